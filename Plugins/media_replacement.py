@@ -0,0 +1,43 @@
+"""
+image_replace: turn the <img>s of a variant's pages into replaced-image placeholders and publish
+their derivatives under derived/. Like packaging.do_build it works on every page at once, so remote
+images are probed together and the media cache is saved once per build.
+"""
+
+import os
+from pathlib import Path
+
+import packaging
+from build_variants import depends_on, open_for_write, parse_page
+
+
+# a changed image can change every page that shows it
+@depends_on("*.png", "*.jpg", "*.jpeg", "*.webp", "*.gif", "*.svg")
+def main(target: Path, attachments, progr=None, task=None, /):
+    pages = []
+    for base, _, files in os.walk(target):
+        for file in files:
+            page = Path(base) / file
+            if file.endswith(".html") and (attachments.dirty is None or page in attachments.dirty):
+                pages.append(page)
+    if progr and task:
+        progr.update(task, total=len(pages))
+
+    soups = {page: parse_page(page.read_text(encoding="utf-8")) for page in pages}
+    remote = packaging.fetch_remote_media(
+        url for soup in soups.values() for url in packaging.remote_sources(soup)
+    )
+    derived = packaging.build_derivatives(
+        [(str(page), soup) for page, soup in soups.items()], str(target), remote, target
+    )
+    for page, soup in soups.items():
+        if packaging.replace_images(soup, target, page.parent, remote, derived):
+            with open_for_write(page, "w", encoding="utf-8") as f:
+                f.write(soup.decode())
+            attachments.replaced(page)
+        if progr and task:
+            progr.advance(task, 1)
+    for base, _, files in os.walk(target / packaging.DERIVED_DIR):
+        for file in files:
+            attachments.touched(Path(base) / file)
+    packaging.media_cache.save()
@@ -0,0 +1,6 @@
+from pathlib import Path
+
+
+def main(path: Path, attachments, /):
+    # the parsed tree stays on the attachments for every later plugin in this file's pass
+    attachments.load_soup()
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import importlib
+import importlib.util
+import re
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Literal, NamedTuple
+
+from strictyaml import Enum, Map, MapPattern, Optional, Seq, Str, load
+
+CONFIG_PATH = Path("alter.yaml")
+
+PLUGIN_SCHEMA = Map(
+    {
+        Optional("provides"): Seq(Str()),
+        Optional("use"): Seq(Str()),
+        Optional("path"): Str(),
+        Optional("module"): Str(),
+        "pipeline": Map(
+            {
+                "target": Enum(["file", "project"]),
+                Optional("match"): Seq(Str()),
+                "entrypoint": Str(),
+            }
+        ),
+    }
+)
+SCHEMA = Map(
+    {
+        Optional("collect"): Map({"rules": Seq(Str())}),
+        "build": MapPattern(
+            Str(),
+            Map(
+                {
+                    Optional("mount"): Str(),
+                    Optional("use"): Seq(Str()),
+                    Optional("exclude"): Seq(Str()),
+                }
+            ),
+        ),
+        "plugins": MapPattern(Str(), PLUGIN_SCHEMA),
+    }
+)
+
+
+class AlterConfigError(ValueError):
+    pass
+
+
+class PluginSpec(NamedTuple):
+    name: str
+    provides: tuple[str, ...]
+    use: tuple[str, ...]
+    path: str | None
+    module: str | None
+    target: Literal["file", "project"]
+    match: tuple[str, ...]
+    entrypoint: str
+
+
+class VariantSpec(NamedTuple):
+    name: str
+    mount: str
+    plugins: tuple[PluginSpec, ...]
+    exclude: tuple[str, ...]
+
+
+_modules: dict[str, ModuleType] = {}
+
+
+def import_plugin(spec: PluginSpec) -> ModuleType:
+    if spec.module is not None:
+        return importlib.import_module(spec.module)
+    assert spec.path is not None
+    path = str(Path(spec.path).resolve())
+    if path not in _modules:
+        loader_spec = importlib.util.spec_from_file_location(f"alter_plugin_{spec.name}", path)
+        if loader_spec is None or loader_spec.loader is None:
+            raise AlterConfigError(f"plugin {spec.name}: can't load {spec.path}")
+        module = importlib.util.module_from_spec(loader_spec)
+        loader_spec.loader.exec_module(module)
+        _modules[path] = module
+    return _modules[path]
+
+
+class PluginAction:
+    """
+    Build action standing in for a plugin entrypoint. The plugin is imported on first call, so
+    variants only pay for the plugins they use; attributes the driver looks for (raw_text,
+    depends_on) are read from the entrypoint.
+    """
+
+    def __init__(self, spec: PluginSpec):
+        self.spec = spec
+        self.__name__ = spec.name
+        self._match = [re.compile(pattern) for pattern in spec.match]
+        self._entry = None
+
+    def load(self):
+        if self._entry is None:
+            module = import_plugin(self.spec)
+            try:
+                self._entry = getattr(module, self.spec.entrypoint)
+            except AttributeError:
+                raise AlterConfigError(
+                    f"plugin {self.spec.name}: no entrypoint {self.spec.entrypoint!r}"
+                ) from None
+        return self._entry
+
+    def applies(self, relative: str) -> bool:
+        return not self._match or any(pattern.search(relative) for pattern in self._match)
+
+    def __call__(self, path: Path, attachments: Any, /, *args):
+        if self.spec.target == "file":
+            if not self.applies(path.relative_to(attachments.base_path).as_posix()):
+                return
+        return self.load()(path, attachments, *args)
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __getstate__(self):
+        # the entrypoint is re-imported in worker processes instead of pickled
+        return {"spec": self.spec}
+
+    def __setstate__(self, state):
+        self.__init__(state["spec"])
+
+    def __repr__(self):
+        return f"PluginAction({self.spec.name!r})"
+
+
+class AlterConfig:
+    def __init__(
+        self, plugins: dict[str, PluginSpec], variants: dict[str, dict], collect: list[str]
+    ):
+        self.plugins = plugins
+        self.variant_data = variants
+        self.collect = collect
+        self.providers: dict[str, PluginSpec] = {}
+        for spec in plugins.values():
+            self.providers[spec.name] = spec
+        for spec in plugins.values():
+            for capability in spec.provides:
+                self.providers.setdefault(capability, spec)
+
+    def resolve(self, names: list[str], requester: str) -> tuple[PluginSpec, ...]:
+        """Plugins needed for names, dependencies first, otherwise in the order asked for."""
+        order: list[PluginSpec] = []
+        state: dict[str, bool] = {}
+
+        def visit(name: str, chain: list[str]):
+            spec = self.providers.get(name)
+            if spec is None:
+                raise AlterConfigError(
+                    f"nothing provides {name!r} (needed by {' -> '.join(chain)})"
+                )
+            if state.get(spec.name) is True:
+                return
+            if state.get(spec.name) is False:
+                raise AlterConfigError(f"dependency cycle: {' -> '.join(chain + [spec.name])}")
+            state[spec.name] = False
+            for dep in spec.use:
+                visit(dep, chain + [spec.name])
+            state[spec.name] = True
+            order.append(spec)
+
+        for name in names:
+            visit(name, [requester])
+        return tuple(order)
+
+    def variants(self) -> list[VariantSpec]:
+        return [
+            VariantSpec(
+                name,
+                data.get("mount", ""),
+                self.resolve(data.get("use", []), name),
+                tuple(data.get("exclude", [])),
+            )
+            for name, data in self.variant_data.items()
+        ]
+
+
+def load_config(path: Path = CONFIG_PATH) -> AlterConfig:
+    with open(path, encoding="utf-8") as f:
+        data = load(f.read(), SCHEMA, label=str(path)).data
+    plugins = {}
+    for name, plugin in data["plugins"].items():
+        if ("path" in plugin) == ("module" in plugin):
+            raise AlterConfigError(f"plugin {name}: exactly one of path/module is required")
+        pipeline = plugin["pipeline"]
+        plugins[name] = PluginSpec(
+            name,
+            tuple(plugin.get("provides", [])),
+            tuple(plugin.get("use", [])),
+            plugin.get("path"),
+            plugin.get("module"),
+            pipeline["target"],
+            tuple(pipeline.get("match", [])),
+            pipeline["entrypoint"],
+        )
+    collect = data.get("collect", {}).get("rules", [])
+    return AlterConfig(plugins, data["build"], collect)
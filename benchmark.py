@@ -0,0 +1,471 @@
+"""
+Build benchmark: generates a synthetic site, then times build_variants.py and packaging.py on it.
+
+    python benchmark.py --pages 200 --images 4 --assets 20 --repeat 3 -o bench.json
+
+Remote images are served by a local HTTP stand-in, so runs don't depend on the network. Results are
+JSON (every run plus the median of each timing) so they can be compared between commits.
+
+    python benchmark.py --imports
+
+checks the startup budget instead: importing the build scripts must not pull in the heavy third
+party packages, and must add no more than --import-budget times a bare interpreter start to it
+(tests/test_imports.py runs the same check).
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import perf_counter, sleep
+from typing import Any, NamedTuple
+
+from PIL import Image
+
+REPO = Path(__file__).resolve().parent
+# what --imports measures: the build scripts as a watch loop or a single-file run would load them
+IMPORT_STATEMENT = "import build_variants, packaging"
+# third party packages that must only be imported by the actions that use them
+LAZY_MODULES = ["bs4", "jinja2", "rich", "PIL", "requests", "urllib3", "watchdog"]
+# what IMPORT_STATEMENT may add to a bare interpreter start, as a multiple of that start: it adds
+# about 0.7, so a machine that is slower overall doesn't fail, but doubling the import time does
+IMPORT_BUDGET = 1.5
+
+
+class SiteParams(NamedTuple):
+    pages: int
+    depth: int
+    images: int
+    remote_fraction: float
+    assets: float
+    variant_fraction: float
+    js_fraction: float
+    seed: int
+
+
+def png_bytes(width: int, height: int, seed: int) -> bytes:
+    rng = random.Random(seed)
+    image = Image.new(
+        "RGB", (width, height), (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    )
+    out = io.BytesIO()
+    image.save(out, "PNG")
+    return out.getvalue()
+
+
+class RemoteImages:
+    """Local stand-in for remote image hosts. Honours Range and If-None-Match like a CDN would."""
+
+    def __init__(self, images: dict[str, bytes], latency: float = 0.0):
+        self.images = images
+        self.latency = latency
+        self.requests = 0
+        remote = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                remote.requests += 1
+                if remote.latency:
+                    sleep(remote.latency)
+                data = remote.images.get(self.path)
+                if data is None:
+                    self.send_error(404)
+                    return
+                etag = f'"{len(data)}-{hash(data) & 0xFFFFFFFF:x}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                status, body = 200, data
+                ranged = self.headers.get("Range", "")
+                if ranged.startswith("bytes="):
+                    start, _, end = ranged[6:].partition("-")
+                    first = int(start or 0)
+                    last = min(int(end) if end else len(data) - 1, len(data) - 1)
+                    status, body = 206, data[first : last + 1]
+                self.send_response(status)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                if status == 206:
+                    self.send_header("Content-Range", f"bytes {first}-{last}/{len(data)}")
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self) -> RemoteImages:
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <title>{title}</title>
+    <link rel="stylesheet" href="/dist/index.css">
+    <script src="/dist/index.js" defer></script>
+{meta}</head>
+<body>
+<nav>{nav}</nav>
+<main class="content">
+    {{% for n in range({paragraphs}) %}}
+    <p id="p{{{{ n }}}}">Paragraph {{{{ n }}}} of {title}. <a href="/static/asset0.bin">a</a></p>
+    {{% endfor %}}
+{body}</main>
+<script>document.body.dataset.ready = "{title}";</script>
+</body>
+</html>
+"""
+
+UNAVAILABLE = """<!doctype html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="variants" data-deny-all>
+    <title>Document not available</title>
+</head>
+<body><main><p>This page needs JavaScript.</p></main></body>
+</html>
+"""
+
+
+def generate_site(root: Path, params: SiteParams, remote: RemoteImages | None) -> dict[str, int]:
+    """Write a site laid out like this repository into root. Returns what was generated."""
+    rng = random.Random(params.seed)
+    shutil.rmtree(root, ignore_errors=True)
+    for directory in ("src", "dist", "static/img", "secret_deploy", "Plugins"):
+        (root / directory).mkdir(parents=True, exist_ok=True)
+    shutil.copy(REPO / "alter.yaml", root / "alter.yaml")
+    for plugin in (REPO / "Plugins").glob("*.py"):
+        shutil.copy(plugin, root / "Plugins" / plugin.name)
+    (root / "LICENSE").write_text("synthetic\n")
+    (root / "secret_deploy" / "keep.txt").write_text("secret\n")
+    (root / "dist" / "index.js").write_text("console.log('x');\n" * 2000)
+    (root / "dist" / "index.css").write_text("body { margin: 0; }\n" * 2000)
+    (root / "src" / "var_unavailable.html").write_text(UNAVAILABLE)
+
+    local_images = max(1, min(32, params.pages * params.images // 4 or 1))
+    for n in range(local_images):
+        data = png_bytes(rng.randrange(16, 400), rng.randrange(16, 400), params.seed + n)
+        (root / "static" / "img" / f"{n}.png").write_bytes(data)
+    asset_bytes = int(params.assets * 1024 * 1024)
+    chunk = 256 * 1024
+    for n in range((asset_bytes + chunk - 1) // chunk):
+        (root / "static" / f"asset{n}.bin").write_bytes(
+            rng.randbytes(min(chunk, asset_bytes - n * chunk))
+        )
+    if asset_bytes == 0:
+        (root / "static" / "asset0.bin").write_bytes(b"")
+
+    remote_images = 0
+    gated = 0
+    for page in range(params.pages):
+        level = page % (params.depth + 1)
+        directory = root / "src" / Path(*[f"section{n}" for n in range(level)])
+        directory.mkdir(parents=True, exist_ok=True)
+        meta = ""
+        if rng.random() < params.variant_fraction:
+            meta = '    <meta name="variants" data-deny data-target="nojs">\n'
+            gated += 1
+        body = []
+        for n in range(params.images):
+            if remote is not None and rng.random() < params.remote_fraction:
+                path = f"/img/{page}-{n}.png"
+                remote.images[path] = png_bytes(
+                    rng.randrange(16, 800), rng.randrange(16, 800), params.seed + page * 977 + n
+                )
+                body.append(f'    <img src="{remote.base}{path}" alt="remote {n}">\n')
+                remote_images += 1
+            else:
+                body.append(
+                    f'    <img src="/static/img/{rng.randrange(local_images)}.png" alt="">\n'
+                )
+        if rng.random() < params.js_fraction:
+            body.append('    <div data-js-required><button onclick="go()">Go</button></div>\n')
+        nav = " ".join(
+            f'<a href="/page{rng.randrange(params.pages)}.html">link</a>' for _ in range(5)
+        )
+        (directory / f"page{page}.html").write_text(
+            PAGE.format(title=f"Page {page}", meta=meta, nav=nav, paragraphs=20, body="".join(body))
+        )
+    return {"pages": params.pages, "remote_images": remote_images, "variant_gated": gated}
+
+
+# spans build_variants records per stage rather than per action, and what they're reported as
+STAGE_SPANS = {"prepare": "prepare", "mount": "mount_tree", "index": "index", "write": "write"}
+
+
+def span_times(spans: list, variant: str) -> dict[str, Any]:
+    """Wall time of a variant's (or "shared"'s) stages, and of its actions summed over files."""
+    times: dict[str, Any] = {"actions": {}}
+    for span in spans:
+        if span.variant != variant:
+            continue
+        if span.action in STAGE_SPANS:
+            key = STAGE_SPANS[span.action]
+            times[key] = times.get(key, 0.0) + span.wall
+        else:
+            times["actions"][span.action] = times["actions"].get(span.action, 0.0) + span.wall
+    return times
+
+
+def bench_variants(jobs: int) -> dict:
+    import build_variants as bv
+    import buildtrace
+    from console import NullProgress
+
+    result: dict[str, Any] = {"variants": {}}
+    start = perf_counter()
+    scripts = bv.load_builds(Path("alter.yaml"))
+    output = Path("deploy")
+    shutil.rmtree(output, ignore_errors=True)
+    output.mkdir()
+    pool = bv.worker_pool(jobs) if jobs > 1 else None
+    batch = bv.shared_actions(scripts)
+    # the build's own tracer, which also collects the spans of worker processes
+    trace = buildtrace.Tracer()
+    previous = buildtrace.install(trace)
+    try:
+        with NullProgress() as prog:
+            t = perf_counter()
+            sources = bv.collect_sources()
+            result["collect_sources"] = perf_counter() - t
+            shared = None
+            if batch:
+                t = perf_counter()
+                shared = (len(batch), *bv.shared_stage(batch, sources, prog, pool, jobs))
+                result["shared_stage"] = {"total": perf_counter() - t}
+            for script in scripts:
+                t = perf_counter()
+                bv.build_variant(script, output, prog, pool, jobs, sources=sources, shared=shared)
+                result["variants"][script.name] = {"total": perf_counter() - t}
+    finally:
+        buildtrace.install(previous)
+        if pool is not None:
+            pool.shutdown()
+    result["total"] = perf_counter() - start
+    if batch:
+        result["shared_stage"].update(span_times(trace.spans, "shared"))
+    for script in scripts:
+        result["variants"][script.name].update(span_times(trace.spans, script.name))
+    return result
+
+
+def bench_packaging() -> dict:
+    import packaging
+
+    if not hasattr(packaging, "do_build"):
+        raise SystemExit(f"imported {packaging.__file__} instead of this repository's packaging.py")
+    packaging.matches = packaging.collect_matches()
+    start = perf_counter()
+    packaging.do_build("packaged")
+    return {"do_build": perf_counter() - start}
+
+
+def clear_caches():
+    shutil.rmtree(".cache", ignore_errors=True)
+    shutil.rmtree(".staging", ignore_errors=True)
+    bv = sys.modules.get("build_variants")
+    if bv is not None:
+        # compiled templates and content hashes are kept in memory
+        bv.drop_caches()
+    packaging = sys.modules.get("packaging")
+    # (not pip's "packaging" distribution, which shares the name)
+    if packaging is not None and hasattr(packaging, "media_cache"):
+        packaging.media_cache = packaging.MediaCache(packaging.CACHE_DIR / "media.json")
+
+
+def startup_time(statement: str, repeat: int) -> float:
+    """Best wall time of a fresh interpreter running statement in the repository."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        subprocess.run([sys.executable, "-c", statement], cwd=REPO, check=True)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def eager_imports() -> list[str]:
+    """The LAZY_MODULES that IMPORT_STATEMENT loads."""
+    probe = f"{IMPORT_STATEMENT}; import sys; print(' '.join(sorted(set(sys.modules))))"
+    loaded = subprocess.run(
+        [sys.executable, "-c", probe], cwd=REPO, capture_output=True, text=True, check=True
+    ).stdout.split()
+    return [module for module in LAZY_MODULES if module in loaded]
+
+
+def import_cost(repeat: int) -> tuple[float, float]:
+    """Seconds a bare interpreter takes to start, and what IMPORT_STATEMENT adds to that."""
+    bare = startup_time("pass", repeat)
+    return bare, startup_time(IMPORT_STATEMENT, repeat) - bare
+
+
+def check_imports(budget: float, repeat: int) -> bool:
+    """
+    Import-time budget: fails if importing the build scripts loads any of LAZY_MODULES, or adds more
+    than budget times a bare interpreter start to it.
+    """
+    eager = eager_imports()
+    bare, cost = import_cost(repeat)
+    print(f"{IMPORT_STATEMENT}: {cost * 1e3:.0f}ms over a {bare * 1e3:.0f}ms interpreter start")
+    ok = True
+    if eager:
+        print(f"FAIL: imported at startup: {', '.join(eager)}")
+        ok = False
+    if cost > budget * bare:
+        print(f"FAIL: over the budget of {budget:g} times the interpreter start")
+        ok = False
+    return ok
+
+
+def flatten(data: dict, prefix: str = "") -> dict[str, float]:
+    out = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            out.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, float):
+            out[prefix + key] = value
+    return out
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="penguinencounter.github.io build benchmark")
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=2, help="directory nesting under src/")
+    parser.add_argument("--images", type=int, default=3, help="<img> tags per page")
+    parser.add_argument(
+        "--remote", type=float, default=0.3, help="fraction of images served remotely"
+    )
+    parser.add_argument("--assets", type=float, default=5.0, help="MiB of static assets")
+    parser.add_argument("--variant-pages", type=float, default=0.1, help="fraction denying nojs")
+    parser.add_argument(
+        "--js-pages", type=float, default=0.3, help="fraction with data-js-required"
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per remote request")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument(
+        "--cold", action="store_true", help="clear .cache/.staging before every run"
+    )
+    parser.add_argument("--site", type=Path, help="where to generate the site (default: temp dir)")
+    parser.add_argument("--skip-packaging", action="store_true")
+    parser.add_argument("-o", "--output", type=Path, help="write JSON here instead of stdout")
+    parser.add_argument(
+        "--imports",
+        action="store_true",
+        help="only check the import-time budget; exits with 1 if it's exceeded",
+    )
+    parser.add_argument(
+        "--import-budget",
+        type=float,
+        default=IMPORT_BUDGET,
+        help="times a bare interpreter start",
+    )
+    args = parser.parse_args()
+    if args.imports:
+        sys.exit(0 if check_imports(args.import_budget, max(args.repeat, 5)) else 1)
+
+    params = SiteParams(
+        args.pages,
+        args.depth,
+        args.images,
+        args.remote,
+        args.assets,
+        args.variant_pages,
+        args.js_pages,
+        args.seed,
+    )
+    temp = None
+    if args.site is None:
+        temp = tempfile.TemporaryDirectory(prefix="site-bench-")
+        site = Path(temp.name) / "site"
+    else:
+        site = args.site.resolve()
+    sys.path.insert(0, str(REPO))
+    here = os.getcwd()
+    runs = []
+    with RemoteImages({}, args.latency) as remote:
+        generated = generate_site(site, params, remote)
+        os.chdir(site)
+        try:
+            for run in range(args.repeat):
+                if args.cold or run == 0:
+                    clear_caches()
+                entry: dict[str, Any] = {"cold": args.cold or run == 0}
+                before = remote.requests
+                with contextlib.redirect_stdout(io.StringIO()):
+                    entry["build_variants"] = bench_variants(args.jobs)
+                    if not args.skip_packaging:
+                        entry["packaging"] = bench_packaging()
+                entry["remote_requests"] = remote.requests - before
+                runs.append(entry)
+                print(
+                    f"run {run + 1}/{args.repeat}: variants {entry['build_variants']['total']:.3f}s"
+                    + (
+                        f", packaging {entry['packaging']['do_build']:.3f}s"
+                        if "packaging" in entry
+                        else ""
+                    ),
+                    file=sys.stderr,
+                )
+        finally:
+            os.chdir(here)
+            if temp is not None:
+                temp.cleanup()
+
+    timings = [flatten(run) for run in runs]
+    report = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params._asdict() | {"jobs": args.jobs, "latency": args.latency},
+        "generated": generated,
+        "runs": runs,
+        "median": {
+            key: statistics.median(t[key] for t in timings if key in t) for key in timings[0]
+        },
+    }
+    text = json.dumps(report, indent=1)
+    if args.output is not None:
+        args.output.write_text(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,176 @@
 from __future__ import annotations
 
+import argparse
+import copy
+import fnmatch
+import functools
+import glob
+import hashlib
+import json
 import os
 import re
 import shutil
-import subprocess
 import sys
 import tempfile
-from pathlib import Path
-from typing import Literal, NamedTuple, Protocol, cast
-
-import bs4
-from bs4 import Tag
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-from rich import print as rp
-from rich.progress import (
-    BarColumn,
-    MofNCompleteColumn,
-    Progress,
-    TaskID,
-    TaskProgressColumn,
-    TextColumn,
-    TimeElapsedColumn,
-    TimeRemainingColumn,
-)
+import threading
+from collections import OrderedDict
+from pathlib import Path, PurePosixPath
+from time import time_ns
+from typing import TYPE_CHECKING, Callable, Iterable, Literal, NamedTuple, Protocol, cast
+
+import buildtrace
+import console
+from buildtrace import Tracer
+from console import rp
+from htmlrewrite import HTMLRewriter, RewriteUnsupported
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+    import bs4
+    from bs4 import Tag
+    from jinja2 import Environment, FileSystemBytecodeCache
+    from rich.progress import Progress, TaskID
+
+    from references import PageLinks
+
+# plugins declared with "module: build_variants" must resolve to this module, not a second copy
+sys.modules.setdefault("build_variants", sys.modules[__name__])
 
 TEMPLATE_DIR = Path("src")
-jinja = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=select_autoescape())
+# staging lives inside the checkout so files can be hardlinked/reflinked instead of copied
+STAGING_ROOT = Path(".staging")
+CACHE_DIR = Path(".cache")
+MANIFEST_DIR = CACHE_DIR / "manifests"
+# output of the actions every variant starts with, kept between builds
+SHARED_STAGE = STAGING_ROOT / "shared"
+# with --artifact, variants are mounted here (one tree each) instead of into deploy/
+ARTIFACT_STAGE = STAGING_ROOT / "artifact"
+# every variant stages these unchanged, so fix_rel_url leaves links to them on the root mount's copy:
+# one file for the browser to cache, whichever variant it's browsing
+SHARED_URL_PREFIXES = ("/static/",)
+MANIFEST_VERSION = 1
+# content hashes kept by (device, inode, size, mtime): a build hashes most files several times, and
+# the build daemon hashes the same sources for every build it runs
+HASH_CACHE_ENTRIES = 8192
+# like git's racily clean entries: a file modified this recently could change again without its
+# mtime moving, so its hash isn't kept
+HASH_RACY_WINDOW_NS = 50_000_000
+# parsed pages kept by content hash; 0 (one-shot builds) keeps none, since handing out a copy of a
+# kept tree costs about two thirds of a parse. daemon.py turns it on in itself and its workers
+parsed_page_entries = 0
+
+
+def template_cache() -> FileSystemBytecodeCache:
+    from jinja2 import FileSystemBytecodeCache
+
+    # entries are checked against the template source's hash, so edits just replace them
+    directory = CACHE_DIR / "jinja"
+    directory.mkdir(parents=True, exist_ok=True)
+    return FileSystemBytecodeCache(str(directory))
+
+
+@functools.cache
+def templates() -> Environment:
+    # built on first use: importing jinja2 is a noticeable part of startup, and not every build renders
+    from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+    return Environment(
+        loader=FileSystemLoader(TEMPLATE_DIR),
+        autoescape=select_autoescape(),
+        bytecode_cache=template_cache(),
+    )
+
+
+def _group_end(pattern: str, at: int) -> int:
+    depth = 0
+    i = at
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i += 2
+            continue
+        if c == "[":
+            i = pattern.index("]", i + 2)
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    raise re.error("unbalanced parenthesis", pattern, at)
+
+
+def literal_prefix(pattern: str) -> tuple[str | None, bool]:
+    """
+    Literal text every match of an anchored pattern starts with, and whether the pattern is only that
+    literal (so anything starting with it matches). (None, False) if no prefix can be determined.
+    """
+    if not pattern.startswith("^") or "|" in pattern:
+        return None, False
+    out = []
+    i = 1
+    closers = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "(":
+            end = _group_end(pattern, i)
+            if pattern[end + 1 : end + 2] in ("*", "?", "{", "+"):
+                break
+            if pattern.startswith("(?:", i):
+                i += 3
+            elif pattern.startswith("(?P<", i):
+                i = pattern.index(">", i) + 1
+            elif pattern.startswith("(?", i):
+                break
+            else:
+                i += 1
+            closers += 1
+            continue
+        if c == ")" and closers:
+            closers -= 1
+            i += 1
+            continue
+        if c == "\\":
+            lit = pattern[i + 1 : i + 2]
+            if not lit or lit.isalnum():
+                break
+            step = 2
+        elif c in ".[]{}()*+?^$|":
+            break
+        else:
+            lit = c
+            step = 1
+        if pattern[i + step : i + step + 1] in ("*", "?", "{"):
+            break
+        out.append(lit)
+        i += step
+    return "".join(out), i == len(pattern)
 
 
 class MapProvider:
+    inbound: str
+
     def process(
         self, source_path: Path, output_path: Path
     ) -> tuple[Literal[True], Path] | tuple[Literal[False] | Literal[None], Literal[None]]: ...
 
+    def may_match(self, directory: Path) -> bool:
+        """Whether a file somewhere under directory could be matched."""
+        prefix, _ = literal_prefix(self.inbound)
+        if prefix is None or directory == Path(os.curdir):
+            return True
+        below = str(directory) + os.sep
+        return below.startswith(prefix) or prefix.startswith(below)
+
+    def covers(self, directory: Path) -> bool:
+        """Whether every file under directory is matched."""
+        prefix, exact = literal_prefix(self.inbound)
+        if prefix is None or not exact or directory == Path(os.curdir):
+            return False
+        return (str(directory) + os.sep).startswith(prefix)
+
 
 class DiscardMap(MapProvider):
     def __init__(self, inbound_pattern: str):
@@ -86,15 +224,54 @@ class SourceMap(MapProvider):
         return True, output_path / result
 
 
-SOURCES = [
+# never staged, whatever the collect rules say
+DISCARDED = [
     DiscardMap(r"^node_modules"),
     DiscardMap(r"^deploy"),
-    SourceMap(r"^(dist[/\\].*)$", r"$1$"),
-    SourceMap(r"^(static[/\\].*)$", r"$1$"),
-    SourceMap(r"^(secret_deploy[/\\].*)$", r"$1$"),
-    SourceMap(r"^LICENSE$"),
-    SourceMap(r"^src[/\\](.*?\.html)$", "$1$"),
 ]
+# collect rules for a config without any
+DEFAULT_COLLECT = ["src/*.html", "dist", "static", "LICENSE", "secret_deploy"]
+
+
+def collect_rule(rule: str) -> SourceMap:
+    """
+    The SourceMap for one of alter.yaml's collect rules: a path whose parts may use the wildcards *
+    and ? (which, as in fnmatch, also match /). Matches are staged relative to the directory the
+    wildcards start in (or the last part's, without any), and a directory stages everything below
+    it: 'dist' stages dist/a.js as it is, 'src/*.html' stages src/tools/b.html as tools/b.html.
+    """
+    parts = PurePosixPath(rule).parts
+    fixed = next((i for i, part in enumerate(parts) if "*" in part or "?" in part), len(parts) - 1)
+    base = "".join(re.escape(part) + r"[/\\]" for part in parts[:fixed])
+    staged = r"[/\\]".join(
+        re.escape(part).replace(r"\*", ".*").replace(r"\?", ".") for part in parts[fixed:]
+    )
+    return SourceMap(rf"^{base}({staged}(?:[/\\].*)?)$", "$1$")
+
+
+# what collect_sources stages; load_builds sets it from the config's collect rules
+SOURCES: list[MapProvider] = [*DISCARDED, *map(collect_rule, DEFAULT_COLLECT)]
+
+
+def use_collect_rules(rules: list[str]):
+    global SOURCES
+    SOURCES = [*DISCARDED, *map(collect_rule, rules)]
+
+
+class DirectoryMatcher:
+    def __init__(self, sources: list[MapProvider]):
+        self.sources = sources
+
+    def enter(self, directory: Path) -> bool:
+        # rules apply in order: a discard covering the whole subtree only wins if no
+        # earlier mapping could claim something inside it
+        for source in self.sources:
+            if isinstance(source, DiscardMap):
+                if source.covers(directory):
+                    return False
+            elif source.may_match(directory):
+                return True
+        return False
 
 
 class ProcessingAction:
@@ -103,17 +280,166 @@ class ProcessingAction:
     REPLACE = -2
 
 
+class VariantRules(NamedTuple):
+    """A page's <meta name="variants"> tags: data-deny-all, or data-allow/data-deny with data-target."""
+
+    deny_all: bool
+    allow: tuple[str, ...]
+    deny: tuple[str, ...]
+
+    def allows(self, variant: str) -> bool:
+        if self.deny_all:
+            return False
+        if self.allow:
+            return variant in self.allow and variant not in self.deny
+        return variant not in self.deny
+
+
+def page_rules(text: str) -> VariantRules | None:
+    """The variant rules declared by a page, or None if it has none (it's in every variant)."""
+    if "variants" not in text:
+        return None
+    deny_all = False
+    allow: list[str] = []
+    deny: list[str] = []
+
+    def collect(element):
+        nonlocal deny_all
+        if element.has_attribute("data-deny-all"):
+            deny_all = True
+        if (variant := element.get_attribute("data-target")) is None:
+            return
+        if element.has_attribute("data-allow"):
+            allow.append(variant)
+        if element.has_attribute("data-deny"):
+            deny.append(variant)
+
+    HTMLRewriter().on('meta[name="variants"]', collect).transform(text)
+    if not (deny_all or allow or deny):
+        return None
+    return VariantRules(deny_all, tuple(allow), tuple(deny))
+
+
 class Attachments:
-    def __init__(self, build_script: BuildScript, base_path: Path, /):
+    def __init__(
+        self,
+        build_script: BuildScript,
+        base_path: Path,
+        /,
+        dirty: set[Path] | None = None,
+        output: Path | None = None,
+        rules: dict[str, VariantRules] | None = None,
+        links: dict[str, PageLinks | None] | None = None,
+        shared_links: set[str] | None = None,
+    ):
         self.build_script: BuildScript = build_script
         self.base_path: Path = base_path
+        # staged files whose inputs changed since the last build; None means everything
+        self.dirty: set[Path] | None = dirty
+        # where the variant gets mounted; staged files outside dirty are already final there
+        self.output: Path | None = output
+        # variant rules of every rendered page that has any, by staged path; None if not indexed
+        self.rules: dict[str, VariantRules] | None = rules
+        # what the variant's file pass found in the pages it processed, by staged path; None for
+        # pages a project action replaced since, and no dict at all if there was no file pass
+        self.links: dict[str, PageLinks | None] | None = links
+        # the site paths (without a leading /) the rendered pages reference, as the shared stage
+        # left them for every variant; None if there was no shared stage
+        self.shared_links: set[str] | None = shared_links
+
+    def allows(self, path: Path) -> bool:
+        """Whether the page staged at path belongs in this variant."""
+        if self.rules is not None:
+            rules = self.rules.get(path.relative_to(self.base_path).as_posix())
+        else:
+            with open(self.final(path), encoding="utf-8") as f:
+                rules = page_rules(f.read())
+        return rules is None or rules.allows(self.build_script.name)
+
+    def touched(self, path: Path):
+        """A project action rewrote the staged file at path, so it has to be mounted again."""
+        if self.dirty is not None:
+            self.dirty.add(path)
+
+    def replaced(self, path: Path):
+        """A project action put other content at path: what the file pass found there is stale."""
+        self.touched(path)
+        if self.links is not None:
+            self.links[path.relative_to(self.base_path).as_posix()] = None
+
+    def final(self, path: Path) -> Path:
+        """Where a staged file's finished content is; for unchanged files that's the output."""
+        if self.dirty is None or path in self.dirty or self.output is None:
+            return path
+        mounted = self.output / path.relative_to(self.base_path)
+        return mounted if mounted.exists() else path
 
 
 class FileAttachments(Attachments):
-    def __init__(self, build_script: BuildScript, base_path: Path, /):
+    def __init__(self, build_script: BuildScript, base_path: Path, path: Path, /):
         super().__init__(build_script, base_path)
+        self.path: Path = path
         self.soup: bs4.BeautifulSoup | None = None
         self.soup_modified: bool = False
+        self.text: str | None = None
+        self.text_modified: bool = False
+
+    def load_soup(self) -> bs4.BeautifulSoup:
+        if self.soup is None:
+            if self.text is not None:
+                self.soup = parse_page(self.text)
+            else:
+                with open(self.path, "rb") as f:
+                    data = f.read()
+                buildtrace.tracer().read(len(data))
+                self.soup = parse_page(data)
+        return self.soup
+
+    def load_text(self) -> str:
+        if self.soup is not None and self.soup_modified:
+            self.set_text(self.soup.decode())
+        if self.text is None:
+            with open(self.path, encoding="utf-8") as f:
+                self.text = f.read()
+            buildtrace.tracer().read(len(self.text))
+        return self.text
+
+    def rewrite(self, rewriter: HTMLRewriter) -> bool:
+        """
+        Run a streaming rewrite over the document text. Returns False when the caller has to make
+        its edit on the parsed tree instead: the tree holds unsaved edits or the rewriter gave up.
+        """
+        if self.soup is not None and self.soup_modified:
+            return False
+        text = self.load_text()
+        try:
+            rewritten = rewriter.transform(text)
+        except RewriteUnsupported:
+            return False
+        if rewritten != text:
+            self.set_text(rewritten)
+        return True
+
+    def set_text(self, text: str):
+        # the cached tree no longer matches the document
+        self.text = text
+        self.text_modified = True
+        self.soup = None
+        self.soup_modified = False
+
+    def flush(self) -> bool:
+        if not self.path.exists():
+            return False
+        if self.soup is not None and self.soup_modified:
+            data = self.soup.decode()
+        elif self.text is not None and self.text_modified:
+            data = self.text
+        else:
+            return False
+        with open_for_write(self.path, encoding="utf-8") as f:
+            f.write(data)
+        buildtrace.tracer().wrote(len(data))
+        return True
 
 
 class FileActionType(Protocol):
@@ -121,6 +447,54 @@ class FileActionType(Protocol):
     def __call__(self, path: Path, attachments: FileAttachments, /): ...
 
 
+def raw_text(action: FileActionType) -> FileActionType:
+    """Mark a file action as working on FileAttachments.text instead of a parsed tree."""
+    setattr(action, "raw_text", True)
+    return action
+
+
+def variant_independent(action: FileActionType) -> FileActionType:
+    """Mark a file action whose output is the same in every variant, so it can run once for all."""
+    setattr(action, "variant_independent", True)
+    return action
+
+
+def depends_on(*staged: str):
+    """
+    Declare staged files a project action reads for every page; changing one rebuilds the variant.
+    They're fnmatch patterns, so '*.png' is every PNG.
+    """
+
+    def mark(action: ProjectActionType) -> ProjectActionType:
+        setattr(action, "depends_on", staged)
+        return action
+
+    return mark
+
+
+def keyed_by(state: Callable[[], str]):
+    """
+    Declare outside state a file action's output depends on, like a password in the environment.
+    state() returns a digest of it for the manifests; when it changes, every file goes through the
+    action again.
+    """
+
+    def mark(action: FileActionType) -> FileActionType:
+        setattr(action, "state", state)
+        return action
+
+    return mark
+
+
+def action_names(actions: Iterable[FileActionType | ProjectActionType]) -> list[str]:
+    """The actions as the manifests record them, with the state of keyed_by actions."""
+    names = []
+    for action in actions:
+        state = getattr(action, "state", None)
+        names.append(action.__name__ if state is None else f"{action.__name__}:{state()}")
+    return names
+
+
 class ProjectActionType(Protocol):
     __name__: str
     def __call__(
@@ -134,49 +508,279 @@ class BuildScript(NamedTuple):
         tuple[str, FileActionType | ProjectActionType]
     ]
     mount: str
+    exclude: tuple[str, ...] = ()
 
 
-def prepare(target: Path, progress: Progress, prog_task: TaskID):
-    copies = 0
-    filec = 0
-    validates = 0
+def load_builds(config: Path) -> list[BuildScript]:
+    import alter
+
+    loaded = alter.load_config(config)
+    use_collect_rules(loaded.collect or DEFAULT_COLLECT)
+    return [
+        BuildScript(
+            variant.name,
+            [(spec.target, alter.PluginAction(spec)) for spec in variant.plugins],
+            variant.mount,
+            variant.exclude,
+        )
+        for variant in loaded.variants()
+    ]
+
+
+FICLONE = 0x40049409
+
+
+def reflink(source: Path, target: Path):
+    import fcntl
+
+    with open(source, "rb") as fi, open(target, "wb") as fo:
+        try:
+            fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+        except OSError:
+            fo.close()
+            target.unlink()
+            raise
+
+
+def stage_file(source: Path, target: Path) -> str:
+    """
+    Place source at target without copying bytes where possible. Hardlinks share the source inode, so
+    anything writing to a staged file must go through open_for_write().
+    """
+    try:
+        os.link(source, target)
+        return "linked"
+    except OSError:
+        pass
+    try:
+        reflink(source, target)
+        return "reflinked"
+    except (OSError, ImportError):
+        pass
+    shutil.copy(source, target)
+    return "copied"
+
+
+def open_for_write(path: Path, mode: str = "w", **kwargs):
+    # copy-on-write: a hardlinked file is unlinked first so the write lands in a fresh inode
+    try:
+        if path.stat().st_nlink > 1:
+            path.unlink()
+    except FileNotFoundError:
+        pass
+    return open(path, mode, **kwargs)
+
+
+def mount_tree(source: Path, target: Path, only: set[Path] | None = None):
+    for base, dirs, files in source.walk():
+        out = target / base.relative_to(source)
+        out.mkdir(parents=True, exist_ok=True)
+        for file in files:
+            if only is not None and base / file not in only:
+                continue
+            try:
+                os.replace(base / file, out / file)
+            except OSError:
+                (out / file).unlink(missing_ok=True)
+                stage_file(base / file, out / file)
+
+
+def deduplicate(
+    trees: list[Path], link: bool = True, skip: set[Path] | None = None
+) -> tuple[int, int]:
+    """
+    Find files with the same content across mounted trees, apart from those in skip; with link,
+    every copy after the first is replaced by a hardlink to it. Returns how many files and bytes
+    were duplicates.
+    """
+    by_size: dict[int, list[Path]] = {}
+    for tree in trees:
+        for base, _, names in tree.walk():
+            for name in names:
+                path = base / name
+                if (skip is None or path not in skip) and (size := path.stat().st_size):
+                    by_size.setdefault(size, []).append(path)
+
+    count = duplicated = 0
+    # staging hardlinks untouched files to their sources, so many copies already share an inode
+    digests: dict[tuple[int, int], str] = {}
+    for size, paths in by_size.items():
+        if len(paths) < 2:
+            continue
+        first: dict[str, Path] = {}
+        for path in paths:
+            stat = path.stat()
+            inode = (stat.st_dev, stat.st_ino)
+            if inode not in digests:
+                digests[inode] = file_hash(path)
+            original = first.setdefault(digests[inode], path)
+            if original is path:
+                continue
+            count += 1
+            duplicated += size
+            if link and not os.path.samefile(original, path):
+                linked = path.with_name(path.name + ".dedupe")
+                linked.unlink(missing_ok=True)
+                os.link(original, linked)
+                os.replace(linked, path)
+    return count, duplicated
 
-    total = 0
-    for base, dirs, files in os.walk(".", followlinks=True):
-        total += len(files)
-    progress.update(prog_task, total=total)
+
+def shadowed_copies(selected: list[BuildScript], outputs: dict[str, Path]) -> set[Path]:
+    """
+    The files variants under a mount stage below SHARED_URL_PREFIXES that none of their pages or
+    stylesheets load, with their precompressed siblings. fix_rel_url sends links to
+    them to the root mount's copy, so theirs is never requested. Only variants with a references
+    action (which records what's unreferenced) are looked at.
+    """
+    from references import load_graph
+
+    root = next((outputs[s.name] for s in selected if not s.mount.strip("/")), None)
+    if root is None:
+        return set()
+    shadowed: set[Path] = set()
+    for script in selected:
+        mount = script.mount.strip("/")
+        if not mount or "references" not in (action.__name__ for _, action in script.targets):
+            continue
+        graph = load_graph(script.name)
+        for served in graph["unreferenced"] if graph is not None else ():
+            rest = served[len(mount) + 1 :]
+            if rest.startswith(SHARED_URL_PREFIXES) and (root / rest[1:]).exists():
+                copy = outputs[script.name] / served[1:]
+                shadowed.add(copy)
+                shadowed.update(copy.parent.glob(f"{glob.escape(copy.name)}.*"))
+    return shadowed
+
+
+def write_artifact(
+    path: Path, trees: list[Path], mtime: int = 0, omit: set[Path] | None = None
+) -> int:
+    """
+    Write mounted trees into one tar, the format GitHub Pages deploys, leaving out the files in
+    omit. Where paths collide the later tree wins, as when mounting them in order. Entries are
+    sorted and carry fixed metadata, so the same site always gives the same bytes. Returns the
+    number of files.
+    """
+    import tarfile
+
+    files: dict[str, Path] = {}
+    for tree in trees:
+        for base, _, names in tree.walk():
+            rel = base.relative_to(tree)
+            for name in names:
+                if omit is None or base / name not in omit:
+                    files[(rel / name).as_posix()] = base / name
+    # the directories holding them, so one emptied by omit isn't written
+    dirs = {parent.as_posix() for name in files for parent in Path(name).parents} - {"."}
+    dirs -= files.keys()
+    entries: list[tuple[str, Path | None]] = [(name, None) for name in dirs]
+    entries += files.items()
+    entries.sort()
+
+    trace = buildtrace.tracer()
+    partial = path.with_name(path.name + ".partial")
+    with tarfile.open(partial, "w", format=tarfile.PAX_FORMAT) as tar:
+        for name, source in entries:
+            info = tarfile.TarInfo(name)
+            info.mtime = mtime
+            if source is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+                continue
+            info.mode = 0o644
+            with open(source, "rb") as f:
+                info.size = os.fstat(f.fileno()).st_size
+                tar.addfile(info, f)
+            trace.read(info.size)
+    os.replace(partial, path)
+    trace.wrote(path.stat().st_size)
+    return len(files)
+
+
+def collect_sources() -> list[tuple[Path, Path]]:
+    """Every file a variant stages, with where it goes relative to the staging directory."""
+    matcher = DirectoryMatcher(SOURCES)
+    sources: list[tuple[Path, Path]] = []
 
     for base, dirs, files in os.walk(".", followlinks=True):
         pb = Path(base)
+        dirs[:] = [d for d in dirs if matcher.enter(pb / d)]
         for file in files:
-            filec += 1
-            if progress is not None and prog_task is not None:
-                progress.advance(prog_task, 1)
             for source in SOURCES:
-                validates += 1
-                state, result = source.process(pb / file, target)
+                state, result = source.process(pb / file, Path())
                 if state:
-                    k: Path = result
-                    os.makedirs(k.parent, exist_ok=True)
-                    shutil.copy(pb / file, k)
-                    copies += 1
+                    sources.append((pb / file, cast(Path, result)))
                     break
                 elif state is None:
                     continue
                 elif not state:
                     break
-    rp(rf"[green]Copied [bold]{copies}[/] files to [bold cyan]{target}[/][/]")
+    return sources
+
+
+def prepare(
+    target: Path,
+    sources: list[tuple[Path, Path]],
+    progress: Progress,
+    prog_task: TaskID,
+    substitutes: dict[Path, Path] | None = None,
+) -> list[tuple[Path, Path]]:
+    """Stage sources into target, taking a source's shared stage output where there is one."""
+    staged: list[tuple[Path, Path]] = []
+    progress.update(prog_task, total=len(sources))
+    methods: dict[str, int] = {}
+    for source_path, rel in sources:
+        k = target / rel
+        origin = source_path
+        if substitutes is not None and source_path in substitutes:
+            origin = substitutes[source_path]
+            if not origin.exists():
+                # a shared action deleted it
+                progress.advance(prog_task, 1)
+                continue
+        os.makedirs(k.parent, exist_ok=True)
+        method = stage_file(origin, k)
+        methods[method] = methods.get(method, 0) + 1
+        staged.append((source_path, k))
+        progress.advance(prog_task, 1)
+    summary = ", ".join(f"{method} [bold]{count}[/]" for method, count in sorted(methods.items()))
+    rp(rf"[green]Staged {summary or '[bold]0[/]'} files to [bold cyan]{target}[/][/]")
+    return staged
+
 
+def is_root_relative(url: str | None) -> bool:
+    return url is not None and url.startswith("/") and not url.startswith("//")
 
+
+def remounted(url: str | None) -> bool:
+    """Whether fix_rel_url moves a URL under the variant's mount."""
+    return is_root_relative(url) and not url.startswith(SHARED_URL_PREFIXES)  # type: ignore[union-attr]
+
+
+@raw_text
 def fix_rel_url(path: Path, att: FileAttachments):
     if path.suffix != ".html":
         return
-    page = att.soup
-    assert page is not None
     build = att.build_script
     if build.mount == "":
         return
 
+    def remount(element):
+        if element.has_attribute("data-link-absolute") or element.tag_name == "script":
+            return
+        rel = (element.get_attribute("rel") or "").split()
+        if element.tag_name == "link" and "stylesheet" in rel:
+            return
+        for attr in ("href", "src"):
+            if remounted(value := element.get_attribute(attr)):
+                element.set_attribute(attr, "/" + build.mount + value)
+
+    if att.rewrite(HTMLRewriter().on("[href], [src]", remount)):
+        return
+    page = att.load_soup()
+
     def is_local(a: Tag):
         return "data-link-absolute" not in a.attrs
 
@@ -189,62 +793,26 @@ def fix_rel_url(path: Path, att: FileAttachments):
         if result.name == "link" and "rel" in result.attrs and "stylesheet" in result.attrs["rel"]:
             continue
         if "href" in result.attrs:
-            if result.attrs["href"].startswith("/") and not result.attrs["href"].startswith("//"):
+            if remounted(result.attrs["href"]):
                 result.attrs["href"] = "/" + build.mount + result.attrs["href"]
                 modified = True
         if "src" in result.attrs:
-            if result.attrs["src"].startswith("/") and not result.attrs["src"].startswith("//"):
+            if remounted(result.attrs["src"]):
                 result.attrs["src"] = "/" + build.mount + result.attrs["src"]
                 modified = True
     if modified:
         att.soup_modified = True
 
 
-def canonicals(target: Path, attach: FileAttachments):
-    if target.suffix != ".html":
-        return
-    struct = attach.soup
-    assert struct is not None
-    if not (el := struct.select_one('meta[name="canonical-options"]')):
-        return
-    value = el.attrs["content"]
-    print(target.relative_to(attach.base_path))
-    struct.new_tag("link", rel="canonical", href=value)
-    attach.soup_modified = True
-
-
-def process_variant_desc(page: bs4.BeautifulSoup, target_name: str) -> bool:
-    # <meta name="variants" allow target="nojs">
-    if page.select('meta[name="variants"][data-deny-all]'):
-        return False
-    allowlist = page.select('meta[name="variants"][data-allow][data-target]')
-    denylist = page.select('meta[name="variants"][data-deny][data-target]')
-    if not (allowlist or denylist):
-        return True
-    deny = True
-    results = set()
-    if allowlist:
-        deny = False
-    for tag in allowlist:
-        results.add(tag.attrs["data-target"])
-    for tag in denylist:
-        if deny:
-            results.add(tag.attrs["data-target"])
-        else:
-            results.discard(tag.attrs["data-target"])
-    if deny:
-        return target_name not in results
-    else:
-        return target_name in results
-
-
+@raw_text
 def noscript_v2(target: Path, attach: FileAttachments):
     if target.suffix == ".js":
         target.unlink()
     if target.suffix != ".html":
         return
-    struct = attach.soup
-    assert struct is not None
+    if attach.rewrite(HTMLRewriter().on("script, [data-js-required]", lambda e: e.remove())):
+        return
+    struct = attach.load_soup()
     attach.soup_modified = True
     for e in struct.find_all("script"):
         e.decompose()
@@ -252,155 +820,831 @@ def noscript_v2(target: Path, attach: FileAttachments):
         e.decompose()
 
 
-def process_noscript(target: Path, force: bool = False):
-    with open(target, encoding="utf-8") as f:
-        content = f.read()
-        struct = bs4.BeautifulSoup(content, "html.parser")
-    if not force and not process_variant_desc(struct, "nojs"):
-        return None
-    for e in struct.find_all("script"):
-        e.decompose()
-    for e in struct.select("[data-js-required]"):
-        e.decompose()
-    return struct
-
-
-def noscript(target: Path, _: Attachments, progr: Progress | None = None, task: TaskID | None = None):
+@depends_on("var_unavailable.html")
+def noscript(target: Path, att: Attachments, progr: Progress | None = None, task: TaskID | None = None):
+    # scripts are already gone (noscript_v2); what's left is swapping out pages this variant doesn't get
     shutil.rmtree(target / "dist", ignore_errors=True)
     targets = []
     for base, dirs, files in os.walk(target):
         for file in files:
             if file.endswith(".html"):
-                targets.append(Path(base) / file)
+                if att.dirty is None or Path(base) / file in att.dirty:
+                    targets.append(Path(base) / file)
             elif file.endswith(".js"):
                 (Path(base) / file).unlink()
     if progr and task:
         progr.update(task, total=len(targets))
+    unavailable_page = target / "var_unavailable.html"
+    trace = buildtrace.tracer()
     try:
-        missing_template = process_noscript(target / "var_unavailable.html", force=True)
+        with open(att.final(unavailable_page), "rb") as f:
+            unavailable = f.read()
     except FileNotFoundError as e:
-        rp('[bold red]stopped at exception: [/]', e)
+        console.error('[bold red]stopped at exception: [/]', e)
         if progr:
             progr.stop()
+        import subprocess
+
         subprocess.call(['pwsh'], cwd=target)
         raise
-    assert missing_template is not None
-    for target in targets:
-        struct = process_noscript(target)
-        if struct is None:
-            struct = missing_template
-        with open(target, "w", encoding="utf-8") as f:
-            f.write(struct.decode())
+    trace.read(len(unavailable))
+    for page in targets:
+        if page != unavailable_page and not att.allows(page):
+            with open_for_write(page, "wb") as f:
+                f.write(unavailable)
+            trace.wrote(len(unavailable))
+            att.replaced(page)
         if progr and task:
             progr.advance(task, 1)
 
 
-def pjinja(target: Path, att: Attachments):
+@variant_independent
+@raw_text
+def pjinja(target: Path, att: FileAttachments):
     if target.suffix != ".html":
         return
     template_name = str(target.relative_to(att.base_path)).replace("\\", "/")
-    result = jinja.get_template(template_name).render()
-    with open(target, "w", encoding="utf-8") as f:
-        f.write(result)
+    att.set_text(templates().get_template(template_name).render())
 
 
-def full(target: Path):
-    pass
+_hashes: OrderedDict[tuple[int, int, int, int], str] = OrderedDict()
+_hashes_lock = threading.Lock()
 
 
-if __name__ == "__main__":
-    jinja_task = ('file', pjinja)
-    builds = [
-        BuildScript(
-            "nojs", [jinja_task, ("file", noscript_v2), ("file", fix_rel_url), ("project", noscript)], "v/nojs"
-        ),
-        BuildScript("full", [jinja_task, ("file", canonicals), ("file", fix_rel_url)], ""),
-    ]
-    output = Path("deploy")
-    shutil.rmtree(output, ignore_errors=True)
-    os.makedirs(output)
-    targets = []
-    for name in sys.argv[1:]:
-        targets.append(name)
-    for script in builds:
-        name = script.name
-        if targets and name not in targets:
-            rp(f"Skipping [bold yellow]{name}[/]")
+_parsed: OrderedDict[str, bs4.BeautifulSoup] = OrderedDict()
+_parsed_lock = threading.Lock()
+
+
+def keep_parsed_pages(entries: int):
+    global parsed_page_entries
+    parsed_page_entries = entries
+
+
+def parse_page(data: str | bytes) -> bs4.BeautifulSoup:
+    """
+    A page parsed with html.parser. With parsed_page_entries, the tree is kept by content hash and
+    every caller gets a copy of it, since actions edit their tree in place.
+    """
+    import bs4
+
+    if not parsed_page_entries:
+        buildtrace.tracer().parsed()
+        return bs4.BeautifulSoup(data, "html.parser")
+    if isinstance(data, str):
+        key = "str:" + hashlib.sha256(data.encode()).hexdigest()
+    else:
+        key = "bytes:" + hashlib.sha256(data).hexdigest()
+    with _parsed_lock:
+        if (kept := _parsed.get(key)) is not None:
+            _parsed.move_to_end(key)
+    if kept is None:
+        kept = bs4.BeautifulSoup(data, "html.parser")
+        buildtrace.tracer().parsed()
+        with _parsed_lock:
+            _parsed[key] = kept
+            while len(_parsed) > parsed_page_entries:
+                _parsed.popitem(last=False)
+    return copy.copy(kept)
+
+
+def file_hash(path: Path) -> str:
+    stat = os.stat(path)
+    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _hashes_lock:
+        if (digest := _hashes.get(key)) is not None:
+            _hashes.move_to_end(key)
+            return digest
+    with open(path, "rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    if time_ns() - stat.st_mtime_ns > HASH_RACY_WINDOW_NS:
+        with _hashes_lock:
+            _hashes[key] = digest
+            while len(_hashes) > HASH_CACHE_ENTRIES:
+                _hashes.popitem(last=False)
+    return digest
+
+
+def drop_caches():
+    """
+    Forget what the process keeps between builds: compiled templates, content hashes and parsed
+    pages.
+    """
+    templates.cache_clear()
+    referenced_templates.cache_clear()
+    imported_modules.cache_clear()
+    with _hashes_lock:
+        _hashes.clear()
+    with _parsed_lock:
+        _parsed.clear()
+
+
+@functools.lru_cache(maxsize=1024)
+def referenced_templates(name: str, digest: str) -> tuple[str, ...]:
+    """The templates name extends/includes/imports directly; digest is its source's hash."""
+    from jinja2 import meta
+
+    jinja = templates()
+    source, _, _ = jinja.loader.get_source(jinja, name)  # type: ignore[union-attr]
+    return tuple(ref for ref in meta.find_referenced_templates(jinja.parse(source)) if ref is not None)
+
+
+def template_deps(name: str) -> dict[str, str]:
+    """Hashes of every template a page pulls in through extends/include/import, transitively."""
+    found: dict[str, str] = {}
+    pending = [name]
+    while pending:
+        current = pending.pop()
+        for ref in referenced_templates(current, file_hash(TEMPLATE_DIR / current)):
+            if ref in found:
+                continue
+            found[ref] = file_hash(TEMPLATE_DIR / ref)
+            pending.append(ref)
+    return found
+
+
+@functools.lru_cache(maxsize=256)
+def imported_modules(path: Path, digest: str) -> tuple[str, ...]:
+    """The top-level modules path imports absolutely, anywhere in it; digest is its hash."""
+    import ast
+
+    names = []
+    for node in ast.walk(ast.parse(path.read_bytes(), str(path))):
+        if isinstance(node, ast.Import):
+            names += [alias.name.partition(".")[0] for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+            names.append(node.module.partition(".")[0])
+    return tuple(names)
+
+
+def tool_modules(actions: Iterable[FileActionType | ProjectActionType]) -> list[Path]:
+    """
+    The Python files a build with these actions runs: this module, the plugins' and whatever they
+    import from next to this one, found by following import statements rather than importing.
+    """
+    here = Path(__file__).resolve().parent
+    pending = [Path(__file__).resolve()]
+    for action in actions:
+        spec = getattr(action, "spec", None)
+        if spec is None:
             continue
-        mount = script.mount
-        with tempfile.TemporaryDirectory() as td, Progress(
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            TaskProgressColumn(),
-            MofNCompleteColumn(),
-            TimeElapsedColumn(),
-            TimeRemainingColumn(),
-            refresh_per_second=20,
-        ) as prog:
-            copy_task = prog.add_task("[bright_blue]Stage build env[/]", total=None)
-            tasks = []
-            for action in script.targets:
-                tasks.append(
-                    prog.add_task(
-                        rf"[italic magenta]{action[1].__name__}[/]", total=None, start=False
-                    )
-                )
-            mount_task = prog.add_task("[bright_green]Mount result[/]", total=1, start=False)
+        if spec.path is not None:
+            pending.append(Path(spec.path).resolve())
+        else:
+            pending.append(here / (spec.module.replace(".", "/") + ".py"))
+    found: set[Path] = set()
+    while pending:
+        tool = pending.pop()
+        if tool in found or not tool.is_file():
+            continue
+        found.add(tool)
+        pending += [here / f"{name}.py" for name in imported_modules(tool, file_hash(tool))]
+    return sorted(found)
 
-            p = Path(td)
-            rp(f"Building [bold green]{name}[/]")
-            prepare(p, prog, copy_task)
 
-            idx = 0
-            queue = script.targets.copy()
+def tool_hash(actions: Iterable[FileActionType | ProjectActionType]) -> str:
+    # anything that changes what the actions do invalidates the manifests of builds that run them
+    digest = hashlib.sha256()
+    for tool in tool_modules(actions):
+        digest.update(file_hash(tool).encode())
+    return digest.hexdigest()
 
-            while 1:
-                if len(queue) == 0:
-                    break
-                leader = queue.pop(0)
-                this_batch = [leader]
-                if leader[0] == "file":
-                    while len(queue) > 0:
-                        mode, _ = next_item = queue[0]
-                        if mode == "file":
-                            this_batch.append(queue.pop(0))
-                        else:
-                            break
-                    paths = []
-                    for path, dirs, files in p.walk(follow_symlinks=True):
-                        paths.extend(map(lambda k: path / k, files))
-                    for x in range(idx, idx + len(this_batch)):
-                        prog.start_task(tasks[x])
-                        prog.update(tasks[x], total=len(paths))
-                    for path in paths:
-                        for i, (_, process) in enumerate(this_batch):
-                            attach = FileAttachments(script, p)
-                            process = cast(FileActionType, process)
-                            if not (path.exists() and path.is_file()):
-                                prog.advance(tasks[idx + i])
-                                continue
-                            with open(path, "rb") as f:
-                                content = f.read()
-                            if path.suffix == ".html":
-                                attach.soup = bs4.BeautifulSoup(content, "html.parser")
-                            process(path, attach)
-                            if attach.soup_modified:
-                                assert attach.soup
-                                with open(path, "w", encoding="utf-8") as f:
-                                    f.write(attach.soup.decode())
-                            prog.advance(tasks[idx + i])
+
+def manifest_entries(staged: list[tuple[Path, Path]], base: Path) -> dict[str, dict]:
+    entries = {}
+    for source, target in staged:
+        entry: dict = {"source": source.as_posix(), "hash": file_hash(source)}
+        if target.suffix == ".html" and source.is_relative_to(TEMPLATE_DIR):
+            deps = template_deps(source.relative_to(TEMPLATE_DIR).as_posix())
+            if deps:
+                entry["deps"] = deps
+        entries[target.relative_to(base).as_posix()] = entry
+    return entries
+
+
+def load_manifest(name: str) -> dict | None:
+    try:
+        with open(MANIFEST_DIR / f"{name}.json", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(name: str, manifest: dict):
+    MANIFEST_DIR.mkdir(parents=True, exist_ok=True)
+    with open(MANIFEST_DIR / f"{name}.json", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def changed_outputs(
+    script: BuildScript, module_out: Path, manifest: dict, previous: dict | None
+) -> set[str] | None:
+    """Staged files that need processing and mounting again, or None if the whole variant does."""
+    if previous is None:
+        return None
+    for key in ("tool", "actions", "exclude", "mount", "output"):
+        if previous.get(key) != manifest[key]:
+            return None
+    old = previous["inputs"]
+    mounted = previous["files"]
+    dirty = {
+        rel
+        for rel, entry in manifest["inputs"].items()
+        if old.get(rel) != entry or (rel in mounted and not (module_out / rel).exists())
+    }
+    for _, action in script.targets:
+        for pattern in getattr(action, "depends_on", ()):
+            if fnmatch.filter(dirty, pattern):
+                return None
+    return dirty
+
+
+class FileActionError(Exception):
+    def __init__(self, path: str, action: str, message: str):
+        super().__init__(path, action, message)
+        self.path = path
+        self.action = action
+        self.message = message
+
+    def __str__(self):
+        return f"{self.action} failed on {self.path}: {self.message}"
+
+
+FileBatch = list[tuple[str, FileActionType | ProjectActionType]]
+
+
+def run_file_batch(
+    script: BuildScript,
+    base: Path,
+    path: Path,
+    batch: FileBatch,
+    index: dict[str, VariantRules] | None = None,
+    links: dict[str, PageLinks | None] | None = None,
+) -> bool:
+    # one document per file goes through every action in the batch and is written once; with index,
+    # the variant rules of the result are recorded while its text is still in memory, with links
+    # what it references (see references.py), for the project actions after the pass
+    attach = FileAttachments(script, base, path)
+    trace = buildtrace.tracer()
+    rel = path.relative_to(base).as_posix()
+    for _, process in batch:
+        process = cast(FileActionType, process)
+        if not (path.exists() and path.is_file()):
+            break
+        with trace.span(script.name, process.__name__, rel):
+            if path.suffix == ".html" and not getattr(process, "raw_text", False):
+                attach.load_soup()
+            try:
+                process(path, attach)
+            except Exception as e:
+                raise FileActionError(rel, process.__name__, f"{type(e).__name__}: {e}") from e
+    if index is not None and path.suffix == ".html" and path.exists():
+        with trace.span(script.name, "index", rel):
+            if (rules := page_rules(attach.load_text())) is not None:
+                index[rel] = rules
+    if links is not None and path.suffix == ".html" and path.exists():
+        from references import page_references
+
+        with trace.span(script.name, "index", rel):
+            links[rel] = page_references(attach.load_text(), rel, script.mount.strip("/"))
+    with trace.span(script.name, "write", rel):
+        return attach.flush()
+
+
+def run_file_chunk(
+    script: BuildScript,
+    base: Path,
+    batch: FileBatch,
+    paths: list[Path],
+    trace: bool = False,
+    indexed: bool = False,
+    linked: bool = False,
+) -> tuple[
+    list[Path], int, list[buildtrace.Span], dict[str, VariantRules], dict[str, PageLinks | None]
+]:
+    # runs in a worker process; only rewritten paths, a count, any spans and the variant rules and
+    # links found go back to the driver
+    previous = buildtrace.install(Tracer()) if trace else None
+    index: dict[str, VariantRules] = {}
+    links: dict[str, PageLinks | None] = {}
+    try:
+        modified = [
+            path
+            for path in paths
+            if run_file_batch(
+                script,
+                base,
+                path,
+                batch,
+                index if indexed else None,
+                links if linked else None,
+            )
+        ]
+        return modified, len(paths), buildtrace.tracer().spans, index, links
+    finally:
+        if previous is not None:
+            buildtrace.install(previous)
+
+
+def run_file_pass(
+    script: BuildScript,
+    base: Path,
+    batch: FileBatch,
+    prog: Progress,
+    tasks: list[TaskID],
+    pool: Executor | None,
+    jobs: int,
+    only: set[Path] | None = None,
+    index: dict[str, VariantRules] | None = None,
+    links: dict[str, PageLinks | None] | None = None,
+) -> list[Path]:
+    paths = []
+    for path, dirs, files in base.walk(follow_symlinks=True):
+        paths.extend(map(lambda k: path / k, files))
+    if only is not None:
+        paths = [path for path in paths if path in only]
+    for task in tasks:
+        prog.start_task(task)
+        prog.update(task, total=len(paths))
+
+    modified = []
+    trace = buildtrace.tracer()
+    if pool is None:
+        for path in paths:
+            if run_file_batch(script, base, path, batch, index, links):
+                modified.append(path)
+            for task in tasks:
+                prog.advance(task)
+        return modified
+
+    from concurrent.futures import as_completed
+
+    chunk = max(1, len(paths) // (jobs * 4))
+    futures = [
+        pool.submit(
+            run_file_chunk,
+            script,
+            base,
+            batch,
+            paths[at : at + chunk],
+            trace.enabled,
+            index is not None,
+            links is not None,
+        )
+        for at in range(0, len(paths), chunk)
+    ]
+    try:
+        for future in as_completed(futures):
+            changed, count, spans, found, linked = future.result()
+            trace.extend(spans)
+            modified.extend(changed)
+            if index is not None:
+                index.update(found)
+            if links is not None:
+                links.update(linked)
+            for task in tasks:
+                prog.advance(task, count)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    return modified
+
+
+def shared_actions(scripts: list[BuildScript]) -> FileBatch:
+    """The variant independent file actions every script starts with."""
+    shared: FileBatch = []
+    for steps in zip(*(script.targets for script in scripts)):
+        mode, action = steps[0]
+        if mode != "file" or not getattr(action, "variant_independent", False):
+            break
+        if any(other.__name__ != action.__name__ for _, other in steps):
+            break
+        shared.append(steps[0])
+    return shared
+
+
+def shared_stage(
+    batch: FileBatch,
+    sources: list[tuple[Path, Path]],
+    prog: Progress,
+    pool: Executor | None = None,
+    jobs: int = 1,
+) -> tuple[dict[Path, Path], dict[str, VariantRules], set[str]]:
+    """
+    Run the actions all variants start with once, into SHARED_STAGE, and return the result for each
+    source they apply to, plus the variant rules of the rendered pages and the site paths they
+    reference. Only sources that changed since the previous build go through them again.
+    """
+    script = BuildScript("shared", batch, "")
+
+    def applies(rel: Path) -> bool:
+        relative = rel.as_posix()
+        return any(getattr(action, "applies", lambda _: True)(relative) for _, action in batch)
+
+    wanted = [(source, SHARED_STAGE / rel) for source, rel in sources if applies(rel)]
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "tool": tool_hash(action for _, action in batch),
+        "actions": action_names(action for _, action in batch),
+        "inputs": manifest_entries(wanted, SHARED_STAGE),
+    }
+    previous = load_manifest("_shared")
+    if previous is None or any(previous.get(key) != manifest[key] for key in ("tool", "actions")):
+        shutil.rmtree(SHARED_STAGE, ignore_errors=True)
+        previous = {"inputs": {}, "rules": {}, "links": {}}
+    old = previous["inputs"]
+
+    dirty = set()
+    with buildtrace.tracer().span("shared", "prepare"):
+        for source, target in wanted:
+            rel = target.relative_to(SHARED_STAGE).as_posix()
+            if old.get(rel) != manifest["inputs"][rel] or not target.exists():
+                target.parent.mkdir(parents=True, exist_ok=True)
+                target.unlink(missing_ok=True)
+                stage_file(source, target)
+                dirty.add(target)
+        for rel in old.keys() - manifest["inputs"].keys():
+            (SHARED_STAGE / rel).unlink(missing_ok=True)
+
+    tasks = [
+        prog.add_task(rf"[italic magenta]shared: {action.__name__}[/]", total=None, start=False)
+        for _, action in batch
+    ]
+    fresh: dict[str, VariantRules] = {}
+    found: dict[str, PageLinks | None] = {}
+    run_file_pass(script, SHARED_STAGE, batch, prog, tasks, pool, jobs, dirty, fresh, found)
+    rp(rf"[green]shared: {', '.join(manifest['actions'])} ran on [bold]{len(dirty)}[/] files[/]")
+    # pages that weren't processed again keep the rules recorded when they were
+    rules = {
+        rel: VariantRules(deny_all, tuple(allow), tuple(deny))
+        for rel, (deny_all, allow, deny) in previous.get("rules", {}).items()
+        if rel in manifest["inputs"] and SHARED_STAGE / rel not in dirty
+    }
+    rules.update(fresh)
+    manifest["rules"] = rules
+    links = {
+        rel: keys
+        for rel, keys in previous.get("links", {}).items()
+        if rel in manifest["inputs"] and SHARED_STAGE / rel not in dirty
+    }
+    for rel, page in found.items():
+        if page is not None:
+            links[rel] = sorted({ref.key[1:] for ref in page.refs})
+    manifest["links"] = links
+    save_manifest("_shared", manifest)
+    return dict(wanted), rules, {key for keys in links.values() for key in keys}
+
+
+def build_variant(
+    script: BuildScript,
+    output: Path,
+    prog: Progress,
+    pool: Executor | None = None,
+    jobs: int = 1,
+    incremental: bool = False,
+    sources: list[tuple[Path, Path]] | None = None,
+    shared: tuple[int, dict[Path, Path], dict[str, VariantRules], set[str]] | None = None,
+):
+    """
+    Stage, process and mount one variant. shared is how many of the script's leading actions already
+    ran in the shared stage, the files they produced, the variant rules of those pages and the site
+    paths they reference.
+    """
+    name = script.name
+    label = f"{name}: " if pool is not None else ""
+    trace = buildtrace.tracer()
+    skip, substitutes, rules, shared_links = shared if shared is not None else (0, None, None, None)
+    actions = script.targets[skip:]
+    copy_task = prog.add_task(f"[bright_blue]{label}Stage build env[/]", total=None)
+    tasks = []
+    for action in actions:
+        tasks.append(
+            prog.add_task(rf"[italic magenta]{label}{action[1].__name__}[/]", total=None, start=False)
+        )
+    mount_task = prog.add_task(f"[bright_green]{label}Mount result[/]", total=1, start=False)
+
+    STAGING_ROOT.mkdir(exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix=f"{name}-", dir=STAGING_ROOT) as td:
+        p = Path(td)
+        rp(f"Building [bold green]{name}[/]")
+        if sources is None:
+            sources = collect_sources()
+        with trace.span(name, "prepare"):
+            staged = prepare(p, sources, prog, copy_task, substitutes)
+        if script.exclude:
+            excluded = [re.compile(pattern) for pattern in script.exclude]
+            kept = []
+            for source_path, target in staged:
+                if any(pattern.search(target.relative_to(p).as_posix()) for pattern in excluded):
+                    target.unlink()
                 else:
-                    prog.start_task(tasks[idx])
-                    attach = Attachments(script, p)
-                    _, process = leader
-                    process = cast(ProjectActionType, process)
+                    kept.append((source_path, target))
+            staged = kept
+        module_out = output / script.mount
+
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "tool": tool_hash(action for _, action in script.targets),
+            "exclude": list(script.exclude),
+            "actions": action_names(action for _, action in script.targets),
+            "mount": script.mount,
+            "output": output.as_posix(),
+            "inputs": manifest_entries(staged, p),
+        }
+        previous = load_manifest(name)
+        changed = changed_outputs(script, module_out, manifest, previous) if incremental else None
+        dirty = None if changed is None else {p / rel for rel in changed}
+        if changed is not None:
+            rp(rf"[green]{name}: [bold]{len(changed)}[/] of {len(staged)} files changed[/]")
+
+        idx = 0
+        queue = actions.copy()
+        modified = 0
+        # a later file pass over a page replaces what an earlier one found
+        links: dict[str, PageLinks | None] | None = None
+
+        while 1:
+            if len(queue) == 0:
+                break
+            leader = queue.pop(0)
+            this_batch = [leader]
+            if leader[0] == "file":
+                while len(queue) > 0:
+                    mode, _ = next_item = queue[0]
+                    if mode == "file":
+                        this_batch.append(queue.pop(0))
+                    else:
+                        break
+                batch_tasks = tasks[idx : idx + len(this_batch)]
+                if links is None:
+                    links = {}
+                modified += len(
+                    run_file_pass(
+                        script, p, this_batch, prog, batch_tasks, pool, jobs, dirty, links=links
+                    )
+                )
+            else:
+                prog.start_task(tasks[idx])
+                attach = Attachments(
+                    script,
+                    p,
+                    dirty=dirty,
+                    output=module_out,
+                    rules=rules,
+                    links=links,
+                    shared_links=shared_links,
+                )
+                _, process = leader
+                process = cast(ProjectActionType, process)
+                with trace.span(name, process.__name__):
                     process(p, attach, prog, tasks[idx])
-                idx += len(this_batch)
-
-            module_out = output / mount
-            if module_out.exists():
-                rp(f"\\[WARNING] clobbering {module_out} - check mount points")
-            module_out.mkdir(parents=True, exist_ok=True)
-            prog.start_task(mount_task)
-            shutil.copytree(p, module_out, dirs_exist_ok=True)
-            prog.advance(mount_task)
+            idx += len(this_batch)
+        rp(rf"[green]{name}: file actions rewrote [bold]{modified}[/] files[/]")
+
+        # files created by actions have no manifest entry and are always mounted; untouched
+        # files keep whatever the previous build decided for them
+        files = manifest["inputs"]
+        produced = {}
+        for path, dirs, names in p.walk():
+            for file in names:
+                rel = (path / file).relative_to(p).as_posix()
+                entry = files.get(rel)
+                if entry is None:
+                    produced[rel] = {"source": None}
+                elif dirty is None or p / rel in dirty:
+                    # processed again, or rewritten by a project action
+                    produced[rel] = entry
+                elif rel in previous["files"]:  # type: ignore[index]
+                    produced[rel] = entry
+        manifest["files"] = produced
+
+        if module_out.exists() and not incremental:
+            rp(f"\\[WARNING] clobbering {module_out} - check mount points")
+        module_out.mkdir(parents=True, exist_ok=True)
+        prog.start_task(mount_task)
+        with trace.span(name, "mount"):
+            if dirty is None:
+                mount_tree(p, module_out)
+            else:
+                fresh = {p / rel for rel, entry in produced.items() if entry["source"] is None}
+                mount_tree(p, module_out, dirty | fresh)
+        if incremental and previous is not None:
+            for rel in previous["files"].keys() - produced.keys():
+                (module_out / rel).unlink(missing_ok=True)
+        save_manifest(name, manifest)
+        prog.advance(mount_task)
+
+
+def report_trace(trace: Tracer, count: int):
+    left, right = "left", "right"
+    console.table(
+        "time by action",
+        [("variant", left), ("action", left), ("spans", right), ("wall", right), ("cpu", right)],
+        (
+            [variant, action, str(spans), f"{wall * 1e3:.1f}ms", f"{cpu * 1e3:.1f}ms"]
+            for variant, action, spans, wall, cpu in trace.totals()[:count]
+        ),
+    )
+    console.table(
+        f"{count} slowest",
+        [
+            ("variant", left),
+            ("action", left),
+            ("file", left),
+            ("wall", right),
+            ("cpu", right),
+            ("read", right),
+            ("written", right),
+            ("parses", right),
+        ],
+        (
+            [
+                span.variant,
+                span.action,
+                span.file or "",
+                f"{span.wall * 1e3:.1f}ms",
+                f"{span.cpu * 1e3:.1f}ms",
+                str(span.read),
+                str(span.written),
+                str(span.parses),
+            ]
+            for span in trace.slowest(count)
+        ),
+    )
+
+
+def full(target: Path):
+    pass
+
+
+def worker_pool(jobs: int) -> Executor:
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # spawn keeps workers independent of the driver's progress/variant threads; they keep as many
+    # parsed pages as this process does
+    return ProcessPoolExecutor(
+        jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=keep_parsed_pages,
+        initargs=(parsed_page_entries,),
+    )
+
+
+def build(
+    selected: list[BuildScript],
+    jobs: int = 1,
+    incremental: bool = False,
+    artifact: Path | None = None,
+    pool: Executor | None = None,
+):
+    """
+    Build the selected variants into deploy/, or into the artifact tar. Raises FileActionError when
+    an action fails. With jobs > 1 file actions run on pool; a long-lived caller passes its own to
+    keep the workers warm between builds, otherwise one is started for the build.
+    """
+    output = Path("deploy") if artifact is None else ARTIFACT_STAGE
+    if not incremental:
+        shutil.rmtree(output, ignore_errors=True)
+    os.makedirs(output, exist_ok=True)
+
+    sources = collect_sources()
+    batch = shared_actions(selected)
+    # variants only meet in the artifact, so each is mounted into a tree of its own there
+    outputs = {
+        script.name: output if artifact is None else output / script.name for script in selected
+    }
+
+    with console.progress() as prog:
+        if jobs <= 1:
+            shared = (len(batch), *shared_stage(batch, sources, prog)) if batch else None
+            for script in selected:
+                build_variant(
+                    script,
+                    outputs[script.name],
+                    prog,
+                    incremental=incremental,
+                    sources=sources,
+                    shared=shared,
+                )
+        else:
+            from concurrent.futures import ThreadPoolExecutor, as_completed
+
+            owned = pool is None
+            workers = worker_pool(jobs) if pool is None else pool
+            try:
+                with ThreadPoolExecutor(len(selected) or 1) as variants:
+                    if batch:
+                        shared = (len(batch), *shared_stage(batch, sources, prog, workers, jobs))
+                    else:
+                        shared = None
+                    running = [
+                        variants.submit(
+                            build_variant,
+                            script,
+                            outputs[script.name],
+                            prog,
+                            workers,
+                            jobs,
+                            incremental,
+                            sources,
+                            shared,
+                        )
+                        for script in selected
+                    ]
+                    for future in as_completed(running):
+                        future.result()
+            finally:
+                if owned:
+                    workers.shutdown()
+
+    trace = buildtrace.tracer()
+    trees = list(dict.fromkeys(outputs.values()))
+    # Pages refuses artifacts with links, so there duplicates are only counted, and the copies
+    # nothing requests are left out
+    shadowed = shadowed_copies(selected, outputs) if artifact is not None else set()
+    if shadowed:
+        rp(rf"[green]{len(shadowed)} unreferenced copies of shared files left out of the tar[/]")
+    with trace.span("deploy", "deduplicate"):
+        count, duplicated = deduplicate(trees, link=artifact is None, skip=shadowed)
+    where = "stored once in deploy" if artifact is None else "repeated in the artifact"
+    rp(rf"[green]{count} duplicate files ({duplicated / 1024:.0f} KiB) {where}[/]")
+    if artifact is not None:
+        with trace.span("artifact", "write"):
+            count = write_artifact(
+                artifact,
+                [outputs[script.name] for script in selected],
+                int(os.environ.get("SOURCE_DATE_EPOCH", 0)),
+                shadowed,
+            )
+        shutil.rmtree(output, ignore_errors=True)
+        rp(rf"[green]Wrote [bold]{count}[/] files to [bold cyan]{artifact}[/][/]")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="penguinencounter.github.io variant builder")
+    parser.add_argument("targets", nargs="*", help="variants to build (default: all)")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="worker processes for file actions; variants also build concurrently when > 1",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="keep the output and only rebuild files whose inputs changed since the last build",
+    )
+    parser.add_argument(
+        "-c", "--config", type=Path, default=Path("alter.yaml"), help="variant/plugin configuration"
+    )
+    parser.add_argument(
+        "--trace", type=Path, help="record per action/file timings and write a Chrome trace here"
+    )
+    parser.add_argument(
+        "--top", type=int, help="print the N slowest actions and files (default 10 with --trace)"
+    )
+    parser.add_argument(
+        "--artifact",
+        type=Path,
+        help="write the site into this tar (a Pages artifact) instead of deploy/; "
+        "mtimes are SOURCE_DATE_EPOCH, or 0",
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="only print errors; output is also plain text whenever stdout isn't a terminal",
+    )
+    args = parser.parse_args()
+    if args.artifact is not None and args.incremental:
+        parser.error("--artifact always builds everything, it can't be combined with -i")
+    console.configure(quiet=args.quiet)
+    if args.trace is not None or args.top is not None:
+        buildtrace.install(Tracer())
+
+    builds = load_builds(args.config)
+    selected = []
+    for script in builds:
+        if args.targets and script.name not in args.targets:
+            rp(f"Skipping [bold yellow]{script.name}[/]")
+            continue
+        selected.append(script)
+    try:
+        build(selected, args.jobs, args.incremental, args.artifact)
+    except FileActionError as e:
+        console.error(f"[bold red]build failed:[/] [italic magenta]{e.action}[/] on [bold]{e.path}[/]")
+        console.error(f"  {e.message}")
+        sys.exit(1)
+
+    trace = buildtrace.tracer()
+    if isinstance(trace, Tracer):
+        if args.trace is not None:
+            trace.chrome_trace(args.trace)
+            rp(rf"[green]Wrote [bold]{len(trace.spans)}[/] spans to [bold cyan]{args.trace}[/][/]")
+        report_trace(trace, 10 if args.top is None else args.top)
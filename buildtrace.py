@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+from contextlib import nullcontext
+from pathlib import Path
+from time import perf_counter, thread_time
+from typing import NamedTuple
+
+
+class Span(NamedTuple):
+    variant: str
+    action: str
+    file: str | None
+    start: float
+    wall: float
+    cpu: float
+    read: int
+    written: int
+    parses: int
+    pid: int
+    tid: int
+
+
+class _Open:
+    __slots__ = ("variant", "action", "file", "start", "cpu", "read", "written", "parses")
+
+    def __init__(self, variant: str, action: str, file: str | None):
+        self.variant = variant
+        self.action = action
+        self.file = file
+        self.read = 0
+        self.written = 0
+        self.parses = 0
+        self.start = perf_counter()
+        self.cpu = thread_time()
+
+
+class _SpanContext:
+    __slots__ = ("tracer", "variant", "action", "file")
+
+    def __init__(self, tracer: Tracer, variant: str, action: str, file: str | None):
+        self.tracer = tracer
+        self.variant = variant
+        self.action = action
+        self.file = file
+
+    def __enter__(self):
+        self.tracer._stack().append(_Open(self.variant, self.action, self.file))
+
+    def __exit__(self, *exc):
+        span = self.tracer._stack().pop()
+        self.tracer.spans.append(
+            Span(
+                span.variant,
+                span.action,
+                span.file,
+                span.start,
+                perf_counter() - span.start,
+                thread_time() - span.cpu,
+                span.read,
+                span.written,
+                span.parses,
+                os.getpid(),
+                threading.get_native_id(),
+            )
+        )
+
+
+class Tracer:
+    """
+    Records a Span per (variant, action, file). Bytes and parses are added to the innermost open span of
+    the calling thread; spans from worker processes are merged in with extend().
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.spans: list[Span] = []
+        self._local = threading.local()
+
+    def _stack(self) -> list[_Open]:
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def span(self, variant: str, action: str, file: str | None = None) -> _SpanContext:
+        return _SpanContext(self, variant, action, file)
+
+    def read(self, count: int):
+        if stack := self._stack():
+            stack[-1].read += count
+
+    def wrote(self, count: int):
+        if stack := self._stack():
+            stack[-1].written += count
+
+    def parsed(self):
+        if stack := self._stack():
+            stack[-1].parses += 1
+
+    def extend(self, spans: list[Span]):
+        self.spans.extend(spans)
+
+    def chrome_trace(self, path: Path):
+        """Write spans in the Trace Event Format (chrome://tracing, ui.perfetto.dev)."""
+        origin = min((span.start for span in self.spans), default=0.0)
+        events = [
+            {
+                "name": span.action if span.file is None else f"{span.action} {span.file}",
+                "cat": span.variant,
+                "ph": "X",
+                "ts": round((span.start - origin) * 1e6, 1),
+                "dur": round(span.wall * 1e6, 1),
+                "pid": span.pid,
+                "tid": span.tid,
+                "args": {
+                    "variant": span.variant,
+                    "action": span.action,
+                    "file": span.file,
+                    "cpu_ms": round(span.cpu * 1e3, 3),
+                    "read": span.read,
+                    "written": span.written,
+                    "parses": span.parses,
+                },
+            }
+            for span in self.spans
+        ]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def slowest(self, count: int) -> list[Span]:
+        return sorted(self.spans, key=lambda span: span.wall, reverse=True)[:count]
+
+    def totals(self) -> list[tuple[str, str, int, float, float]]:
+        """(variant, action, spans, wall, cpu) summed over files, slowest first."""
+        sums: dict[tuple[str, str], list] = {}
+        for span in self.spans:
+            entry = sums.setdefault((span.variant, span.action), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += span.wall
+            entry[2] += span.cpu
+        rows = [(variant, action, *entry) for (variant, action), entry in sums.items()]
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+
+class NullTracer:
+    """Stand-in used when tracing is off; every call is a no-op."""
+
+    enabled = False
+    spans: list[Span] = []
+    _context = nullcontext()
+
+    def span(self, variant: str, action: str, file: str | None = None):
+        return self._context
+
+    def read(self, count: int):
+        pass
+
+    def wrote(self, count: int):
+        pass
+
+    def parsed(self):
+        pass
+
+    def extend(self, spans: list[Span]):
+        pass
+
+
+_active: Tracer | NullTracer = NullTracer()
+
+
+def tracer() -> Tracer | NullTracer:
+    return _active
+
+
+def install(new: Tracer | NullTracer) -> Tracer | NullTracer:
+    """Make new the tracer everything records to; returns the previous one."""
+    global _active
+    previous, _active = _active, new
+    return previous
@@ -0,0 +1,158 @@
+"""
+Output for the build scripts. rich is only imported when writing to a terminal: with --quiet, or when
+stdout is redirected, messages are printed as plain lines with their markup stripped and progress
+bars are replaced by NullProgress.
+"""
+
+from __future__ import annotations
+
+import re
+import sys
+from typing import Any, Iterable
+
+# rich's markup tags; an odd run of backslashes in front escapes the tag
+MARKUP = re.compile(r"(\\*)\[([a-z#/@][^[]*?)]")
+
+_quiet = False
+_plain: bool | None = None
+
+
+def configure(quiet: bool = False, plain: bool | None = None):
+    """
+    quiet drops informational messages (errors are still printed). plain defaults to whether stdout
+    isn't a terminal; quiet implies it.
+    """
+    global _quiet, _plain
+    _quiet = quiet
+    _plain = quiet or (not sys.stdout.isatty() if plain is None else plain)
+
+
+def is_plain() -> bool:
+    if _plain is None:
+        configure(_quiet)
+    return bool(_plain)
+
+
+def strip_markup(text: str) -> str:
+    """The text rich would print for markup, without the styles."""
+    out = []
+    position = 0
+    for match in MARKUP.finditer(text):
+        escapes, tag = match.groups()
+        # like rich, "\[" outside a tag is an escaped bracket too
+        out.append(text[position : match.start()].replace("\\[", "["))
+        out.append("\\" * (len(escapes) // 2))
+        if len(escapes) % 2:
+            out.append(f"[{tag}]")
+        position = match.end()
+    out.append(text[position:].replace("\\[", "["))
+    return "".join(out)
+
+
+def _emit(objects: tuple, file):
+    if is_plain():
+        print(*(strip_markup(o) if isinstance(o, str) else o for o in objects), file=file)
+        return
+    from rich import print as rich_print
+
+    rich_print(*objects, file=file)
+
+
+def rp(*objects: Any):
+    """rich.print, or a plain print of the same message without the markup."""
+    if not _quiet:
+        _emit(objects, sys.stdout)
+
+
+def error(*objects: Any):
+    """Like rp, but to stderr and also in quiet mode."""
+    _emit(objects, sys.stderr)
+
+
+def table(title: str, columns: list[tuple[str, str]], rows: Iterable[list[str]]):
+    """Print rows under (heading, justify) columns; justify is "left" or "right"."""
+    if _quiet:
+        return
+    rows = list(rows)
+    if not is_plain():
+        from rich import print as rich_print
+        from rich.table import Table
+
+        out = Table(title=title, title_justify="left")
+        for heading, justify in columns:
+            out.add_column(heading, justify=justify)  # type: ignore[arg-type]
+        for row in rows:
+            out.add_row(*row)
+        rich_print(out)
+        return
+    widths = [
+        max([len(heading)] + [len(row[i]) for row in rows])
+        for i, (heading, _) in enumerate(columns)
+    ]
+
+    def line(cells: list[str]) -> str:
+        return "  ".join(
+            cell.rjust(width) if justify == "right" else cell.ljust(width)
+            for cell, width, (_, justify) in zip(cells, widths, columns)
+        ).rstrip()
+
+    print(title)
+    print(line([heading for heading, _ in columns]))
+    for row in rows:
+        print(line(row))
+
+
+class NullProgress:
+    """Stands in for rich.progress.Progress when progress isn't shown; tasks are only numbered."""
+
+    def __init__(self):
+        self.tasks = 0
+
+    def __enter__(self) -> NullProgress:
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def add_task(
+        self, description: str, start: bool = True, total: float | None = 100.0, **fields
+    ) -> int:
+        self.tasks += 1
+        return self.tasks
+
+    def start_task(self, task: int):
+        pass
+
+    def update(self, task: int, **fields):
+        pass
+
+    def advance(self, task: int, advance: float = 1):
+        pass
+
+    def stop(self):
+        pass
+
+
+def progress() -> Any:
+    """A progress display for a build: rich's when writing to a terminal, otherwise NullProgress."""
+    if is_plain():
+        return NullProgress()
+    from rich.progress import (
+        BarColumn,
+        MofNCompleteColumn,
+        Progress,
+        TaskProgressColumn,
+        TextColumn,
+        TimeElapsedColumn,
+        TimeRemainingColumn,
+    )
+
+    return Progress(
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        TaskProgressColumn(),
+        MofNCompleteColumn(),
+        TimeElapsedColumn(),
+        TimeRemainingColumn(),
+        refresh_per_second=20,
+    )
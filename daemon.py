@@ -0,0 +1,297 @@
+"""
+Build daemon. It keeps build_variants loaded between builds, so a rebuild doesn't pay for the
+interpreter start and imports, and reuses the compiled templates, content hashes, parsed pages,
+media metadata and (with -j) the worker processes. Every build is incremental: only changed files
+are processed again.
+
+    python daemon.py --serve 8000 --watch   # build, serve deploy/ and rebuild on changes
+    python daemon.py --request [nojs ...]   # ask a running daemon for a build and wait for it
+
+Builds are requested over a localhost socket, one JSON object per line each way. With --serve, pages
+served from deploy/ reload after every successful build (Server-Sent Events, see serve.py). When a
+module the builds run changes, the daemon restarts itself instead of building with stale code.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+from pathlib import Path
+from time import perf_counter, sleep
+from typing import TYPE_CHECKING, Any, Callable, NamedTuple
+
+import build_variants as bv
+import console
+from console import rp
+
+if TYPE_CHECKING:
+    from watchdog.events import FileSystemEvent
+
+    from serve import Reloads
+
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = 8730
+# how long --request keeps trying to reach a daemon that is (re)starting
+CONNECT_TIMEOUT = 30.0
+WATCH_DEBOUNCE = 0.2
+# build output and tool state; changes there never need a build
+WATCH_IGNORED = ("deploy", ".cache", ".staging", ".git", "node_modules", "__pycache__")
+# parsed pages kept between builds, in the daemon and each worker
+PARSED_PAGES = 256
+
+
+class Build(NamedTuple):
+    started: float
+    variants: frozenset[str]
+    result: dict
+
+
+class Builder:
+    """Runs one build at a time; a request waiting on a build that started after it shares it."""
+
+    def __init__(self, config: Path, jobs: int, reloads: Reloads | None = None):
+        self.config = config
+        self.jobs = jobs
+        self.reloads = reloads
+        bv.keep_parsed_pages(PARSED_PAGES)
+        self.pool = bv.worker_pool(jobs) if jobs > 1 else None
+        self.tool = tool_hash(bv.load_builds(config))
+        self.lock = threading.Lock()
+        self.last: Build | None = None
+        self.restarting = threading.Event()
+
+    def build(self, targets: list[str]) -> dict:
+        asked = perf_counter()
+        with self.lock:
+            scripts = bv.load_builds(self.config)
+            if self.restarting.is_set() or tool_hash(scripts) != self.tool:
+                self.restarting.set()
+                return {"ok": False, "restart": True}
+            unknown = sorted(set(targets) - {script.name for script in scripts})
+            if unknown:
+                return {"ok": False, "error": f"no such variant: {', '.join(unknown)}"}
+            selected = [script for script in scripts if not targets or script.name in targets]
+            names = frozenset(script.name for script in selected)
+            last = self.last
+            if last is not None and last.started > asked and names <= last.variants:
+                return last.result
+
+            started = perf_counter()
+            try:
+                bv.build(selected, self.jobs, incremental=True, pool=self.pool)
+            except bv.FileActionError as e:
+                result = {"ok": False, "action": e.action, "path": str(e.path), "error": e.message}
+            except Exception as e:
+                traceback.print_exc()
+                result = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            else:
+                result = {"ok": True, "variants": sorted(names)}
+                if self.reloads is not None:
+                    self.reloads.notify()
+            result["seconds"] = round(perf_counter() - started, 3)
+            self.last = Build(started, names, result)
+            report(result)
+            return result
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def tool_hash(scripts: list[bv.BuildScript]) -> str:
+    # only what the builds run: editing serve.py or benchmark.py doesn't restart the daemon
+    return bv.tool_hash(action for script in scripts for _, action in script.targets)
+
+
+def report(result: dict):
+    if result["ok"]:
+        rp(rf"[green]daemon: built {', '.join(result['variants'])} in {result['seconds']:.2f}s[/]")
+    elif "action" in result:
+        console.error(
+            f"[bold red]build failed:[/] [italic magenta]{result['action']}[/] "
+            f"on [bold]{result['path']}[/]"
+        )
+        console.error(f"  {result['error']}")
+    else:
+        console.error(f"[bold red]build failed:[/] {result['error']}")
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    builder: Builder
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                targets = json.loads(line).get("targets", [])
+            except (json.JSONDecodeError, AttributeError):
+                result = {"ok": False, "error": "requests are JSON objects, one per line"}
+            else:
+                result = self.builder.build(targets)
+            try:
+                self.wfile.write(json.dumps(result).encode() + b"\n")
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            if result.get("restart"):
+                # shutdown() waits for serve_forever, which this thread mustn't block
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+
+
+class DaemonServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+
+class Watcher:
+    """
+    Debounces watched changes into builds. Like packaging.FSHandler, it only has the dispatch() the
+    observer calls, keeping watchdog out of the imports unless --watch is used.
+    """
+
+    EVENT_TYPES = {"created", "deleted", "modified", "moved"}
+
+    def __init__(self, builder: Builder, root: Path, stop: Callable[[], None]):
+        self.builder = builder
+        # stops the daemon's server, which restarts it when the builder asks to
+        self.stop = stop
+        self.ignored = [root.resolve() / name for name in WATCH_IGNORED]
+        self.lock = threading.Lock()
+        self.timer: threading.Timer | None = None
+
+    def watched(self, path: str) -> bool:
+        resolved = Path(path).resolve()
+        return not any(resolved.is_relative_to(ignored) for ignored in self.ignored)
+
+    def dispatch(self, event: FileSystemEvent):
+        if event.event_type not in self.EVENT_TYPES:
+            return
+        paths = [os.fsdecode(event.src_path)]
+        if event.event_type == "moved":
+            paths.append(os.fsdecode(event.dest_path))
+        if not any(self.watched(path) for path in paths):
+            return
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(WATCH_DEBOUNCE, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+        if self.builder.build([]).get("restart"):
+            self.stop()
+
+
+def request(targets: list[str], host: str, port: int) -> dict:
+    """Ask the daemon for a build of targets (all variants when empty) and wait for the result."""
+    deadline = perf_counter() + CONNECT_TIMEOUT
+    while True:
+        try:
+            with socket.create_connection((host, port)) as conn:
+                conn.sendall(json.dumps({"targets": targets}).encode() + b"\n")
+                line = conn.makefile("rb").readline()
+        except (ConnectionRefusedError, ConnectionResetError):
+            line = b""
+        if line:
+            result = json.loads(line)
+            if not result.get("restart"):
+                return result
+        if perf_counter() > deadline:
+            return {"ok": False, "error": f"no build daemon on {host}:{port}"}
+        # the daemon is starting, or restarting with new build modules
+        sleep(0.2)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="penguinencounter.github.io build daemon")
+    parser.add_argument(
+        "targets", nargs="*", help="with --request: variants to build (default: all)"
+    )
+    parser.add_argument("--request", action="store_true", help="ask a running daemon for a build")
+    parser.add_argument("--port", type=int, default=DAEMON_PORT, help="localhost port for requests")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="worker processes, kept running between builds"
+    )
+    parser.add_argument(
+        "-c", "--config", type=Path, default=Path("alter.yaml"), help="variant/plugin configuration"
+    )
+    parser.add_argument(
+        "--serve",
+        type=int,
+        metavar="PORT",
+        help="also serve deploy/ here; pages reload after builds",
+    )
+    parser.add_argument(
+        "--host",
+        default=DAEMON_HOST,
+        help="address for --serve; 0.0.0.0 also serves the local network",
+    )
+    parser.add_argument("-w", "--watch", action="store_true", help="build when sources change")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print errors")
+    args = parser.parse_args()
+    console.configure(quiet=args.quiet)
+
+    if args.request:
+        result = request(args.targets, DAEMON_HOST, args.port)
+        report(result)
+        sys.exit(0 if result["ok"] else 1)
+    if args.targets:
+        parser.error("variants are chosen per request, with --request")
+
+    # bound before the first build, so requests made meanwhile wait for it instead of failing
+    server = DaemonServer((DAEMON_HOST, args.port), RequestHandler)
+    reloads = site = None
+    if args.serve is not None:
+        from serve import Reloads, make_server
+
+        reloads = Reloads()
+    builder = Builder(args.config, args.jobs, reloads)
+    server.RequestHandlerClass = type("Handler", (RequestHandler,), {"builder": builder})
+    builder.build([])
+
+    # stopped like with ctrl-C, so the worker processes are shut down too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    observer: Any = None
+    try:
+        if args.serve is not None:
+            Path("deploy").mkdir(exist_ok=True)
+            root = Path("deploy").resolve()
+            site, _ = make_server(root, args.host, args.serve, args.config, reloads=reloads)
+            threading.Thread(target=site.serve_forever, daemon=True).start()
+            rp(rf"[green]daemon: serving deploy on [bold]http://{args.host}:{args.serve}/[/][/]")
+        if args.watch:
+            from watchdog.observers import Observer
+
+            observer = Observer()
+            observer.schedule(Watcher(builder, Path("."), server.shutdown), ".", recursive=True)
+            observer.start()
+        rp(rf"[green]daemon: waiting for requests on [bold]{DAEMON_HOST}:{args.port}[/][/]")
+        if not builder.restarting.is_set():
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        if site is not None:
+            site.shutdown()
+            site.server_close()
+        # waits for the handlers, so a restart reply is sent before the process is replaced
+        server.server_close()
+        builder.close()
+    if builder.restarting.is_set():
+        rp("[yellow]daemon: build modules changed, restarting[/]")
+        os.execv(sys.executable, [sys.executable, *sys.argv])
+
+
+if __name__ == "__main__":
+    main()
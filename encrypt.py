@@ -0,0 +1,201 @@
+"""
+File action encrypting marked parts of pages for encryptedContentHandler.ts, in the format the
+CyberChef recipe in the README produces. An element with data-encrypt gets its content replaced by
+the AES-256-GCM ciphertext (hex, in data-content), and the page gets a <meta name="encryption-info">
+with the salt, IV, tag and PBKDF2 parameters the browser needs to derive the key again.
+
+    <div id="notes" data-encrypt>...</div>                  password from $ENCRYPTION_KEY
+    <body id="all" data-encrypt="FRIENDS_KEY">...</body>    password from $FRIENDS_KEY
+
+Marked elements need an id, which names their section. A section keeps its salt between builds in
+.cache/encrypt/keys.json, so a process building more than once (the build daemon) derives its key
+(100000 PBKDF2 iterations) only once; keys are kept in memory, never written to disk. The IV is an
+HMAC of the section and its content under the key, so it only repeats for the same plaintext, and
+the same salts give the same page. Reproducible output (the --artifact build in CI) therefore needs
+.cache/encrypt/ kept between builds; without it, every build picks new salts. The build manifests
+hold a PBKDF2 digest of the passwords in use, so changing one encrypts every page again.
+"""
+
+from __future__ import annotations
+
+import base64
+import functools
+import hashlib
+import hmac
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+
+from build_variants import keyed_by, raw_text, variant_independent
+
+if TYPE_CHECKING:
+    from build_variants import FileAttachments
+
+ENCRYPT_ATTRIBUTE = "data-encrypt"
+# (not data-encryption-info-by, which pages encrypted by hand already have)
+MARKED = re.compile(rf"\b{ENCRYPT_ATTRIBUTE}(?![-\w])")
+DEFAULT_PASSWORD_VARIABLE = "ENCRYPTION_KEY"
+KEY_CACHE = Path(".cache") / "encrypt" / "keys.json"
+KEY_CACHE_LOCK = KEY_CACHE.with_name(f"{KEY_CACHE.name}.lock")
+PBKDF2_HASH = "SHA-256"
+PBKDF2_ITERATIONS = 100_000
+KEY_LENGTH = 32
+SALT_LENGTH = 32
+IV_LENGTH = 12
+TAG_LENGTH = 16
+
+# derived keys by (password, salt), kept in memory only, for processes that build more than once
+_keys: dict[tuple[str, bytes], bytes] = {}
+
+
+def derive_key(password: str, salt: bytes) -> bytes:
+    # the same derivation as crypto.subtle.deriveKey in the browser; hashlib releases the GIL
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PBKDF2_ITERATIONS, KEY_LENGTH)
+
+
+def load_key_cache() -> dict:
+    """Salts by section, the password variables pages use, and the salt of password_state()."""
+    try:
+        with open(KEY_CACHE, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache = {}
+    return {
+        "salts": cache.get("salts", {}),
+        "variables": cache.get("variables", []),
+        "state": cache.get("state"),
+    }
+
+
+def update_key_cache(update: Callable[[dict], None]) -> dict:
+    """
+    Apply update to the cache and save it. Worker processes encrypting other pages save theirs at
+    the same time, so the cache is locked from reading it to replacing it.
+    """
+    import fcntl
+
+    KEY_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    with open(KEY_CACHE_LOCK, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = load_key_cache()
+        update(cache)
+        temporary = KEY_CACHE.with_name(f"{KEY_CACHE.name}.{os.getpid()}")
+        with open(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(temporary, KEY_CACHE)
+    return cache
+
+
+@functools.cache
+def password_state() -> str:
+    """
+    A digest of the passwords pages are encrypted with, for the build manifests. It is derived like
+    the keys, with a salt of its own, so it is no faster to test a guess against than a page. The
+    passwords can't change while a process runs, so it's computed once; that also keeps it the same
+    through a build in which pages record new password variables.
+    """
+    cache = load_key_cache()
+    variables = sorted({DEFAULT_PASSWORD_VARIABLE, *cache["variables"]})
+    if not any(os.environ.get(variable) for variable in variables):
+        return ""
+    if cache["state"] is None:
+        cache = update_key_cache(
+            lambda cache: cache.update(state=cache["state"] or b64(os.urandom(SALT_LENGTH)))
+        )
+    passwords = "\0".join(f"{variable}={os.environ.get(variable, '')}" for variable in variables)
+    return derive_key(passwords, base64.b64decode(cache["state"])).hex()
+
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+def derive_iv(key: bytes, section: str, plaintext: bytes) -> bytes:
+    # deterministic, like AES-GCM-SIV: a different section or content gives a different IV
+    message = b"iv\0" + section.encode() + b"\0" + plaintext
+    return hmac.digest(key, message, "sha256")[:IV_LENGTH]
+
+
+@variant_independent
+@keyed_by(password_state)
+@raw_text
+def encrypt(target: Path, att: FileAttachments):
+    if target.suffix != ".html" or not MARKED.search(att.load_text()):
+        return
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    struct = att.load_soup()
+    sections = struct.select(f"[{ENCRYPT_ATTRIBUTE}]")
+    if not sections:
+        return
+    rel = target.relative_to(att.base_path).as_posix()
+    cache = load_key_cache()
+    salts: dict[str, str] = {}
+    variables: set[str] = set()
+    # (element, meta id, password, salt)
+    planned = []
+    for element in sections:
+        variable = element.attrs.pop(ENCRYPT_ATTRIBUTE) or DEFAULT_PASSWORD_VARIABLE
+        password = os.environ.get(variable)
+        if not password:
+            raise RuntimeError(f"set ${variable} to the password for the {ENCRYPT_ATTRIBUTE} parts")
+        if not element.get("id"):
+            # a position would hand a section's salt to another one when sections are added
+            raise RuntimeError(f"<{element.name} {ENCRYPT_ATTRIBUTE}> needs an id to keep its salt")
+        variables.add(variable)
+        info_id = f"{element['id']}-cryptinfo"
+        section = f"{rel}#{info_id}"
+        if section in cache["salts"]:
+            salt = base64.b64decode(cache["salts"][section])
+        else:
+            salt = os.urandom(SALT_LENGTH)
+            salts[section] = b64(salt)
+        planned.append((element, info_id, password, salt))
+
+    missing = {(password, salt) for _, _, password, salt in planned} - _keys.keys()
+    if missing:
+        # pages are spread over the build's worker processes; a page's own parts over threads
+        with ThreadPoolExecutor(min(len(missing), os.cpu_count() or 1)) as pool:
+            _keys.update(zip(missing, pool.map(lambda pair: derive_key(*pair), missing)))
+
+    for element, info_id, password, salt in planned:
+        key = _keys[password, salt]
+        plaintext = element.decode_contents().encode()
+        init = derive_iv(key, info_id, plaintext)
+        sealed = AESGCM(key).encrypt(init, plaintext, None)
+        # the browser reads the tag from the meta and appends it again
+        content, tag = sealed[:-TAG_LENGTH], sealed[-TAG_LENGTH:]
+        element.clear()
+        classes = element.get("class") or []
+        if "encrypted-content" not in classes:
+            element["class"] = [*classes, "encrypted-content"]
+        element["data-encryption-info-by"] = info_id
+        element["data-content"] = content.hex()
+        meta = struct.new_tag(
+            "meta",
+            attrs={
+                "name": "encryption-info",
+                "id": info_id,
+                "data-salt": b64(salt),
+                "data-init": b64(init),
+                "data-hash": PBKDF2_HASH,
+                "data-tag": tag.hex(),
+                "data-iterations": str(PBKDF2_ITERATIONS),
+            },
+        )
+        if struct.head is not None:
+            struct.head.append(meta)
+        else:
+            element.insert_before(meta)
+    att.soup_modified = True
+    # a new variable changes password_state(), so the next build encrypts every page once more
+    if salts or not variables.issubset(cache["variables"]):
+
+        def update(cache: dict):
+            cache["salts"].update(salts)
+            cache["variables"] = sorted(variables.union(cache["variables"]))
+
+        update_key_cache(update)
@@ -0,0 +1,317 @@
+"""
+Project action giving dist/ and static/ assets content-hashed names (dist/index.css becomes
+dist/index.1a2b3c4d5e.css) so they can be served with long-lived immutable cache headers.
+
+Every reference is rewritten in the same pass: href/src/srcset in pages, including the stylesheet
+and script links fix_rel_url leaves alone, and url()/@import in stylesheets. The renames are written
+to asset-manifest.json at the variant's root. Only assets the rendered pages or a stylesheet load
+are renamed; the rest keep their plain name, since they are fetched by a fixed URL (the adblock list
+in static/filters.txt) or linked by name (the font licenses). What the pages load is taken from the
+shared stage, which every variant starts from, so all variants agree on it.
+
+Root-relative URLs that fix_rel_url didn't move under a variant's mount point at the root mount's
+copy of a file. That copy is built from the same sources, so its name is planned from them.
+This module only imports the standard library at the top; serve.py uses FINGERPRINTED.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import posixpath
+import re
+from pathlib import Path
+from typing import Any, Callable
+from urllib.parse import urlsplit
+
+FINGERPRINT_DIRS = ("dist", "static")
+FINGERPRINT_LENGTH = 10
+MANIFEST_NAME = "asset-manifest.json"
+# source maps are found by their plain name, through the comment at the end of their script
+UNHASHED_SUFFIXES = {".map"}
+# a file name with a fingerprint in it; its content never changes
+FINGERPRINTED = re.compile(rf"\.[0-9a-f]{{{FINGERPRINT_LENGTH}}}(?=\.[^./]*$|$)")
+URL_ATTRIBUTES = ("href", "src", "data-img-src")
+SRCSET_ATTRIBUTES = ("srcset", "data-img-srcset")
+CSS_REFERENCE = re.compile(
+    r"""url\(\s*(?:"([^"]*)"|'([^']*)'|([^"'()\s]+))\s*\)|@import\s+(?:"([^"]*)"|'([^']*)')"""
+)
+SRCSET_URL = re.compile(r"^(\s*)(\S+)")
+
+
+def is_asset(rel: str) -> bool:
+    name = posixpath.basename(rel)
+    return (
+        rel.startswith(tuple(f"{directory}/" for directory in FINGERPRINT_DIRS))
+        and posixpath.splitext(name)[1] not in UNHASHED_SUFFIXES
+        # already hashed, e.g. by webpack's [contenthash]
+        and not FINGERPRINTED.search(name)
+    )
+
+
+def unhashed(path: str) -> str:
+    """path with the fingerprint taken out of its file name."""
+    return FINGERPRINTED.sub("", path, count=1)
+
+
+def fingerprinted_name(rel: str, digest: str) -> str:
+    base, suffix = posixpath.splitext(rel)
+    return f"{base}.{digest[:FINGERPRINT_LENGTH]}{suffix}"
+
+
+def asset_key(url: str, base: str, mount: str) -> tuple[str, bool] | None:
+    """
+    The path a local URL points to, resolved against the variant-relative path of the file it's in,
+    and whether that's inside the variant (otherwise it's in the root mount); None for external and
+    fragment-only URLs.
+    """
+    parts = urlsplit(url)
+    if parts.scheme or parts.netloc or not parts.path:
+        return None
+    path = parts.path
+    if not path.startswith("/"):
+        resolved = posixpath.normpath(posixpath.join(posixpath.dirname(base), path))
+        return None if resolved.startswith("../") else (resolved, True)
+    if mount and path.startswith(f"/{mount}/"):
+        return posixpath.normpath(path[len(mount) + 2 :]), True
+    return posixpath.normpath(path.lstrip("/")), not mount
+
+
+def resolve(url: str, base: str, mount: str, own: dict[str, str], shared: dict[str, str]) -> str:
+    """url with the file name swapped for its fingerprinted one, if it points at a renamed asset."""
+    found = asset_key(url, base, mount)
+    if found is None:
+        return url
+    key, inside = found
+    names = own if inside else shared
+    if key not in names:
+        # a page that wasn't processed again links the name an earlier build gave the asset
+        key = unhashed(key)
+        if key not in names:
+            return url
+    path = urlsplit(url).path
+    old, new = posixpath.basename(found[0]), posixpath.basename(names[key])
+    if not path.endswith(old):
+        return url
+    # the query and fragment are kept
+    return url[: len(path) - len(old)] + new + url[len(path) :]
+
+
+def plan(
+    read: Callable[[str], bytes], assets: set[str], mount: str, shared: dict[str, str]
+) -> tuple[dict[str, str], dict[str, bytes], dict[str, set[str]]]:
+    """
+    Fingerprinted paths for assets, the new content of the stylesheets whose references changed and
+    the assets each stylesheet loads. A stylesheet is hashed after its references are rewritten, so
+    a changed font renames it too.
+    """
+    renamed: dict[str, str] = {}
+    rewritten: dict[str, bytes] = {}
+    loads: dict[str, set[str]] = {}
+    # stylesheets being rewritten; an @import cycle leaves the inner reference as it was
+    active: set[str] = set()
+
+    def reference(rel: str) -> Callable[[re.Match], str]:
+        def swap(match: re.Match) -> str:
+            group = next(i for i in range(1, 6) if match.group(i) is not None)
+            found = asset_key(match.group(group), rel, mount)
+            if found is not None and found[1] and found[0] in assets:
+                loads.setdefault(rel, set()).add(found[0])
+                visit(found[0])
+            new = resolve(match.group(group), rel, mount, renamed, shared)
+            start, end = match.start(group) - match.start(), match.end(group) - match.start()
+            return match.group(0)[:start] + new + match.group(0)[end:]
+
+        return swap
+
+    def visit(rel: str):
+        if rel in renamed or rel in active:
+            return
+        data = read(rel)
+        if rel.endswith(".css"):
+            active.add(rel)
+            text = data.decode("utf-8")
+            new = CSS_REFERENCE.sub(reference(rel), text)
+            active.discard(rel)
+            if new != text:
+                data = rewritten[rel] = new.encode("utf-8")
+        renamed[rel] = fingerprinted_name(rel, hashlib.sha256(data).hexdigest())
+
+    for rel in sorted(assets):
+        visit(rel)
+    return renamed, rewritten, loads
+
+
+def loaded_assets(linked: set[str] | None, loads: dict[str, set[str]], mount: str) -> set[str]:
+    """
+    The assets that are renamed, by variant-relative path: those the rendered pages reference
+    inside the variant (linked, site paths recorded by the shared stage) and those stylesheets load.
+    Without a shared stage only the latter are known.
+    """
+    from build_variants import remounted
+
+    loaded = {rel for rels in loads.values() for rel in rels}
+    loaded.update(key for key in linked or () if not mount or remounted(f"/{key}"))
+    return loaded
+
+
+def root_assets(
+    fingerprinted: bool = True, linked: set[str] | None = None
+) -> tuple[dict[str, str], Callable[[str], bytes]]:
+    """
+    The fingerprinted paths the root mount gives the assets, planned from the sources, and a reader
+    for their content there (by their unhashed path). linked is what the rendered pages reference,
+    as for loaded_assets.
+    """
+    from build_variants import collect_sources
+
+    sources = {rel.as_posix(): source for source, rel in collect_sources()}
+    renamed: dict[str, str] = {}
+    rewritten: dict[str, bytes] = {}
+    if fingerprinted:
+        renamed, rewritten, loads = plan(
+            lambda rel: sources[rel].read_bytes(), set(filter(is_asset, sources)), "", {}
+        )
+        loaded = loaded_assets(linked, loads, "")
+        renamed = {rel: name for rel, name in renamed.items() if rel in loaded}
+
+    def read(rel: str) -> bytes:
+        if rel in rewritten:
+            return rewritten[rel]
+        if rel not in sources:
+            raise FileNotFoundError(rel)
+        return sources[rel].read_bytes()
+
+    return renamed, read
+
+
+def fingerprint(target: Path, att: Any, progr: Any = None, task: Any = None):
+    import buildtrace
+    from build_variants import open_for_write
+    from console import rp
+    from htmlrewrite import HTMLRewriter
+    from references import affected_pages, load_graph
+
+    trace = buildtrace.tracer()
+    mount = att.build_script.mount.strip("/")
+    assets: set[str] = set()
+    pages: list[Path] = []
+    for base, dirs, files in target.walk():
+        for file in files:
+            rel = (base / file).relative_to(target).as_posix()
+            if file.endswith(".html"):
+                pages.append(base / file)
+            elif is_asset(rel):
+                assets.add(rel)
+    if progr is not None and task is not None:
+        progr.update(task, total=len(pages) + 1)
+
+    def read_staged(rel: str) -> bytes:
+        with open(att.final(target / rel), "rb") as f:
+            data = f.read()
+        trace.read(len(data))
+        return data
+
+    shared, _ = root_assets(linked=att.shared_links) if mount else ({}, None)
+    renamed, rewritten, loads = plan(read_staged, assets, mount, shared)
+    loaded = loaded_assets(att.shared_links, loads, mount)
+    renamed = {rel: name for rel, name in renamed.items() if rel in loaded}
+    # assets renamed now and not in the last build, or the other way round
+    switched: set[str] = set()
+    if att.dirty is not None and (previous := att.final(target / MANIFEST_NAME)).exists():
+        with open(previous, encoding="utf-8") as f:
+            switched = json.load(f).keys() ^ renamed.keys()
+
+    # pages the file pass processed are only rewritten if they link a renamed asset; every variant
+    # stages the same dist/ and static/, so a page that wasn't processed again only links a name
+    # that changed if it loads one of the changed assets
+    links = att.links if att.links is not None else {}
+    rewrite: set[Path] = set()
+    unknown: dict[str, Path] = {}
+    for page in pages:
+        rel = page.relative_to(target).as_posix()
+        if (known := links.get(rel)) is not None:
+            if known.hinted or any(
+                resolve(ref.url, "", mount, renamed, shared) != ref.url for ref in known.refs
+            ):
+                rewrite.add(page)
+        elif att.dirty is None or page in att.dirty or rel in links:
+            rewrite.add(page)
+        else:
+            unknown[rel] = page
+    if unknown:
+        changed = {
+            rel for path in att.dirty if is_asset(rel := path.relative_to(target).as_posix())
+        }
+        changed |= switched
+        if changed:
+            for rel in affected_pages(att.build_script.name, mount, changed, unknown):
+                rewrite.add(unknown.pop(rel))
+
+    # the rest are left alone if they are in the last build's reference graph, and rewritten
+    # (unchanged) when it has none
+    graph = load_graph(att.build_script.name) if unknown else None
+    for rel, page in unknown.items():
+        if graph is None or rel not in graph["pages"]:
+            rewrite.add(page)
+
+    def page_reference(rel: str) -> Callable[[Any], None]:
+        def swapped(url: str) -> str:
+            return resolve(url, rel, mount, renamed, shared)
+
+        def swap(element):
+            for attr in URL_ATTRIBUTES:
+                if (value := element.get_attribute(attr)) is not None:
+                    if (new := swapped(value)) != value:
+                        element.set_attribute(attr, new)
+            for attr in SRCSET_ATTRIBUTES:
+                if (value := element.get_attribute(attr)) is not None:
+                    new = ",".join(
+                        SRCSET_URL.sub(lambda m: m.group(1) + swapped(m.group(2)), candidate, 1)
+                        for candidate in value.split(",")
+                    )
+                    if new != value:
+                        element.set_attribute(attr, new)
+
+        return swap
+
+    selectors = ", ".join(f"[{attr}]" for attr in URL_ATTRIBUTES + SRCSET_ATTRIBUTES)
+    written = 0
+    for page in pages:
+        if page in rewrite:
+            rel = page.relative_to(target).as_posix()
+            with open(att.final(page), encoding="utf-8") as f:
+                text = f.read()
+            trace.read(len(text))
+            new = HTMLRewriter().on(selectors, page_reference(rel)).transform(text)
+            if new != text:
+                with open_for_write(page, "w", encoding="utf-8") as f:
+                    f.write(new)
+                trace.wrote(len(new))
+                # in incremental builds the page may not have been processed again
+                att.touched(page)
+                written += 1
+        if progr is not None and task is not None:
+            progr.advance(task, 1)
+
+    for rel, data in rewritten.items():
+        with open_for_write(target / rel, "wb") as f:
+            f.write(data)
+        trace.wrote(len(data))
+        if rel not in renamed:
+            att.touched(target / rel)
+    # the last build didn't mount these under their plain name
+    for rel in switched - renamed.keys():
+        att.touched(target / rel)
+    for rel, hashed in renamed.items():
+        (target / rel).rename(target / hashed)
+    if progr is not None and task is not None:
+        progr.advance(task, 1)
+
+    with open(target / MANIFEST_NAME, "w", encoding="utf-8") as f:
+        json.dump(renamed, f, indent=1, sort_keys=True)
+    kept = len(assets) - len(renamed)
+    rp(
+        rf"[green]fingerprint: [bold]{len(renamed)}[/] assets renamed ([bold]{kept}[/] nothing "
+        rf"loads keep their plain names), [bold]{written}[/] pages rewritten[/]"
+    )
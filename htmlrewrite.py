@@ -0,0 +1,307 @@
+from __future__ import annotations
+
+import html
+import re
+from typing import Callable, Iterator
+
+VOID_ELEMENTS = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "source",
+    "track",
+    "wbr",
+}
+RAW_TEXT_ELEMENTS = {"script", "style", "textarea", "title", "xmp", "iframe", "noembed", "noframes"}
+# elements whose end tag may be implied; their extent can't be found by matching tags alone
+OPTIONAL_END_ELEMENTS = {
+    "p",
+    "li",
+    "dt",
+    "dd",
+    "option",
+    "optgroup",
+    "tr",
+    "td",
+    "th",
+    "thead",
+    "tbody",
+    "tfoot",
+    "rb",
+    "rt",
+    "rtc",
+    "rp",
+    "colgroup",
+    "caption",
+    "html",
+    "head",
+    "body",
+}
+# ...but these only occur once, so their end tag is unambiguous when it is written out
+SINGLETON_ELEMENTS = {"html", "head", "body"}
+
+TOKEN = re.compile(
+    r"""
+    (?P<comment><!--.*?(?:-->|\Z))
+    | (?P<decl><![^>]*>?)
+    | (?P<pi><\?[^>]*>?)
+    | (?P<end></(?P<end_name>[a-zA-Z][^\t\n\f\r />]*)[^>]*>)
+    | (?P<start><(?P<name>[a-zA-Z][^\t\n\f\r />]*)
+        (?P<attrs>(?:[\t\n\f\r /]*[^\t\n\f\r />"'=][^\t\n\f\r />"'=]*
+            (?:[\t\n\f\r ]*=[\t\n\f\r ]*(?:"[^"]*"|'[^']*'|[^\t\n\f\r >]+))?)*)
+        [\t\n\f\r ]*(?P<closing>/?)>)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+ATTRIBUTE = re.compile(
+    # name, then an optional value: double-quoted, single-quoted or unquoted
+    r"""([^\t\n\f\r />"'=][^\t\n\f\r />"'=]*)"""
+    r"""(?:[\t\n\f\r ]*=[\t\n\f\r ]*("[^"]*"|'[^']*'|[^\t\n\f\r >]+))?"""
+)
+TAG_END = re.compile(r">|\Z")
+RAW_TEXT_END = {
+    name: re.compile(rf"</{name}(?=[\t\n\f\r />])", re.IGNORECASE) for name in RAW_TEXT_ELEMENTS
+}
+SELECTOR_PART = re.compile(
+    r"""\[\s*([^\s~|^$*=\]]+)\s*(?:([~]?=)\s*(?:"([^"]*)"|'([^']*)'|([^\]\s]+))\s*)?\]"""
+)
+
+Content = str | Callable[[], str]
+
+
+class RewriteUnsupported(Exception):
+    """The document needs a real tree (e.g. an edit on an element with an implied end tag)."""
+
+
+class Selector:
+    def __init__(self, text: str):
+        self.text = text.strip()
+        match = re.match(r"^(\*|[a-zA-Z][a-zA-Z0-9-]*)?", self.text)
+        assert match is not None
+        self.tag = (match.group(1) or "*").lower()
+        rest = self.text[match.end() :]
+        self.attributes: list[tuple[str, str | None, str | None]] = []
+        at = 0
+        while at < len(rest):
+            part = SELECTOR_PART.match(rest, at)
+            if part is None:
+                raise ValueError(f"unsupported selector: {text!r}")
+            name, operator, *values = part.groups()
+            value = next((v for v in values if v is not None), None)
+            self.attributes.append((name.lower(), operator, value))
+            at = part.end()
+        if not self.text:
+            raise ValueError("empty selector")
+
+    def matches(self, element: Element) -> bool:
+        if self.tag != "*" and self.tag != element.tag_name:
+            return False
+        for name, operator, value in self.attributes:
+            actual = element.get_attribute(name)
+            if actual is None:
+                return False
+            if operator == "=" and actual != value:
+                return False
+            if operator == "~=" and value not in actual.split():
+                return False
+        return True
+
+
+def attribute_value(raw: str | None) -> str | None:
+    if raw is None:
+        return None
+    if raw[:1] in ("'", '"'):
+        raw = raw[1:-1]
+    return html.unescape(raw)
+
+
+class Element:
+    def __init__(self, name: str, raw_attributes: str, self_closing: bool, source: str):
+        self.name = name
+        self.tag_name = name.lower()
+        self.self_closing = self_closing
+        self.source = source
+        self.attributes: list[tuple[str, str | None]] = [
+            (m.group(1), attribute_value(m.group(2))) for m in ATTRIBUTE.finditer(raw_attributes)
+        ]
+        self.modified = False
+        self.removed = False
+        self.prepended: list[Content] = []
+        self.appended: list[Content] = []
+
+    @property
+    def void(self) -> bool:
+        return self.tag_name in VOID_ELEMENTS or self.self_closing
+
+    def get_attribute(self, name: str) -> str | None:
+        name = name.lower()
+        for key, value in self.attributes:
+            if key.lower() == name:
+                return "" if value is None else value
+        return None
+
+    def has_attribute(self, name: str) -> bool:
+        return self.get_attribute(name) is not None
+
+    def set_attribute(self, name: str, value: str):
+        for i, (key, _) in enumerate(self.attributes):
+            if key.lower() == name.lower():
+                self.attributes[i] = (key, value)
+                break
+        else:
+            self.attributes.append((name, value))
+        self.modified = True
+
+    def remove_attribute(self, name: str):
+        kept = [(k, v) for k, v in self.attributes if k.lower() != name.lower()]
+        if len(kept) != len(self.attributes):
+            self.attributes = kept
+            self.modified = True
+
+    def remove(self):
+        """Drop the element and everything inside it."""
+        self.removed = True
+
+    def prepend(self, content: Content):
+        """Insert markup right after the start tag."""
+        self.prepended.append(content)
+
+    def append(self, content: Content):
+        """Insert markup right before the end tag; a callable is evaluated when that's reached."""
+        self.appended.append(content)
+
+    def serialize(self) -> str:
+        if not self.modified:
+            return self.source
+        out = ["<", self.name]
+        for key, value in self.attributes:
+            if value is None:
+                out.append(f" {key}")
+            else:
+                out.append(f' {key}="{html.escape(value, quote=True)}"')
+        out.append("/>" if self.self_closing else ">")
+        return "".join(out)
+
+
+def render(contents: list[Content]) -> str:
+    return "".join(content() if callable(content) else content for content in contents)
+
+
+class HTMLRewriter:
+    """
+    Single forward pass over a document, calling handlers on elements matching simple selectors
+    (tag, [attr], [attr="v"], [attr~="v"], comma lists). Bytes of tags nobody touched are passed
+    through as-is.
+    """
+
+    def __init__(self):
+        self.handlers: list[tuple[Selector, Callable[[Element], None]]] = []
+
+    def on(self, selectors: str, handler: Callable[[Element], None]) -> HTMLRewriter:
+        for selector in selectors.split(","):
+            self.handlers.append((Selector(selector), handler))
+        return self
+
+    def transform(self, text: str) -> str:
+        return "".join(self.stream(text))
+
+    def stream(self, text: str) -> Iterator[str]:
+        # open elements with content still to be appended before their end tag, with how many
+        # elements of the same name were open when they started
+        pending: list[tuple[Element, int]] = []
+        open_count: dict[str, int] = {}
+        # name and depth of an element being skipped because it was removed
+        skipping: tuple[str, int] | None = None
+        raw_until: re.Pattern | None = None
+        at = 0
+        while at < len(text):
+            if raw_until is not None:
+                end = raw_until.search(text, at)
+                stop = end.start() if end else len(text)
+                if skipping is None:
+                    yield text[at:stop]
+                at = stop
+                raw_until = None
+                continue
+            lt = text.find("<", at)
+            if lt == -1:
+                if skipping is None:
+                    yield text[at:]
+                break
+            if lt > at:
+                if skipping is None:
+                    yield text[at:lt]
+                at = lt
+            token = TOKEN.match(text, at)
+            if token is None:
+                if skipping is None:
+                    yield "<"
+                at += 1
+                continue
+            source = token.group(0)
+            at = token.end()
+
+            if token.group("start"):
+                element = Element(
+                    token.group("name"), token.group("attrs"), bool(token.group("closing")), source
+                )
+                name = element.tag_name
+                if name in RAW_TEXT_ELEMENTS and not element.self_closing:
+                    raw_until = RAW_TEXT_END[name]
+                if skipping is not None:
+                    if name == skipping[0] and not element.void:
+                        skipping = (name, skipping[1] + 1)
+                    continue
+                for selector, handler in self.handlers:
+                    if not element.removed and selector.matches(element):
+                        handler(element)
+                if not element.void and name in OPTIONAL_END_ELEMENTS:
+                    if element.removed or (element.appended and name not in SINGLETON_ELEMENTS):
+                        raise RewriteUnsupported(f"<{name}> may end implicitly")
+                if element.removed:
+                    if raw_until is not None:
+                        end = raw_until.search(text, at)
+                        if end is None:
+                            raise RewriteUnsupported(f"<{name}> is never closed")
+                        at = TAG_END.search(text, end.end()).end()
+                        raw_until = None
+                    elif not element.void:
+                        skipping = (name, 1)
+                    continue
+                yield element.serialize()
+                if element.prepended:
+                    yield render(element.prepended)
+                if element.void:
+                    continue
+                open_count[name] = open_count.get(name, 0) + 1
+                if element.appended:
+                    pending.append((element, open_count[name]))
+            elif token.group("end"):
+                name = token.group("end_name").lower()
+                if skipping is not None:
+                    if name == skipping[0]:
+                        depth = skipping[1] - 1
+                        skipping = None if depth == 0 else (name, depth)
+                    continue
+                if (
+                    pending
+                    and pending[-1][0].tag_name == name
+                    and pending[-1][1] == open_count.get(name)
+                ):
+                    yield render(pending.pop()[0].appended)
+                if open_count.get(name):
+                    open_count[name] -= 1
+                yield source
+            elif skipping is None:
+                yield source
+        if skipping is not None:
+            raise RewriteUnsupported(f"<{skipping[0]}> is never closed")
+        if pending:
+            raise RewriteUnsupported(f"<{pending[-1][0].tag_name}> is never closed")
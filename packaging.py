@@ -1,56 +1,655 @@
+from __future__ import annotations
+
 import argparse
 import copy
+import fnmatch
 import glob
+import hashlib
+import json
 import os
+import re
 import shutil
-from functools import lru_cache
+import struct
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from io import BytesIO
 from pathlib import Path, PurePosixPath
-from time import sleep
-from typing import Tuple
-
-from bs4 import BeautifulSoup, Tag
-from PIL import Image, UnidentifiedImageError
-from requests import get
-from watchdog.events import FileSystemEvent, FileSystemEventHandler
-from watchdog.observers import Observer
-
-matches = [
-    "dist",
-    "static",
-    "LICENSE",
-    "secret_deploy",
-    *glob.glob("src/*.html"),
-]
-
-
-@lru_cache
-def sizeof_local(path: str) -> Tuple[int, bytes]:
-    if os.path.exists(path):
-        with open(path, "rb") as f:
-            data = f.read()
-            return len(data), data
+from threading import BoundedSemaphore, Lock, Timer
+from time import perf_counter, sleep, time
+from typing import TYPE_CHECKING, Callable, Iterable, NamedTuple, TypeVar
+from urllib.parse import urlsplit
+
+# bs4, PIL, requests and watchdog are imported where they're used: a build without remote images
+# never needs requests, and only --watch needs watchdog
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup, Tag
+    from requests import Session
+    from watchdog.events import FileSystemEvent
+
+PAGE_GLOB = "src/*.html"
+T = TypeVar("T")
+
+
+def collect_matches() -> list[str]:
+    return [
+        "dist",
+        "static",
+        "LICENSE",
+        "secret_deploy",
+        *glob.glob(PAGE_GLOB),
+    ]
+
+
+matches = collect_matches()
+# events arriving within this window are rebuilt together
+WATCH_DEBOUNCE = 0.05
+
+
+CACHE_DIR = Path(".cache")
+REQUEST_HEADERS = {
+    "User-Agent": "GitHubActions: penguinencounter/penguinencounter.github.io - See headers for info.",
+    "X-Request-Reason": "building static site: determining media size",
+}
+REMOTE_TIMEOUT = 0.5
+REMOTE_RETRIES = 2
+REMOTE_BACKOFF = 0.25
+REMOTE_WORKERS = 16
+REMOTE_PER_HOST = 4
+# total wall time for fetching every remote image in a build
+REMOTE_DEADLINE = 15.0
+# dimensions are read from at most this many leading bytes before falling back to a full decode
+HEADER_PROBE_LIMIT = 128 * 1024
+# resized copies offered through srcset; an image gets the widths below its own
+DERIVED_WIDTHS = (480, 960, 1600)
+DERIVED_QUALITY = 80
+# only these are resized: vector images don't need it and resizing would drop GIF animation
+DERIVED_SOURCES = {"JPEG", "PNG", "WEBP"}
+DERIVED_CACHE = CACHE_DIR / "derived"
+# where derivatives are published in the output, and their URL path
+DERIVED_DIR = "derived"
+# downloading a full remote original, unlike probing one, can take a while
+REMOTE_ORIGINAL_TIMEOUT = 30.0
+# total wall time for downloading every remote original in a build
+REMOTE_ORIGINAL_DEADLINE = 60.0
+HEADER_CHUNK = 4096
+# a remote entry revalidated this recently is used without asking again: once per build, while a
+# process running many builds (the build daemon) still revalidates for later ones
+REVALIDATED_FOR = 60.0
+# an entry without an ETag or Last-Modified can't be revalidated, so it's fetched again this long
+# after it was last fetched
+UNVALIDATED_FOR = 24 * 3600.0
+# without a Content-Length, at most this much of a body is read to count its size
+SIZE_READ_LIMIT = 4 * 1024 * 1024
+# data-content-size of an image whose size isn't known
+UNKNOWN_SIZE = -1
+
+
+class MediaInfo(NamedTuple):
+    size: int
+    width: int | None = None
+    height: int | None = None
+    format: str | None = None
+    mode: str | None = None
+
+
+class MediaCache:
+    """
+    Persistent metadata for probed images: remote entries are keyed by URL and revalidated with their
+    ETag/Last-Modified (or fetched again once old, without either), local entries by content hash.
+    Only metadata is kept, never image bytes. The file is read when the first entry is looked up, so
+    importing this module costs nothing.
+    """
+
+    def __init__(self, path: Path, max_entries: int = 2048):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.validated: dict[str, float] = {}
+        self.dirty = False
+        self.loaded = False
+        self.lock = Lock()
+
+    def load(self):
+        # with the lock held
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.entries.update(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def get(self, key: str) -> dict | None:
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                entry["used"] = time()
+                self.dirty = True
+            return entry
+
+    def put(self, key: str, entry: dict):
+        with self.lock:
+            self.load()
+            entry["used"] = time()
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def revalidated(self, key: str):
+        with self.lock:
+            self.validated[key] = time()
+
+    def fresh(self, key: str, entry: dict) -> bool:
+        """Whether the remote entry for key was (re)validated recently enough to use as it is."""
+        if not entry.get("validators"):
+            return time() - entry.get("fetched", 0.0) < UNVALIDATED_FOR
+        with self.lock:
+            return time() - self.validated.get(key, float("-inf")) < REVALIDATED_FOR
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # several build processes may share the cache; replace it whole rather than interleave writes
+            temp = self.path.with_name(f"{self.path.name}.{os.getpid()}")
+            with open(temp, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(temp, self.path)
+            self.dirty = False
+
+
+media_cache = MediaCache(CACHE_DIR / "media.json")
+
+
+PNG_MODES = {0: "L", 2: "RGB", 3: "P", 4: "LA", 6: "RGBA"}
+JPEG_MODES = {1: "L", 3: "RGB", 4: "CMYK"}
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+SVG_TAG = re.compile(rb"<svg\b[^>]*>", re.IGNORECASE)
+SVG_ATTR = re.compile(rb"""\s([a-zA-Z]+)\s*=\s*["']([^"']*)["']""")
+SVG_LENGTH = re.compile(rb"^\s*([0-9.]+)\s*(px)?\s*$")
+
+Dimensions = tuple[int, int, str, str | None]
+
+
+def probe_png(data: bytes) -> Dimensions | None:
+    if len(data) < 26 or data[12:16] != b"IHDR":
+        return None
+    width, height, depth, color = struct.unpack(">IIBB", data[16:26])
+    if color == 3:
+        mode = "P"
+    elif color == 0 and depth == 1:
+        mode = "1"
     else:
-        print(f"[sizeof_local] W: skipping missing image at {path}")
-        return -1, b""
+        mode = PNG_MODES.get(color) if depth == 8 else None
+    return width, height, "PNG", mode
+
+
+def probe_gif(data: bytes) -> Dimensions | None:
+    if len(data) < 10:
+        return None
+    width, height = struct.unpack("<HH", data[6:10])
+    return width, height, "GIF", "P"
+
+
+def probe_jpeg(data: bytes) -> Dimensions | None:
+    at = 2
+    while at + 4 <= len(data):
+        if data[at] != 0xFF:
+            return None
+        marker = data[at + 1]
+        if marker == 0xFF:
+            at += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            at += 2
+            continue
+        (length,) = struct.unpack(">H", data[at + 2 : at + 4])
+        if marker in JPEG_SOF:
+            if at + 10 > len(data):
+                return None
+            height, width, components = struct.unpack(">HHB", data[at + 5 : at + 10])
+            return width, height, "JPEG", JPEG_MODES.get(components)
+        at += 2 + length
+    return None
+
+
+def probe_webp(data: bytes) -> Dimensions | None:
+    if len(data) < 30:
+        return None
+    chunk = data[12:16]
+    if chunk == b"VP8 " and data[23:26] == b"\x9d\x01\x2a":
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF, "WEBP", "RGB"
+    if chunk == b"VP8L" and data[20] == 0x2F:
+        (bits,) = struct.unpack("<I", data[21:25])
+        mode = "RGBA" if bits & (1 << 28) else "RGB"
+        return 1 + (bits & 0x3FFF), 1 + ((bits >> 14) & 0x3FFF), "WEBP", mode
+    if chunk == b"VP8X":
+        width = 1 + int.from_bytes(data[24:27], "little")
+        height = 1 + int.from_bytes(data[27:30], "little")
+        return width, height, "WEBP", "RGBA" if data[20] & 0x10 else "RGB"
+    return None
+
+
+def probe_svg(data: bytes) -> Dimensions | None:
+    tag = SVG_TAG.search(data)
+    if tag is None:
+        return None
+    attrs = {k.lower(): v for k, v in SVG_ATTR.findall(tag.group(0))}
+    width = SVG_LENGTH.match(attrs.get(b"width", b""))
+    height = SVG_LENGTH.match(attrs.get(b"height", b""))
+    if width and height:
+        return round(float(width.group(1))), round(float(height.group(1))), "SVG", None
+    box = attrs.get(b"viewbox", b"").replace(b",", b" ").split()
+    if len(box) == 4:
+        return round(float(box[2])), round(float(box[3])), "SVG", None
+    return None
+
+
+def probe_header(data: bytes) -> Dimensions | None:
+    """Dimensions, format and (when known) mode from the leading bytes of an image, without decoding it."""
+    try:
+        if data.startswith(b"\x89PNG\r\n\x1a\n"):
+            return probe_png(data)
+        if data.startswith((b"GIF87a", b"GIF89a")):
+            return probe_gif(data)
+        if data.startswith(b"\xff\xd8"):
+            return probe_jpeg(data)
+        if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+            return probe_webp(data)
+        if b"<svg" in data[:HEADER_PROBE_LIMIT].lower():
+            return probe_svg(data)
+    except (struct.error, ValueError, IndexError):
+        pass
+    return None
+
+
+def read_metadata(data: bytes, size: int) -> MediaInfo:
+    # full decode, only for images the header probe can't handle
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with BytesIO(data) as bio:
+            image_data = Image.open(bio)
+            image_data.load()
+            return MediaInfo(
+                size, image_data.width, image_data.height, image_data.format, image_data.mode
+            )
+    except UnidentifiedImageError:
+        return MediaInfo(size)
 
 
-@lru_cache
-def sizeof_remote(url: str) -> Tuple[int, bytes]:
+def entry_info(entry: dict) -> MediaInfo:
+    return MediaInfo(*entry["info"])
+
+
+def sizeof_local(path: str) -> MediaInfo | None:
+    if not os.path.exists(path):
+        print(f"[sizeof_local] W: skipping missing image at {path}")
+        return None
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if (dims := probe_header(f.read(HEADER_PROBE_LIMIT))) is not None:
+            return MediaInfo(size, *dims)
+        f.seek(0)
+        key = "file:" + hashlib.file_digest(f, "sha256").hexdigest()
+        if (entry := media_cache.get(key)) is not None:
+            return entry_info(entry)
+        f.seek(0)
+        info = read_metadata(f.read(), size)
+    media_cache.put(key, {"info": list(info)})
+    return info
+
+
+def content_size(response) -> int | None:
+    if response.status_code == 206:
+        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    if "Content-Encoding" not in response.headers and "Content-Length" in response.headers:
+        return int(response.headers["Content-Length"])
+    return None
+
+
+def sizeof_remote(url: str, session: Session | None = None) -> MediaInfo | None:
+    from requests import RequestException, get
+
+    key = "url:" + url
+    entry = media_cache.get(key)
+    if entry is not None and media_cache.fresh(key, entry):
+        return entry_info(entry)
+    headers = dict(REQUEST_HEADERS)
+    if entry is not None:
+        validators = entry.get("validators", {})
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "last-modified" in validators:
+            headers["If-Modified-Since"] = validators["last-modified"]
+    request = session.get if session is not None else get
     print(f"[sizeof_remote] I: requesting {url[:64]}...")
-    response = get(
-        url,
-        timeout=0.5,
-        headers={
-            "User-Agent": "GitHubActions: penguinencounter/penguinencounter.github.io - See headers for info.",
-            "X-Request-Reason": "building static site: determining media size",
-        },
+    try:
+        response = request(
+            url,
+            timeout=REMOTE_TIMEOUT,
+            headers=headers | {"Range": f"bytes=0-{HEADER_PROBE_LIMIT - 1}"},
+            stream=True,
+        )
+        with response:
+            media_cache.revalidated(key)
+            if response.status_code == 304 and entry is not None:
+                return entry_info(entry)
+            if response.status_code not in (200, 206):
+                print(f"[sizeof_remote] W: request failed, status {response.status_code}")
+                return None
+            # only the header is read; the connection is dropped once the dimensions are known
+            size = content_size(response)
+            header = b""
+            dims = None
+            chunks = response.iter_content(HEADER_CHUNK)
+            for chunk in chunks:
+                header += chunk
+                if (dims := probe_header(header)) is not None or len(header) >= HEADER_PROBE_LIMIT:
+                    break
+            if dims is not None and size is None and response.status_code == 200:
+                # counted up to SIZE_READ_LIMIT; a larger body is left unread and its size unknown
+                size = len(header)
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > SIZE_READ_LIMIT:
+                        size = UNKNOWN_SIZE
+                        break
+            if dims is not None and size is not None:
+                info = MediaInfo(size, *dims)
+            elif response.status_code == 200:
+                body = header + b"".join(chunks)
+                info = read_metadata(body, len(body))
+            else:
+                print(f"[sizeof_remote] I: header probe failed, fetching all of {url[:64]}...")
+                body = request(url, timeout=REMOTE_TIMEOUT, headers=REQUEST_HEADERS).content
+                info = read_metadata(body, len(body))
+            validators = {}
+            if "ETag" in response.headers:
+                validators["etag"] = response.headers["ETag"]
+            if "Last-Modified" in response.headers:
+                validators["last-modified"] = response.headers["Last-Modified"]
+    except RequestException as e:
+        if entry is not None:
+            print(f"[sizeof_remote] W: revalidation failed, using cached metadata ({e})")
+            return entry_info(entry)
+        print(f"[sizeof_remote] W: request failed: {e}")
+        return None
+    media_cache.put(key, {"info": list(info), "validators": validators, "fetched": time()})
+    return info
+
+
+def remote_session() -> Session:
+    from requests import Session
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = Session()
+    retry = Retry(
+        total=REMOTE_RETRIES,
+        backoff_factor=REMOTE_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD"),
+        raise_on_status=False,
     )
-    if response.status_code != 200:
-        print(f"[sizeof_remote] W: request failed, status {response.status_code}")
-        return -1, b""
-    cont = response.content
-    return len(cont), cont
+    adapter = HTTPAdapter(
+        pool_connections=REMOTE_WORKERS, pool_maxsize=REMOTE_PER_HOST, max_retries=retry
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def remote_sources(soup: BeautifulSoup) -> set[str]:
+    urls = set()
+    for image in soup.find_all("img"):
+        routing = image.get("src")
+        if isinstance(routing, str) and routing.startswith(("http://", "https://")):
+            urls.add(routing)
+    return urls
+
+
+def fetch_pooled(
+    urls: Iterable[str],
+    fetch: Callable[[str, Session], T],
+    late: Callable[[str], T],
+    deadline: float = REMOTE_DEADLINE,
+) -> dict[str, T]:
+    """
+    fetch every URL at once on a shared session, bounded per host and by deadline overall. URLs still
+    being fetched at the deadline get late(url) instead.
+    """
+    urls = sorted(set(urls))
+    if not urls:
+        return {}
+    hosts = {urlsplit(url).netloc: BoundedSemaphore(REMOTE_PER_HOST) for url in urls}
+    session = remote_session()
+
+    def bounded(url: str) -> T:
+        with hosts[urlsplit(url).netloc]:
+            return fetch(url, session)
+
+    pool = ThreadPoolExecutor(min(REMOTE_WORKERS, len(urls)))
+    futures = {pool.submit(bounded, url): url for url in urls}
+    done, pending = wait(futures, timeout=deadline)
+    results = {futures[future]: future.result() for future in done}
+    for future in pending:
+        url = futures[future]
+        print(f"[fetch_pooled] W: deadline passed before {url[:64]} finished")
+        results[url] = late(url)
+    pool.shutdown(wait=False, cancel_futures=True)
+    if not pending:
+        session.close()
+    return results
+
+
+def fetch_remote_media(urls: Iterable[str]) -> dict[str, MediaInfo | None]:
+    """Probe every remote image at once; an image probed too late keeps its cached metadata."""
+
+    def cached(url: str) -> MediaInfo | None:
+        entry = media_cache.get("url:" + url)
+        return entry_info(entry) if entry is not None else None
+
+    return fetch_pooled(urls, sizeof_remote, cached)
+
+
+def derived_format() -> tuple[str, str]:
+    """Pillow format and file suffix of derivatives: WebP, or JPEG if Pillow lacks WebP support."""
+    from PIL import features
+
+    return ("WEBP", "webp") if features.check("webp") else ("JPEG", "jpg")
+
+
+def derived_entry(digest: str, width: int) -> Path:
+    _, suffix = derived_format()
+    return DERIVED_CACHE / digest[:2] / f"{digest}-{width}w-q{DERIVED_QUALITY}.{suffix}"
+
+
+def missing_widths(digest: str, widths: list[int]) -> list[int]:
+    return [width for width in widths if not derived_entry(digest, width).exists()]
+
+
+def derive(source: str, digest: str, widths: list[int]) -> int:
+    """Encode source at every width into the derivative cache. Runs in pool workers."""
+    from PIL import Image, ImageOps
+
+    fmt, _ = derived_format()
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if alpha and fmt == "WEBP" else "RGB")
+        for width in widths:
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.Resampling.LANCZOS)
+            entry = derived_entry(digest, width)
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            partial = entry.with_name(f"{entry.name}.{os.getpid()}")
+            if fmt == "WEBP":
+                resized.save(partial, fmt, quality=DERIVED_QUALITY, method=6)
+            else:
+                resized.save(partial, fmt, quality=DERIVED_QUALITY, optimize=True, progressive=True)
+            os.replace(partial, entry)
+    return len(widths)
+
+
+def remote_original(
+    url: str, widths: list[int], session: Session | None = None
+) -> tuple[str | None, str] | None:
+    """
+    (downloaded file, content hash) of a remote image. Nothing is downloaded when the image was
+    revalidated just now and every derivative of its last known content is cached.
+    """
+    from requests import RequestException, get
+
+    request = session.get if session is not None else get
+    key = "url:" + url
+    entry = media_cache.get(key)
+    if entry is not None and "digest" in entry:
+        if media_cache.fresh(key, entry) and not missing_widths(entry["digest"], widths):
+            return None, entry["digest"]
+    print(f"[remote_original] I: downloading {url[:64]}...")
+    target = DERIVED_CACHE / "originals" / hashlib.sha256(url.encode()).hexdigest()
+    target.parent.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    try:
+        with request(
+            url, timeout=REMOTE_ORIGINAL_TIMEOUT, headers=REQUEST_HEADERS, stream=True
+        ) as r:
+            if r.status_code != 200:
+                print(f"[remote_original] W: request failed, status {r.status_code}")
+                return None
+            with open(target, "wb") as f:
+                for chunk in r.iter_content(1 << 16):
+                    digest.update(chunk)
+                    f.write(chunk)
+    except RequestException as e:
+        print(f"[remote_original] W: request failed: {e}")
+        return None
+    if entry is not None:
+        media_cache.put(key, entry | {"digest": digest.hexdigest()})
+    return str(target), digest.hexdigest()
+
+
+def publish_derivative(entry: Path, target: Path):
+    if target.exists():
+        return
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(entry, target)
+    except OSError:
+        shutil.copyfile(entry, target)
+
+
+def image_key(routing: str, root: Path, relative_root: Path) -> str:
+    """What an <img src> refers to: the URL for remote images, the file path for local ones."""
+    if routing.startswith(("http://", "https://")):
+        return routing
+    route_path = PurePosixPath(routing)
+    if route_path.is_absolute():
+        return str(root.absolute() / route_path.relative_to("/"))
+    return str(relative_root / route_path)
+
+
+def build_derivatives(
+    pages: list[tuple[str, BeautifulSoup]],
+    out_to: str,
+    remote: dict[str, MediaInfo | None] | None = None,
+    root: Path = Path("."),
+) -> dict[str, list[tuple[str, int]]]:
+    """
+    Resize every raster image the pages use to DERIVED_WIDTHS and publish the results in out_to.
+    Returns (URL, width) of each image's derivatives, by image_key. Encoded files are cached by
+    content hash, so unchanged images are never encoded again; new ones go through a process pool.
+    Root-relative image URLs are looked up under root.
+    """
+    # image_key -> whether it's remote
+    images: dict[str, bool] = {}
+    for page, soup in pages:
+        for image in soup.find_all("img"):
+            routing = image.get("src")
+            if not isinstance(routing, str) or routing.startswith("data:"):
+                continue
+            if "srcset" in image.attrs:
+                continue
+            key = image_key(routing, root, Path(page).parent)
+            images.setdefault(key, key == routing)
+    remote = dict(remote or {})
+    remote |= fetch_remote_media(
+        [key for key, is_remote in images.items() if is_remote and key not in remote]
+    )
+
+    # image_key -> (file with the original or None, content hash, width, widths)
+    planned: dict[str, tuple[str | None, str, int, list[int]]] = {}
+    # remote image_key -> (width, widths)
+    downloads: dict[str, tuple[int, list[int]]] = {}
+    for key, is_remote in images.items():
+        info = remote.get(key) if is_remote else sizeof_local(key)
+        if info is None or info.width is None or info.format not in DERIVED_SOURCES:
+            continue
+        widths = [width for width in DERIVED_WIDTHS if width < info.width]
+        if not widths:
+            continue
+        if is_remote:
+            downloads[key] = (info.width, widths)
+            continue
+        with open(key, "rb") as f:
+            planned[key] = (key, hashlib.file_digest(f, "sha256").hexdigest(), info.width, widths)
+    # originals are downloaded together like the probes, so a cold cache costs the slowest
+    # download rather than their sum; one that misses the deadline gets derivatives next build
+    originals = fetch_pooled(
+        downloads,
+        lambda url, session: remote_original(url, downloads[url][1], session),
+        lambda url: None,
+        REMOTE_ORIGINAL_DEADLINE,
+    )
+    for key, original in originals.items():
+        if original is not None:
+            planned[key] = (*original, *downloads[key])
+
+    work = {
+        digest: (source, todo)
+        for source, digest, _, widths in planned.values()
+        if source is not None and (todo := missing_widths(digest, widths))
+    }
+    if len(work) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import get_context
+
+        # spawn: the watcher's timer/observer threads mustn't be forked
+        with ProcessPoolExecutor(
+            min(len(work), os.cpu_count() or 1), mp_context=get_context("spawn")
+        ) as pool:
+            for future in [
+                pool.submit(derive, source, digest, todo) for digest, (source, todo) in work.items()
+            ]:
+                future.result()
+    else:
+        for digest, (source, todo) in work.items():
+            derive(source, digest, todo)
+    for source, _, _, _ in planned.values():
+        if source is not None and Path(source).is_relative_to(DERIVED_CACHE):
+            os.unlink(source)
+    if work:
+        encoded = sum(len(todo) for _, todo in work.values())
+        print(f"[build_derivatives] I: encoded {encoded} images")
+
+    derived: dict[str, list[tuple[str, int]]] = {}
+    for key, (_, digest, _, widths) in planned.items():
+        derived[key] = []
+        for width in widths:
+            entry = derived_entry(digest, width)
+            name = f"{digest[:16]}-{width}w{entry.suffix}"
+            publish_derivative(entry, Path(out_to) / DERIVED_DIR / name)
+            derived[key].append((f"/{DERIVED_DIR}/{name}", width))
+    return derived
 
 
 HTML_IMG_NOCOPY = []
@@ -61,13 +660,45 @@ def match_cssimg(style_rules: str):
     matcher = r"--src\s*:\s*url\s*\(\s*\"?(.*?)\"?(?<!\\)\)\s*;"
 
 
-def process_HTMLs(path: str, out_path: str):
+def load_html(path: str) -> BeautifulSoup:
+    from bs4 import BeautifulSoup
+
     with open(path, "r", encoding="utf-8") as f:
         content = f.read()
-    soup = BeautifulSoup(content, features="html.parser")
+    return BeautifulSoup(content, features="html.parser")
+
+
+def process_HTMLs(
+    path: str,
+    out_path: str,
+    soup: BeautifulSoup | None = None,
+    remote: dict[str, MediaInfo | None] | None = None,
+    derived: dict[str, list[tuple[str, int]]] | None = None,
+):
+    if soup is None:
+        soup = load_html(path)
+    replace_images(soup, Path("."), Path(path).parent, remote, derived)
+    with open(out_path, "w", encoding="utf-8") as f:
+        f.write(str(soup))
+
+
+def replace_images(
+    soup: BeautifulSoup,
+    root: Path,
+    relative_root: Path,
+    remote: dict[str, MediaInfo | None] | None = None,
+    derived: dict[str, list[tuple[str, int]]] | None = None,
+) -> bool:
+    """
+    Turn every <img> into a replaced-image placeholder. Returns whether anything changed. Images
+    with derivatives (from build_derivatives) get a srcset/sizes for the loaded <img>.
+    """
+    if remote is None:
+        remote = {}
+    if derived is None:
+        derived = {}
     media_images = soup.find_all("img")
-    root_is = Path(".").absolute()
-    relative_root = Path(path).parent
+    root_is = root.absolute()
     image: Tag
     for image in media_images:
         routing = image["src"]
@@ -79,17 +710,18 @@ def process_HTMLs(path: str, out_path: str):
             continue
         if routing.startswith("http://"):
             print(f"[ImageProc] W: remote insecure (http:) url may cause mixed content errors")
-            size, data = sizeof_remote(routing)
+            info = remote[routing] if routing in remote else sizeof_remote(routing)
         elif routing.startswith("https://"):
-            size, data = sizeof_remote(routing)
+            info = remote[routing] if routing in remote else sizeof_remote(routing)
         else:
             route_path = PurePosixPath(routing)
             if route_path.is_absolute():
                 route_path = root_is / route_path.relative_to("/")
             else:
                 route_path = relative_root / route_path
-            size, data = sizeof_local(str(route_path))
-            print(f"[ImageProc] D: calculating image size by {route_path}: {size}")
+            info = sizeof_local(str(route_path))
+            print(f"[ImageProc] D: calculating image size by {route_path}: {info and info.size}")
+        size = info.size if info is not None else UNKNOWN_SIZE
 
         for attr in image.attrs.copy():
             if attr in HTML_IMG_NOCOPY:
@@ -100,52 +732,52 @@ def process_HTMLs(path: str, out_path: str):
 
         image["data-replacement-type"] = "img"
 
-        try:
-            # extract more metadata to assist user choices before sending entire file
-            bio = BytesIO(data)
-            image_data = Image.open(bio)
-            image_data.load()
-            xsize = f"{image_data.width}x{image_data.height}"
-            print(
-                f"[ImageProc] I: {routing} is a {xsize} {image_data.format}, {image_data.mode} colors"
-            )
-            image["data-width"] = str(image_data.width)
-            image["data-height"] = str(image_data.height)
-            image["data-format"] = str(image_data.format)
+        if info is not None and info.width is not None and info.height is not None:
+            # metadata to assist user choices before sending entire file
+            xsize = f"{info.width}x{info.height}"
+            print(f"[ImageProc] I: {routing} is a {xsize} {info.format}, {info.mode} colors")
+            image["data-width"] = str(info.width)
+            image["data-height"] = str(info.height)
+            image["data-format"] = str(info.format)
             request_width = image["width"] if "width" in image.attrs else None
             request_height = image["height"] if "height" in image.attrs else None
+            resized = derived.get(image_key(routing, root, relative_root))
+            if resized and isinstance(request_width, (str, type(None))):
+                # the original stays the largest candidate
+                candidates = [f"{url} {width}w" for url, width in resized]
+                image["data-img-srcset"] = ", ".join(candidates + [f"{routing} {info.width}w"])
+                if "data-img-sizes" not in image.attrs:
+                    shown = int(float(request_width)) if request_width is not None else info.width
+                    image["data-img-sizes"] = f"(max-width: {shown}px) 100vw, {shown}px"
             if (isinstance(request_width, str) or request_width is None) and (
                 isinstance(request_height, str) or request_height is None
             ):
                 if "style" not in image.attrs:
                     image["style"] = ""
-                image[
-                    "style"
-                ] += f"--replaced-image-aspect: {image_data.width / image_data.height}; "
+                image["style"] += f"--replaced-image-aspect: {info.width / info.height}; "
                 if request_width is not None and request_height is not None:
                     image["style"] += (
                         f"--replaced-image-width: {request_width}px; "
                         f"--replaced-image-height: {request_height}px;"
                     )
                 elif request_width is not None:
-                    fraction = float(request_width) / image_data.width
+                    fraction = float(request_width) / info.width
                     image["style"] += (
                         f"--replaced-image-width: {int(float(request_width))}px; "
-                        f"--replaced-image-height: {int(float(image_data.height) * fraction)}px;"
+                        f"--replaced-image-height: {int(float(info.height) * fraction)}px;"
                     )
                 elif request_height is not None:
-                    fraction = float(request_height) / image_data.height
+                    fraction = float(request_height) / info.height
                     image["style"] += (
-                        f"--replaced-image-width: {int(float(image_data.width) * fraction)}px; "
+                        f"--replaced-image-width: {int(float(info.width) * fraction)}px; "
                         f"--replaced-image-height: {int(float(request_height))}px;"
                     )
                 else:
                     image["style"] += (
-                        f"--replaced-image-width: {int(float(image_data.width))}px; "
-                        f"--replaced-image-height: {int(float(image_data.height))}px;"
+                        f"--replaced-image-width: {int(float(info.width))}px; "
+                        f"--replaced-image-height: {int(float(info.height))}px;"
                     )
-            bio.close()
-        except UnidentifiedImageError:
+        else:
             print(f"[ImageProc] W: unidentified image at {routing}")
 
         image.name = "span"
@@ -161,8 +793,7 @@ def process_HTMLs(path: str, out_path: str):
             image["class"] = image_classes
 
         image["data-content-size"] = str(size)
-    with open(out_path, "w", encoding="utf-8") as f:
-        f.write(str(soup))
+    return bool(media_images)
 
 
 def do_build(out_to: str):
@@ -171,52 +802,150 @@ def do_build(out_to: str):
         shutil.rmtree(out_to)
     os.makedirs(out_to)
 
-    def process(in_file: str, out_file: str):
-        print(f". Writing {in_file} -> {out_file}")
-        if in_file.endswith(".html"):
-            process_HTMLs(in_file, out_file)
-        else:
-            with open(in_file, "rb") as fI, open(out_file, "wb") as fO:
-                fO.write(fI.read())
-
+    planned: list[tuple[str, str]] = []
     for copy in matches:
         if os.path.isdir(copy):
             for cwd, di, fi in os.walk(copy):
                 os.makedirs(os.path.join(out_to, cwd))
                 for f in fi:
-                    process(os.path.join(cwd, f), os.path.join(out_to, cwd, f))
+                    planned.append((os.path.join(cwd, f), os.path.join(out_to, cwd, f)))
+        else:
+            planned.append((copy, os.path.join(out_to, os.path.split(copy)[1])))
+
+    # phase 1: parse every page and probe all of their remote images together
+    soups = {in_file: load_html(in_file) for in_file, _ in planned if in_file.endswith(".html")}
+    remote = fetch_remote_media(url for soup in soups.values() for url in remote_sources(soup))
+    derived = build_derivatives(list(soups.items()), out_to, remote)
+
+    # phase 2: rewrite from the results
+    for in_file, out_file in planned:
+        print(f". Writing {in_file} -> {out_file}")
+        if in_file in soups:
+            process_HTMLs(in_file, out_file, soups[in_file], remote, derived)
         else:
-            process(copy, os.path.join(out_to, os.path.split(copy)[1]))
+            with open(in_file, "rb") as fI, open(out_file, "wb") as fO:
+                fO.write(fI.read())
+    media_cache.save()
+
+
+def is_within(path: str, parent: str) -> bool:
+    return path == parent or path.startswith(parent + os.sep)
+
+
+def output_for(path: str, out_to: str) -> str | None:
+    """Where do_build puts the file at path, or None if it isn't part of the build."""
+    ap = os.path.abspath(path)
+    for copy in matches:
+        m_ap = os.path.abspath(copy)
+        if os.path.isdir(copy) and is_within(ap, m_ap) and ap != m_ap:
+            return os.path.join(out_to, os.path.relpath(ap))
+        if ap == m_ap:
+            return os.path.join(out_to, os.path.split(copy)[1])
+    return None
+
+
+def rebuild_file(in_file: str, out_to: str):
+    out_file = output_for(in_file, out_to)
+    if out_file is None:
+        return
+    if not os.path.exists(in_file):
+        print(f". Removing {out_file}")
+        if os.path.exists(out_file):
+            os.unlink(out_file)
+        return
+    print(f". Writing {in_file} -> {out_file}")
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    if in_file.endswith(".html"):
+        soup = load_html(in_file)
+        process_HTMLs(in_file, out_file, soup, derived=build_derivatives([(in_file, soup)], out_to))
+    else:
+        shutil.copyfile(in_file, out_file)
 
 
-class FSHandler(FileSystemEventHandler):
+class FSHandler:
+    """
+    Debounces watched changes into rebuilds. It only needs the dispatch() the observer calls, so it
+    doesn't subclass watchdog's FileSystemEventHandler, keeping watchdog out of non-watch imports.
+    """
+
+    # "opened"/"closed" events (newer watchdog) don't change anything
+    EVENT_TYPES = {"created", "deleted", "modified", "moved"}
+
     def __init__(self, build_output: str) -> None:
         self.build_output = build_output
-        super().__init__()
+        self.output_ap = os.path.abspath(build_output)
+        self.lock = Lock()
+        self.build_lock = Lock()
+        self.timer: Timer | None = None
+        self.changed: set[str] = set()
+        self.structural = False
+
+    def watched(self, path: str) -> bool:
+        ap = os.path.abspath(path)
+        if is_within(ap, self.output_ap):
+            return False
+        if fnmatch.fnmatch(os.path.relpath(ap), PAGE_GLOB):
+            return True
+        return any(is_within(ap, os.path.abspath(matcher)) for matcher in matches)
 
     def handle(self, event: FileSystemEvent):
-        ap = os.path.abspath(event.src_path)
-        for matcher in matches:
-            m_ap = os.path.abspath(matcher)
-            if ap.startswith(m_ap):
-                print(f"Re-packaging ({event.src_path} changed)")
+        event_type = event.event_type
+        paths = [os.fsdecode(event.src_path)]
+        if event_type == "moved":
+            paths.append(os.fsdecode(event.dest_path))
+            # editors save atomically by renaming a temporary file over the page: that only
+            # modifies a page the build already knows about
+            known = {os.path.normpath(page) for page in matches}
+            source, destination = (os.path.normpath(os.path.relpath(path)) for path in paths)
+            if not event.is_directory and destination in known and source not in known:
+                event_type = "modified"
+                paths = paths[1:]
+        paths = [path for path in paths if self.watched(path)]
+        if not paths:
+            return
+        with self.lock:
+            if event.is_directory:
+                # a directory's own 'modified' just echoes changes to its files
+                if event_type != "modified":
+                    self.structural = True
+            else:
+                for path in paths:
+                    # pages appearing or disappearing change the set of matches
+                    if event_type != "modified" and fnmatch.fnmatch(
+                        os.path.relpath(path), PAGE_GLOB
+                    ):
+                        self.structural = True
+                    self.changed.add(path)
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = Timer(WATCH_DEBOUNCE, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        global matches
+        with self.lock:
+            changed, structural = self.changed, self.structural
+            self.changed, self.structural = set(), False
+            self.timer = None
+        if not (changed or structural):
+            return
+        with self.build_lock:
+            start = perf_counter()
+            if structural:
+                print("Re-packaging (structure changed)")
+                matches = collect_matches()
                 do_build(self.build_output)
+            else:
+                print(f"Re-packaging {len(changed)} changed file(s)")
+                for path in sorted(changed):
+                    rebuild_file(path, self.build_output)
+                media_cache.save()
+            print(f"Re-packaged in {(perf_counter() - start) * 1000:.0f}ms")
 
-    def on_created(self, event):
-        super().on_created(event)
-        self.handle(event)
-
-    def on_deleted(self, event):
-        super().on_deleted(event)
-        self.handle(event)
-
-    def on_modified(self, event):
-        super().on_modified(event)
-        self.handle(event)
-
-    def on_moved(self, event):
-        super().on_moved(event)
-        self.handle(event)
+    def dispatch(self, event: FileSystemEvent):
+        if event.event_type in self.EVENT_TYPES:
+            self.handle(event)
 
 
 def main():
@@ -226,6 +955,8 @@ def main():
     args = parser.parse_args()
     do_build(args.output)
     if args.watch:
+        from watchdog.observers import Observer
+
         print("Initial build completed, watching for changes")
         obs = Observer()
         obs.schedule(FSHandler(args.output), ".", recursive=True)
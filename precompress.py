@@ -0,0 +1,171 @@
+"""
+Project action writing precompressed .gz (and .br, when the brotli module is installed) siblings
+next to compressible files, so a static server can send them as-is instead of compressing them on
+every request.
+
+Compressed output is kept in .cache/compress keyed by the content hash, so only new content is
+compressed; misses are spread over a process pool. This module only imports the standard library at
+the top so pool workers start quickly.
+"""
+
+from __future__ import annotations
+
+import gzip
+import os
+import tempfile
+from pathlib import Path
+from time import time
+from typing import Any, Callable
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {".html", ".css", ".js", ".mjs", ".map", ".json", ".svg", ".xml", ".txt", ".wasm"}
+# below this a compressed response doesn't save a packet
+MIN_SIZE = 1024
+# keep a compressed copy only if it's at most this fraction of the original
+MAX_RATIO = 0.9
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+CACHE_DIR = Path(".cache") / "compress"
+# entries not used by any build for this long are removed
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+# compressing fewer bytes than this isn't worth starting worker processes
+POOL_THRESHOLD = 4 * 1024 * 1024
+
+
+def encodings() -> dict[str, tuple[str, Callable[[bytes], bytes]]]:
+    """File suffix -> (cache tag naming the settings, encoder)."""
+    found: dict[str, tuple[str, Callable[[bytes], bytes]]] = {
+        "gz": (f"gzip{GZIP_LEVEL}", lambda data: gzip.compress(data, GZIP_LEVEL, mtime=0)),
+    }
+    if brotli is not None:
+        found["br"] = (
+            f"brotli{BROTLI_QUALITY}",
+            lambda data: brotli.compress(data, quality=BROTLI_QUALITY),
+        )
+    return found
+
+
+def cache_entry(digest: str, suffix: str) -> Path:
+    tag, _ = encodings()[suffix]
+    return CACHE_DIR / digest[:2] / f"{digest}.{tag}.{suffix}"
+
+
+def skip_marker(entry: Path) -> Path:
+    # recorded for content that compresses poorly, so it isn't tried again
+    return entry.with_name(entry.name + ".skip")
+
+
+def missing(digest: str) -> list[str]:
+    return [
+        suffix
+        for suffix in encodings()
+        if not (entry := cache_entry(digest, suffix)).exists() and not skip_marker(entry).exists()
+    ]
+
+
+def compress_into_cache(path: str, digest: str, suffixes: list[str]) -> int:
+    """Compress path with every encoding in suffixes into the cache. Runs in pool workers."""
+    with open(path, "rb") as f:
+        data = f.read()
+    written = 0
+    for suffix in suffixes:
+        _, encode = encodings()[suffix]
+        entry = cache_entry(digest, suffix)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        out = encode(data)
+        if len(out) > len(data) * MAX_RATIO:
+            skip_marker(entry).touch()
+            continue
+        with tempfile.NamedTemporaryFile("wb", dir=entry.parent, delete=False) as f:
+            f.write(out)
+        os.replace(f.name, entry)
+        written += 1
+    return written
+
+
+def prune_cache(now: float):
+    for base, dirs, files in CACHE_DIR.walk():
+        for file in files:
+            entry = base / file
+            try:
+                if now - entry.stat().st_mtime > CACHE_MAX_AGE:
+                    entry.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def precompress(target: Path, att: Any, progr: Any = None, task: Any = None):
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    import buildtrace
+    from build_variants import file_hash, stage_file
+    from console import rp
+
+    trace = buildtrace.tracer()
+    # (staged path, where its final content is, content hash, size)
+    candidates: list[tuple[Path, Path, str, int]] = []
+    for base, dirs, files in target.walk():
+        for file in files:
+            path = base / file
+            if path.suffix not in COMPRESSIBLE:
+                continue
+            # in incremental builds, files that weren't processed again are only final in the output
+            content = att.final(path)
+            size = content.stat().st_size
+            if size < MIN_SIZE:
+                continue
+            candidates.append((path, content, file_hash(content), size))
+            trace.read(size)
+    if progr is not None and task is not None:
+        progr.update(task, total=len(candidates))
+
+    work = [
+        (content, digest, size, todo)
+        for _, content, digest, size in candidates
+        if (todo := missing(digest))
+    ]
+    pending = sum(size for _, _, size, _ in work)
+    if len(work) > 1 and pending >= POOL_THRESHOLD:
+        with ProcessPoolExecutor(
+            min(len(work), os.cpu_count() or 1), mp_context=get_context("spawn")
+        ) as pool:
+            for future in [
+                pool.submit(compress_into_cache, str(content), digest, todo)
+                for content, digest, _, todo in work
+            ]:
+                future.result()
+    else:
+        for content, digest, _, todo in work:
+            compress_into_cache(str(content), digest, todo)
+
+    now = time()
+    counts = {suffix: 0 for suffix in encodings()}
+    original = compressed = 0
+    for path, _, digest, size in candidates:
+        for suffix in encodings():
+            entry = cache_entry(digest, suffix)
+            if not entry.exists():
+                continue
+            sibling = path.with_name(f"{path.name}.{suffix}")
+            sibling.unlink(missing_ok=True)
+            stage_file(entry, sibling)
+            os.utime(entry, (now, now))
+            counts[suffix] += 1
+            original += size
+            compressed += entry.stat().st_size
+            trace.wrote(entry.stat().st_size)
+        if progr is not None and task is not None:
+            progr.advance(task, 1)
+    prune_cache(now)
+
+    summary = ", ".join(f"[bold]{count}[/] .{suffix}" for suffix, count in counts.items())
+    saved = (original - compressed) / 1024
+    rp(
+        rf"[green]precompress: {summary} ([bold]{len(work)}[/] compressed, rest cached; "
+        rf"{saved:.0f} KiB saved)[/]"
+    )
@@ -0,0 +1,396 @@
+"""
+Project action building the site's reference graph: the local files every page links and, through
+the stylesheets in dist/, the fonts and images those load. The graph is used to
+
+- add <link rel="preload"> for the fonts a page's stylesheets use (and stylesheets they @import)
+  and <link rel="modulepreload"> for its module scripts, so the browser fetches them before it
+  gets to them;
+- report the files in dist/ and static/ no page loads;
+- tell fingerprint which pages an asset change affects in an incremental build.
+
+A page's references are collected by the variant's file pass while its text is still in memory
+(build_variants.run_file_batch) and reach this action through the attachments; pages the file pass
+didn't process are taken from the last build's graph, which is kept in .cache/references, one file
+per variant. Only pages whose hints change are read and rewritten.
+"""
+
+from __future__ import annotations
+
+import html
+import json
+import posixpath
+import re
+from pathlib import Path
+from typing import Any, Callable, Iterable, NamedTuple
+
+from fingerprint import (
+    CSS_REFERENCE,
+    MANIFEST_NAME,
+    SRCSET_ATTRIBUTES,
+    SRCSET_URL,
+    URL_ATTRIBUTES,
+    asset_key,
+    is_asset,
+    root_assets,
+    unhashed,
+)
+
+GRAPH_DIR = Path(".cache") / "references"
+GRAPH_VERSION = 2
+FONT_TYPES = {".woff2": "font/woff2", ".woff": "font/woff", ".ttf": "font/ttf", ".otf": "font/otf"}
+# marks the hints this action adds, so a page scanned again gets a fresh set
+HINT_ATTRIBUTE = "data-build-hint"
+FONT_FACE = re.compile(r"@font-face\s*{[^}]*}", re.IGNORECASE)
+# italic faces are usually not needed for the first paint
+ITALIC = re.compile(r"font-style\s*:\s*(?:italic|oblique)", re.IGNORECASE)
+UNREFERENCED_SHOWN = 5
+
+
+class Reference(NamedTuple):
+    # style, script, module, media, preload or link from pages; import, font, font-alt or media
+    # from stylesheets (font-alt: fallback formats and italic faces, which aren't preloaded)
+    kind: str
+    # where the file is served without its fingerprint, which names it across builds
+    key: str
+    # where it's served now
+    url: str
+
+
+class PageLinks(NamedTuple):
+    refs: list[Reference]
+    # whether the page has hints added by an earlier build
+    hinted: bool
+
+
+def reference(kind: str, url: str, base: str, mount: str) -> Reference | None:
+    found = asset_key(url, base, mount)
+    if found is None:
+        return None
+    path, inside = found
+    path = "" if path == "." else path
+    served = f"/{mount}/{path}" if inside and mount else f"/{path}"
+    return Reference(kind, unhashed(served), served)
+
+
+def page_kind(element: Any) -> str:
+    rel = (element.get_attribute("rel") or "").lower().split()
+    if element.tag_name == "link":
+        if "stylesheet" in rel:
+            return "style"
+        if "preload" in rel or "modulepreload" in rel:
+            return "preload"
+        return "media" if "icon" in rel else "link"
+    if element.tag_name == "script":
+        return "module" if (element.get_attribute("type") or "").lower() == "module" else "script"
+    if element.tag_name in ("a", "area", "iframe", "form"):
+        return "link"
+    return "media"
+
+
+def page_references(text: str, rel: str, mount: str) -> PageLinks:
+    """The references in a page at rel, in a variant mounted at mount."""
+    from htmlrewrite import HTMLRewriter
+
+    found: list[Reference] = []
+    hinted = []
+
+    def collect(element):
+        if element.has_attribute(HINT_ATTRIBUTE):
+            hinted.append(element)
+            return
+        kind = page_kind(element)
+        urls = [element.get_attribute(attr) for attr in URL_ATTRIBUTES]
+        for attr in SRCSET_ATTRIBUTES:
+            for candidate in (element.get_attribute(attr) or "").split(","):
+                if (match := SRCSET_URL.match(candidate)) is not None:
+                    urls.append(match.group(2))
+        for url in urls:
+            if url is not None and (ref := reference(kind, url, rel, mount)) is not None:
+                found.append(ref)
+
+    selectors = ", ".join(f"[{attr}]" for attr in URL_ATTRIBUTES + SRCSET_ATTRIBUTES)
+    HTMLRewriter().on(selectors, collect).transform(text)
+    return PageLinks(found, bool(hinted))
+
+
+def stylesheet_references(text: str, rel: str, mount: str) -> list[Reference]:
+    faces = [
+        (match.start(), match.end(), bool(ITALIC.search(match.group(0))))
+        for match in FONT_FACE.finditer(text)
+    ]
+    preloaded: set[int] = set()
+    found = []
+    for match in CSS_REFERENCE.finditer(text):
+        url = next(group for group in match.groups() if group is not None)
+        face = next(
+            (i for i, (start, end, _) in enumerate(faces) if start <= match.start() < end), None
+        )
+        if url.split("?")[0].endswith(".css"):
+            kind = "import"
+        elif face is None:
+            kind = "media"
+        elif faces[face][2] or face in preloaded:
+            kind = "font-alt"
+        else:
+            # the first source of a face is the format the browser picks
+            kind = "font"
+            preloaded.add(face)
+        if (ref := reference(kind, url, rel, mount)) is not None:
+            found.append(ref)
+    return found
+
+
+def load_graph(name: str) -> dict | None:
+    try:
+        with open(GRAPH_DIR / f"{name}.json", encoding="utf-8") as f:
+            graph = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return graph if graph.get("version") == GRAPH_VERSION else None
+
+
+def save_graph(name: str, graph: dict):
+    GRAPH_DIR.mkdir(parents=True, exist_ok=True)
+    with open(GRAPH_DIR / f"{name}.json", "w", encoding="utf-8") as f:
+        json.dump({"version": GRAPH_VERSION, **graph}, f, indent=1, sort_keys=True)
+
+
+def affected_pages(name: str, mount: str, changed: set[str], pages: Iterable[str]) -> set[str]:
+    """
+    Of pages (variant-relative paths), those the last build's graph says load one of the changed
+    assets, directly or through a stylesheet, and those it doesn't know; all of them without a graph.
+    """
+    pages = set(pages)
+    graph = load_graph(name)
+    if graph is None:
+        return pages
+    hit = {f"/{rel}" for rel in changed}
+    if mount:
+        hit |= {f"/{mount}/{rel}" for rel in changed}
+    # a stylesheet loading a changed file changes with it
+    grew = True
+    while grew:
+        grew = False
+        for sheet, refs in graph["stylesheets"].items():
+            if sheet not in hit and any(ref[1] in hit for ref in refs):
+                hit.add(sheet)
+                grew = True
+    known = graph["pages"]
+    return {
+        page for page in pages if page not in known or any(ref[1] in hit for ref in known[page])
+    }
+
+
+def hint_markup(page: list[Reference], loads: Callable[[Reference], list[Reference]]) -> str:
+    """The preload hints for a page with the references in page."""
+    authored = {ref.url for ref in page if ref.kind == "preload"}
+    # url -> attributes after the href
+    hints: dict[str, str] = {}
+    for ref in page:
+        if ref.kind == "module":
+            hints.setdefault(ref.url, ' rel="modulepreload"')
+        if ref.kind != "style":
+            continue
+        for loaded in loads(ref):
+            suffix = posixpath.splitext(loaded.key)[1].lower()
+            if loaded.kind == "import":
+                hints.setdefault(loaded.url, ' rel="preload" as="style"')
+            elif loaded.kind == "font" and suffix in FONT_TYPES:
+                hints.setdefault(
+                    loaded.url, f' rel="preload" as="font" type="{FONT_TYPES[suffix]}" crossorigin'
+                )
+    return "".join(
+        f'<link href="{html.escape(url, quote=True)}"{attributes} {HINT_ATTRIBUTE}/>'
+        for url, attributes in hints.items()
+        if url not in authored
+    )
+
+
+def insert_hints(text: str, markup: str) -> tuple[str, bool]:
+    """A page with its earlier hints replaced by markup, and whether it had a <head> to take them."""
+    from htmlrewrite import HTMLRewriter, RewriteUnsupported
+
+    heads = []
+
+    def append(head):
+        heads.append(head)
+        head.append(markup)
+
+    rewriter = HTMLRewriter().on(f"link[{HINT_ATTRIBUTE}]", lambda e: e.remove())
+    try:
+        return rewriter.on("head", append).transform(text), bool(heads)
+    except RewriteUnsupported:
+        pass
+    # e.g. a <head> whose end tag is left out; html.parser nests the <body> in it then
+    import bs4
+
+    soup = bs4.BeautifulSoup(text, "html.parser")
+    for link in soup.select(f"link[{HINT_ATTRIBUTE}]"):
+        link.decompose()
+    if soup.head is None:
+        return soup.decode(), False
+    hints = bs4.BeautifulSoup(markup, "html.parser")
+    if (body := soup.head.find("body", recursive=False)) is not None:
+        body.insert_before(hints)
+    else:
+        soup.head.append(hints)
+    return soup.decode(), True
+
+
+def references(target: Path, att: Any, progr: Any = None, task: Any = None):
+    import buildtrace
+    from build_variants import open_for_write
+    from console import rp
+
+    trace = buildtrace.tracer()
+    name = att.build_script.name
+    mount = att.build_script.mount.strip("/")
+    pages: dict[str, Path] = {}
+    assets: dict[str, str] = {}
+    for base, dirs, files in target.walk():
+        for file in files:
+            rel = (base / file).relative_to(target).as_posix()
+            if file.endswith(".html"):
+                pages[rel] = base / file
+            elif is_asset(unhashed(rel)):
+                served = f"/{mount}/{rel}" if mount else f"/{rel}"
+                assets[unhashed(served)] = served
+    if progr is not None and task is not None:
+        progr.update(task, total=len(pages))
+
+    previous = load_graph(name) if att.dirty is not None else None
+    manifest = target / MANIFEST_NAME
+    renamed: dict[str, str] = {}
+    if manifest.exists():
+        with open(manifest, encoding="utf-8") as f:
+            renamed = json.load(f)
+    root: list[tuple[dict[str, str], Callable[[str], bytes]]] = []
+
+    def root_mount() -> tuple[dict[str, str], Callable[[str], bytes]]:
+        """The root mount's asset names and copies, which this variant doesn't build."""
+        if not root:
+            root.append(root_assets(manifest.exists()))
+        return root[0]
+
+    def current(ref: Reference) -> Reference:
+        """ref with the URL its file is served at now, which changes with its fingerprint."""
+        found = asset_key(ref.key, "", mount)
+        if found is None:
+            return ref
+        path, inside = found
+        names = renamed if inside else root_mount()[0]
+        if path not in names:
+            return ref
+        return ref._replace(
+            url=f"/{mount}/{names[path]}" if inside and mount else f"/{names[path]}"
+        )
+
+    def read(served: str) -> tuple[bytes, str, str]:
+        """A stylesheet's content, its variant-relative path and the mount it's resolved in."""
+        if not mount or served.startswith(f"/{mount}/"):
+            rel = served[len(mount) + 2 :] if mount else served[1:]
+            with open(att.final(target / rel), "rb") as f:
+                return f.read(), rel, mount
+        return root_mount()[1](unhashed(served[1:])), served[1:], ""
+
+    stylesheets: dict[str, list[Reference]] = {}
+
+    def loads(sheet: Reference) -> list[Reference]:
+        """Everything a stylesheet loads, through its @imports too."""
+        found: list[Reference] = []
+        pending, seen = [sheet], {sheet.key}
+        while pending:
+            current = pending.pop()
+            if current.key not in stylesheets:
+                try:
+                    data, rel, resolved_in = read(current.url)
+                except FileNotFoundError:
+                    data, rel, resolved_in = b"", "", mount
+                trace.read(len(data))
+                stylesheets[current.key] = stylesheet_references(
+                    data.decode("utf-8", "replace"), rel, resolved_in
+                )
+            for ref in stylesheets[current.key]:
+                found.append(ref)
+                if ref.kind == "import" and ref.key not in seen:
+                    seen.add(ref.key)
+                    pending.append(ref)
+        return found
+
+    graph: dict[str, list[Reference]] = {}
+    # the hints each page has after this build
+    hints: dict[str, str] = {}
+    scanned = written = 0
+    for rel, page in sorted(pages.items()):
+        text: str | None = None
+        # the hints the page has now; None if they have to be taken out, whatever they are
+        old: str | None
+        known = att.links.get(rel) if att.links is not None else None
+        if att.links is not None:
+            processed = rel in att.links
+        else:
+            processed = att.dirty is None or page in att.dirty
+        if known is not None:
+            refs, old = known.refs, None if known.hinted else ""
+        elif not processed and previous is not None and rel in previous["pages"]:
+            refs = [Reference(*ref) for ref in previous["pages"][rel]]
+            old = previous["hints"].get(rel, "")
+        else:
+            # replaced by a project action, or in a variant without a file pass over its pages
+            with open(att.final(page), encoding="utf-8") as f:
+                text = f.read()
+            trace.read(len(text))
+            refs, had_hints = page_references(text, rel, mount)
+            old = None if had_hints else ""
+            scanned += 1
+        graph[rel] = [current(ref) for ref in refs]
+        markup = hint_markup(graph[rel], loads)
+        if markup != old:
+            if text is None:
+                with open(att.final(page), encoding="utf-8") as f:
+                    text = f.read()
+                trace.read(len(text))
+            new, placed = insert_hints(text, markup)
+            if markup and not placed:
+                rp(rf"[yellow]references: {rel} has no <head> for its preload hints[/]")
+                markup = ""
+            if new != text:
+                with open_for_write(page, "w", encoding="utf-8") as f:
+                    f.write(new)
+                trace.wrote(len(new))
+                att.touched(page)
+                written += 1
+        hints[rel] = markup
+        if progr is not None and task is not None:
+            progr.advance(task, 1)
+
+    # stylesheets loaded by pages that weren't scanned again
+    for refs in graph.values():
+        for ref in refs:
+            if ref.kind == "style":
+                loads(ref)
+    reached = {ref.key for refs in graph.values() for ref in refs}
+    reached |= {ref.key for refs in stylesheets.values() for ref in refs}
+    unreferenced = sorted(served for key, served in assets.items() if key not in reached)
+    save_graph(
+        name,
+        {
+            "pages": {rel: [list(ref) for ref in refs] for rel, refs in graph.items()},
+            "hints": hints,
+            "stylesheets": {key: [list(ref) for ref in refs] for key, refs in stylesheets.items()},
+            "unreferenced": unreferenced,
+        },
+    )
+
+    rp(
+        rf"[green]references: [bold]{scanned}[/] of {len(pages)} pages scanned, "
+        rf"[bold]{sum(map(bool, hints.values()))}[/] with preload hints "
+        rf"([bold]{written}[/] rewritten)[/]"
+    )
+    if unreferenced:
+        shown = ", ".join(unreferenced[:UNREFERENCED_SHOWN])
+        more = len(unreferenced) - UNREFERENCED_SHOWN
+        rp(
+            rf"[yellow]references: [bold]{len(unreferenced)}[/] files in dist/ and static/ aren't "
+            rf"loaded by any {name} page: {shown}{f' and {more} more' if more > 0 else ''}[/]"
+        )
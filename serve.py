@@ -0,0 +1,434 @@
+"""
+Static server for the build output, for staging and load testing.
+
+    python serve.py [--port 8000] [--root deploy] [--host 127.0.0.1]
+
+Threaded, HTTP/1.1 keep-alive. Answers conditional requests (ETag / Last-Modified) with 304, sends
+the .br/.gz siblings written by precompress when the client accepts them, keeps small files in a
+bounded memory cache and sends everything else with sendfile. Not-found pages come from the variant
+mount the request falls under (v/nojs gets v/nojs/404.html). Files with a fingerprinted name are sent
+as immutable; everything else has to be revalidated. Latency percentiles are logged every --stats
+seconds and on exit.
+
+Run by the build daemon (daemon.py --serve), pages also get a script that listens for Server-Sent
+Events on /__reload and reloads the page after every build.
+"""
+
+from __future__ import annotations
+
+import argparse
+import email.utils
+import mimetypes
+import os
+import shutil
+import sys
+import threading
+from collections import OrderedDict, deque
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import perf_counter
+from typing import NamedTuple
+from urllib.parse import unquote, urlsplit
+
+from fingerprint import FINGERPRINTED
+
+# encodings precompress writes, best first
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+# the type of a compressed file asked for by its own name, which is sent as it is
+COMPRESSED_TYPES = {"gzip": "application/gzip", "br": "application/x-brotli"}
+CACHE_FILE_LIMIT = 256 * 1024
+CACHE_TOTAL_LIMIT = 64 * 1024 * 1024
+LATENCY_SAMPLES = 50_000
+SENDFILE_CHUNK = 1 << 24
+# a fingerprinted name changes with the content, so it never needs revalidating
+IMMUTABLE = "public, max-age=31536000, immutable"
+RELOAD_PATH = "/__reload"
+# sent on idle event streams, so proxies and browsers don't time them out
+RELOAD_KEEPALIVE = 15.0
+RELOAD_SCRIPT = (
+    f'<script>new EventSource("{RELOAD_PATH}")'
+    '.addEventListener("reload", () => location.reload())</script>'
+).encode()
+
+
+class Entry(NamedTuple):
+    path: Path
+    size: int
+    mtime_ns: int
+    etag: str
+    encoding: str | None
+
+
+class FileCache:
+    """LRU of small file bodies, bounded by total size; entries are checked against stat on use."""
+
+    def __init__(self, total: int = CACHE_TOTAL_LIMIT, per_file: int = CACHE_FILE_LIMIT):
+        self.total = total
+        self.per_file = per_file
+        self.size = 0
+        self.entries: OrderedDict[Path, tuple[int, bytes]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, entry: Entry) -> bytes | None:
+        if entry.size > self.per_file:
+            return None
+        with self.lock:
+            cached = self.entries.get(entry.path)
+            if cached is not None and cached[0] == entry.mtime_ns and len(cached[1]) == entry.size:
+                self.entries.move_to_end(entry.path)
+                return cached[1]
+        try:
+            with open(entry.path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        with self.lock:
+            old = self.entries.pop(entry.path, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[entry.path] = (entry.mtime_ns, data)
+            self.size += len(data)
+            while self.size > self.total:
+                _, (_, dropped) = self.entries.popitem(last=False)
+                self.size -= len(dropped)
+        return data
+
+
+class Latency:
+    def __init__(self):
+        self.samples: deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def report(self) -> str | None:
+        with self.lock:
+            samples = sorted(self.samples)
+            count = self.count
+            self.samples.clear()
+        if not samples:
+            return None
+
+        def pct(p: float) -> float:
+            return samples[min(len(samples) - 1, int(p * len(samples)))] * 1e3
+
+        return (
+            f"[serve] I: {len(samples)} requests ({count} total) "
+            f"p50 {pct(0.5):.2f}ms p90 {pct(0.9):.2f}ms p99 {pct(0.99):.2f}ms "
+            f"max {samples[-1] * 1e3:.2f}ms"
+        )
+
+
+class Reloads:
+    """Counts finished builds; event streams wait on it to tell browsers to reload."""
+
+    def __init__(self):
+        self.generation = 0
+        self.changed = threading.Condition()
+
+    def notify(self):
+        with self.changed:
+            self.generation += 1
+            self.changed.notify_all()
+
+    def wait(self, seen: int, timeout: float) -> int:
+        """The generation after seen, or seen again if there was no build within timeout."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.generation != seen, timeout)
+            return self.generation
+
+
+def with_reload_script(page: bytes) -> bytes:
+    at = page.rfind(b"</body>")
+    return page + RELOAD_SCRIPT if at < 0 else page[:at] + RELOAD_SCRIPT + page[at:]
+
+
+def accepted(header: str | None) -> set[str]:
+    """Content codings a client accepts (q > 0)."""
+    found = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding and q > 0:
+            found.add(coding.strip().lower())
+    return found
+
+
+def mounts_from_config(config: Path) -> list[str]:
+    try:
+        from alter import load_config
+    except ImportError:
+        return [""]
+    try:
+        variants = load_config(config).variants()
+    except (OSError, ValueError):
+        return [""]
+    return sorted({variant.mount.strip("/") for variant in variants} | {""}, key=len, reverse=True)
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes; with Nagle on, keep-alive clients wait on delayed ACKs
+    disable_nagle_algorithm = True
+    server_version = "penguinencounter-serve"
+    root: Path
+    mounts: list[str]
+    cache: FileCache
+    latency: Latency
+    verbose: bool
+    reloads: Reloads | None = None
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.reloads is not None and urlsplit(self.path).path == RELOAD_PATH:
+            self.stream_reloads(self.reloads)
+            return
+        self.respond(head=False)
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def locate(self, url_path: str) -> Path | None:
+        relative = unquote(url_path).lstrip("/")
+        candidate = (self.root / relative).resolve()
+        if not candidate.is_relative_to(self.root):
+            return None
+        if candidate.is_dir():
+            return candidate / "index.html" if (candidate / "index.html").is_file() else None
+        if candidate.is_file():
+            return candidate
+        # GitHub Pages serves /page from page.html
+        with_html = candidate.with_name(candidate.name + ".html")
+        return with_html if with_html.is_file() else None
+
+    def not_found_page(self, url_path: str) -> Path | None:
+        relative = unquote(url_path).lstrip("/")
+        for mount in self.mounts:
+            if mount == "" or relative == mount or relative.startswith(mount + "/"):
+                page = self.root / mount / "404.html"
+                if page.is_file():
+                    return page
+        return None
+
+    def entry_for(self, path: Path, identity: bool = False) -> Entry:
+        codings = set() if identity else accepted(self.headers.get("Accept-Encoding"))
+        for coding, suffix in ENCODINGS:
+            if coding not in codings:
+                continue
+            sibling = path.with_name(path.name + suffix)
+            try:
+                stat = sibling.stat()
+            except OSError:
+                continue
+            etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}-{suffix[1:]}"'
+            return Entry(sibling, stat.st_size, stat.st_mtime_ns, etag, coding)
+        stat = path.stat()
+        return Entry(
+            path, stat.st_size, stat.st_mtime_ns, f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"', None
+        )
+
+    def not_modified(self, entry: Entry) -> bool:
+        match = self.headers.get("If-None-Match")
+        if match is not None:
+            return match.strip() == "*" or entry.etag in [tag.strip() for tag in match.split(",")]
+        since = self.headers.get("If-Modified-Since")
+        if since is not None:
+            try:
+                when = email.utils.parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return entry.mtime_ns // 1_000_000_000 <= when
+        return False
+
+    def respond(self, head: bool):
+        start = perf_counter()
+        try:
+            url_path = urlsplit(self.path).path
+            if "\0" in unquote(url_path):
+                # no file has one, and the filesystem calls would raise ValueError for it
+                self.send_error(HTTPStatus.BAD_REQUEST, "Null byte in path")
+                return
+            path = self.locate(url_path)
+            status = HTTPStatus.OK
+            if path is None:
+                status = HTTPStatus.NOT_FOUND
+                path = self.not_found_page(url_path)
+                if path is None:
+                    self.send_error(HTTPStatus.NOT_FOUND)
+                    return
+            elif (
+                path.name == "index.html"
+                and not url_path.endswith("/")
+                and path.parent != self.root
+            ):
+                if (self.root / unquote(url_path).lstrip("/")).is_dir():
+                    self.send_response(HTTPStatus.MOVED_PERMANENTLY)
+                    self.send_header("Location", url_path + "/")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+            # pages get the reload script added, so they're sent from the uncompressed file
+            live = self.reloads is not None and path.suffix == ".html"
+            entry = self.entry_for(path, identity=live)
+            if status == HTTPStatus.OK and self.not_modified(entry):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header("ETag", entry.etag)
+                self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                return
+            self.send_response(status)
+            content_type, coding = mimetypes.guess_type(path.name)
+            if coding is not None:
+                content_type = COMPRESSED_TYPES.get(coding)
+            self.send_header("Content-Type", content_type or "application/octet-stream")
+            body = None
+            if live:
+                body = with_reload_script(self.cache.get(entry) or path.read_bytes())
+            self.send_header("Content-Length", str(entry.size if body is None else len(body)))
+            self.send_header("Vary", "Accept-Encoding")
+            if entry.encoding is not None:
+                self.send_header("Content-Encoding", entry.encoding)
+            if status == HTTPStatus.OK:
+                self.send_header("ETag", entry.etag)
+                self.send_header(
+                    "Last-Modified", email.utils.formatdate(entry.mtime_ns / 1e9, usegmt=True)
+                )
+                self.send_header(
+                    "Cache-Control", IMMUTABLE if FINGERPRINTED.search(path.name) else "no-cache"
+                )
+            self.end_headers()
+            if head:
+                return
+            if body is not None:
+                self.wfile.write(body)
+            else:
+                self.send_body(entry)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            self.latency.add(perf_counter() - start)
+
+    def stream_reloads(self, reloads: Reloads):
+        self.close_connection = True
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        seen = reloads.generation
+        try:
+            while True:
+                current = reloads.wait(seen, RELOAD_KEEPALIVE)
+                if current == seen:
+                    self.wfile.write(b": keepalive\n\n")
+                else:
+                    self.wfile.write(f"event: reload\ndata: {current}\n\n".encode())
+                    seen = current
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_body(self, entry: Entry):
+        data = self.cache.get(entry)
+        if data is not None:
+            self.wfile.write(data)
+            return
+        with open(entry.path, "rb") as f:
+            self.wfile.flush()
+            if not hasattr(os, "sendfile"):
+                shutil.copyfileobj(f, self.wfile)
+                return
+            offset = 0
+            while offset < entry.size:
+                sent = os.sendfile(
+                    self.connection.fileno(),
+                    f.fileno(),
+                    offset,
+                    min(SENDFILE_CHUNK, entry.size - offset),
+                )
+                if sent == 0:
+                    break
+                offset += sent
+
+
+def make_server(
+    root: Path,
+    host: str,
+    port: int,
+    config: Path,
+    verbose: bool = False,
+    reloads: Reloads | None = None,
+) -> tuple[ThreadingHTTPServer, Latency]:
+    """A server for root, not yet serving; with reloads, pages reload after every build."""
+    latency = Latency()
+    handler = type(
+        "Handler",
+        (SiteHandler,),
+        {
+            "root": root,
+            "mounts": mounts_from_config(config),
+            "cache": FileCache(),
+            "latency": latency,
+            "verbose": verbose,
+            "reloads": reloads,
+        },
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server, latency
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="penguinencounter.github.io static server")
+    parser.add_argument(
+        "--host", default="127.0.0.1", help="listen address; 0.0.0.0 also serves the local network"
+    )
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--root", type=Path, default=Path("deploy"))
+    parser.add_argument("-c", "--config", type=Path, default=Path("alter.yaml"), help="for mounts")
+    parser.add_argument("--stats", type=float, default=10.0, help="seconds between latency reports")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    root = args.root.resolve()
+    if not root.is_dir():
+        print(f"[serve] E: {root} doesn't exist, build first")
+        sys.exit(1)
+    server, latency = make_server(root, args.host, args.port, args.config, args.verbose)
+    stop = threading.Event()
+
+    def report():
+        while not stop.wait(args.stats):
+            if (line := latency.report()) is not None:
+                print(line, flush=True)
+
+    threading.Thread(target=report, daemon=True).start()
+    mounts = server.RequestHandlerClass.mounts  # type: ignore[attr-defined]
+    print(f"[serve] I: serving {root} on http://{args.host}:{args.port}/ (mounts: {mounts})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        if (line := latency.report()) is not None:
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
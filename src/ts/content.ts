@@ -104,6 +104,18 @@ import "../styles/content.scss"
             console.warn("no c2a element?")
         }
 
+        // resized copies from the build: the browser picks one, the original isn't downloaded
+        if (dataTarget.hasAttribute("srcset")) {
+            dataTarget.src = source
+            dataTarget.decode().then(fin).catch((err) => {
+                console.error(err)
+                if (callto instanceof HTMLElement) {
+                    callto.innerText = "Failed to load"
+                }
+            })
+            return
+        }
+
         // do the request in the background
         progFetch(source, {
             progress: async (read, total) => {
@@ -136,15 +148,18 @@ import "../styles/content.scss"
     }
 
     function statImage(source: HTMLElement, templateElement: HTMLElement) {
-        const size = document.createElement("div")
-        const sizeof = source.dataset.contentSize ? parseInt(source.dataset.contentSize) : 0
-        if (sizeof > 0) {
-            size.innerText = `${siBytes(sizeof)} image`
-        } else {
-            size.innerText = "???B image"
+        // with a srcset the browser picks one of the smaller copies, so the original's size is wrong
+        if (!("imgSrcset" in source.dataset)) {
+            const size = document.createElement("div")
+            const sizeof = source.dataset.contentSize ? parseInt(source.dataset.contentSize) : 0
+            if (sizeof > 0) {
+                size.innerText = `${siBytes(sizeof)} image`
+            } else {
+                size.innerText = "???B image"
+            }
+            size.classList.add("_size")
+            templateElement.appendChild(size)
         }
-        size.classList.add("_size")
-        templateElement.appendChild(size)
         if ("width" in source.dataset && "height" in source.dataset && "format" in source.dataset) {
             const isize = document.createElement("div")
             isize.classList.add("_isize")
@@ -209,7 +224,9 @@ import "../styles/content.scss"
             if (e instanceof HTMLElement) {
                 assert('contentSize' in e.dataset)
                 assert('replacementType' in e.dataset)
-                if (parseInt(e.dataset.contentSize!) <= autoloadSize) {
+                const size = parseInt(e.dataset.contentSize!)
+                // a negative size is unknown: the image may be big, so it waits for a click
+                if (size >= 0 && size <= autoloadSize) {
                     // load the content now
                     tag(e, true)
                     load(e)
@@ -0,0 +1,127 @@
+"""
+HTMLRewriter against BeautifulSoup, which the actions fall back to when it raises RewriteUnsupported:
+an edit made by either has to give the same document once both are parsed again.
+"""
+
+from __future__ import annotations
+
+import unittest
+from pathlib import Path
+from typing import Callable
+
+import bs4
+
+from htmlrewrite import HTMLRewriter, RewriteUnsupported
+
+ROOT = Path(__file__).resolve().parent.parent
+PAGES = sorted((ROOT / "src").rglob("*.html"))
+HINT = '<link rel="preload" href="/dist/font.woff2" as="font" data-build-hint>'
+
+
+def tree(text: str) -> str:
+    return bs4.BeautifulSoup(text, "html.parser").decode()
+
+
+def remount(element):
+    # what fix_rel_url does to root-relative links
+    for attr in ("href", "src"):
+        value = element.get_attribute(attr)
+        if value is not None and value.startswith("/") and not value.startswith("//"):
+            element.set_attribute(attr, "/v/nojs" + value)
+
+
+def remount_soup(soup: bs4.BeautifulSoup):
+    for tag in soup.select("[href], [src]"):
+        for attr in ("href", "src"):
+            value = tag.get(attr)
+            if isinstance(value, str) and value.startswith("/") and not value.startswith("//"):
+                tag[attr] = "/v/nojs" + value
+
+
+def strip_scripts_soup(soup: bs4.BeautifulSoup):
+    # what noscript_v2 does
+    for tag in soup.select("script, [data-js-required]"):
+        tag.decompose()
+
+
+def hint_soup(soup: bs4.BeautifulSoup):
+    assert soup.head is not None
+    soup.head.append(bs4.BeautifulSoup(HINT, "html.parser"))
+
+
+EDITS: dict[str, tuple[Callable[[], HTMLRewriter], Callable[[bs4.BeautifulSoup], None]]] = {
+    "remount": (lambda: HTMLRewriter().on("[href], [src]", remount), remount_soup),
+    "strip scripts": (
+        lambda: HTMLRewriter().on("script, [data-js-required]", lambda e: e.remove()),
+        strip_scripts_soup,
+    ),
+    "hint": (lambda: HTMLRewriter().on("head", lambda e: e.append(HINT)), hint_soup),
+}
+
+
+class SoupComparison(unittest.TestCase):
+    def assertSameEdit(self, text: str, edit: str):
+        rewriter, change = EDITS[edit]
+        soup = bs4.BeautifulSoup(text, "html.parser")
+        change(soup)
+        # parsed again: a tag bs4 removed leaves the whitespace around it in two strings
+        self.assertEqual(tree(rewriter().transform(text)), tree(soup.decode()))
+
+
+class SameAsSoup(SoupComparison):
+    def test_pages(self):
+        self.assertTrue(PAGES)
+        for page in PAGES:
+            text = page.read_text(encoding="utf-8")
+            with self.subTest(page=page.relative_to(ROOT).as_posix()):
+                self.assertEqual(HTMLRewriter().transform(text), text)
+            for edit in EDITS:
+                with self.subTest(page=page.relative_to(ROOT).as_posix(), edit=edit):
+                    self.assertSameEdit(text, edit)
+
+    def test_untouched_bytes(self):
+        text = "<!DOCTYPE html><P CLASS=a\tid='b'>x &amp y<!-- <p> --><br/><?pi?></P>"
+        self.assertEqual(HTMLRewriter().on("p", lambda e: None).transform(text), text)
+
+    def test_raw_text(self):
+        text = '<script>if (a < b) document.write("<a href=/x>")</script><a href="/y">y</a>'
+        self.assertSameEdit(text, "remount")
+        self.assertSameEdit(text, "strip scripts")
+
+
+class OmittedEndTags(SoupComparison):
+    def test_attributes_of_implicitly_ended_elements(self):
+        self.assertSameEdit('<ul><li><a href="/a">a</a><li><img src="/b"></ul>', "remount")
+        self.assertSameEdit('<p><a href="/a">a</a><p>b<div src="/c"></div>', "remount")
+        self.assertSameEdit('<table><tr><td><a href="/a">a<td>b</table>', "remount")
+
+    def test_implied_body(self):
+        text = '<html><head><title>t</title></head><p><script src="/a.js"></script>x'
+        self.assertSameEdit(text, "hint")
+        self.assertSameEdit(text, "strip scripts")
+
+    def test_removing_implicitly_ended_element(self):
+        text = "<ul><li data-js-required>a<li>b</ul>"
+        rewriter = HTMLRewriter().on("[data-js-required]", lambda e: e.remove())
+        with self.assertRaises(RewriteUnsupported):
+            rewriter.transform(text)
+
+    def test_appending_to_implicitly_ended_element(self):
+        rewriter = HTMLRewriter().on("p", lambda e: e.append("<b>x</b>"))
+        with self.assertRaises(RewriteUnsupported):
+            rewriter.transform("<p>a<p>b")
+
+    def test_head_without_end_tag(self):
+        rewriter, _ = EDITS["hint"]
+        with self.assertRaises(RewriteUnsupported):
+            rewriter().transform("<html><head><title>t</title><body>x</body></html>")
+
+    def test_removed_element_never_closed(self):
+        with self.assertRaises(RewriteUnsupported):
+            HTMLRewriter().on("div", lambda e: e.remove()).transform("<div>a<div>b</div>")
+        with self.assertRaises(RewriteUnsupported):
+            HTMLRewriter().on("script", lambda e: e.remove()).transform("<script>a()")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+"""The import-time budget of benchmark.py --imports."""
+
+from __future__ import annotations
+
+import unittest
+
+from benchmark import IMPORT_BUDGET, IMPORT_STATEMENT, eager_imports, import_cost
+
+# best of this many interpreter starts, which evens out a busy machine
+REPEAT = 5
+
+
+class ImportBudget(unittest.TestCase):
+    def test_no_eager_imports(self):
+        self.assertEqual(eager_imports(), [], f"{IMPORT_STATEMENT} loads them at startup")
+
+    def test_budget(self):
+        bare, cost = import_cost(REPEAT)
+        self.assertLessEqual(
+            cost,
+            IMPORT_BUDGET * bare,
+            f"{IMPORT_STATEMENT} adds {cost * 1e3:.0f}ms to a {bare * 1e3:.0f}ms interpreter start",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
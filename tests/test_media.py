@@ -0,0 +1,107 @@
+"""packaging.py's remote image probe and original download, against a local http.server."""
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import io
+import tempfile
+import threading
+import unittest
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+from PIL import Image
+
+import packaging
+from packaging import MediaCache, MediaInfo, fetch_remote_media, remote_original
+
+
+def image_bytes(size: tuple[int, int], fmt: str) -> bytes:
+    out = io.BytesIO()
+    Image.new("RGB", size, (200, 80, 20)).save(out, fmt)
+    return out.getvalue()
+
+
+class Handler(SimpleHTTPRequestHandler):
+    requests: list[tuple[str, int]]
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_response(self, code, message=None):
+        self.requests.append((self.path, code))
+        super().send_response(code, message)
+
+
+class RemoteMedia(unittest.TestCase):
+    def setUp(self):
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.root = Path(temp.name)
+        site = self.root / "site"
+        site.mkdir()
+        self.png = image_bytes((1200, 600), "PNG")
+        (site / "wide.png").write_bytes(self.png)
+        (site / "small.jpg").write_bytes(image_bytes((40, 30), "JPEG"))
+
+        Handler.requests = []
+        server = ThreadingHTTPServer(("127.0.0.1", 0), partial(Handler, directory=str(site)))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.base = f"http://127.0.0.1:{server.server_address[1]}"
+
+        self.cache = MediaCache(self.root / "cache" / "media.json")
+        self.enterContext(mock.patch.object(packaging, "media_cache", self.cache))
+        self.enterContext(mock.patch.object(packaging, "DERIVED_CACHE", self.root / "derived"))
+        self.enterContext(contextlib.redirect_stdout(io.StringIO()))
+
+    def test_cache_is_read_on_first_use(self):
+        self.cache.put("url:x", {"info": [1, 2, 3, "PNG", "RGB"]})
+        self.cache.save()
+        cache = MediaCache(self.cache.path)
+        self.assertFalse(cache.loaded)
+        self.assertEqual(cache.entries, {})
+        self.assertIsNotNone(cache.get("url:x"))
+        self.assertTrue(cache.loaded)
+
+    def test_probe(self):
+        wide, small, missing = (
+            f"{self.base}/{name}" for name in ("wide.png", "small.jpg", "no.png")
+        )
+        found = fetch_remote_media([wide, small, missing])
+        self.assertEqual(found[wide], MediaInfo(len(self.png), 1200, 600, "PNG", "RGB"))
+        self.assertEqual((found[small].width, found[small].height), (40, 30))
+        self.assertIsNone(found[missing])
+
+        # fresh entries aren't requested again
+        asked = len(Handler.requests)
+        self.assertEqual(fetch_remote_media([wide])[wide], found[wide])
+        self.assertEqual(len(Handler.requests), asked)
+
+        # stale ones are revalidated with If-Modified-Since
+        self.cache.validated.clear()
+        self.assertEqual(fetch_remote_media([wide])[wide], found[wide])
+        self.assertEqual(Handler.requests[-1], ("/wide.png", 304))
+
+        self.cache.save()
+        self.assertIsNotNone(MediaCache(self.cache.path).get("url:" + wide))
+
+    def test_fetch_original(self):
+        wide = f"{self.base}/wide.png"
+        fetch_remote_media([wide])
+        downloaded = remote_original(wide, [480, 960])
+        assert downloaded is not None
+        path, digest = downloaded
+        assert path is not None
+        self.assertEqual(Path(path).read_bytes(), self.png)
+        self.assertEqual(digest, hashlib.sha256(self.png).hexdigest())
+        self.assertEqual(self.cache.get("url:" + wide)["digest"], digest)
+        self.assertIsNone(remote_original(f"{self.base}/no.png", [480]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+"""serve.py's answers to requests for paths it can't serve."""
+
+from __future__ import annotations
+
+import http.client
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from serve import make_server
+
+CONFIG = Path(__file__).resolve().parent.parent / "alter.yaml"
+
+
+class BadPaths(unittest.TestCase):
+    def setUp(self):
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        root = Path(temp.name)
+        (root / "index.html").write_text("<p>index</p>", encoding="utf-8")
+        server, _ = make_server(root, "127.0.0.1", 0, CONFIG)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.port = server.server_address[1]
+
+    def status(self, path: str) -> int:
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=5)
+        self.addCleanup(connection.close)
+        connection.request("GET", path)
+        return connection.getresponse().status
+
+    def test_null_byte(self):
+        self.assertEqual(self.status("/a%00b"), 400)
+        self.assertEqual(self.status("/%00/index.html"), 400)
+        # the server is still up
+        self.assertEqual(self.status("/"), 200)
+
+    def test_outside_root(self):
+        self.assertEqual(self.status("/../../etc/passwd"), 404)
+        self.assertEqual(self.status("/%2e%2e/%2e%2e/etc/passwd"), 404)
+
+
+if __name__ == "__main__":
+    unittest.main()